@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+def _save(path: Path, array: np.ndarray):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(array).save(path)
+
+
+@pytest.fixture(scope="session")
+def dataset_dir(tmp_path_factory) -> Path:
+    """
+    A prepared dataset of small random images. ``test_images/bad`` has a
+    rectangular defect mask per image in ``test_masks``, ``good`` images
+    have none.
+    """
+    dataset_dir = tmp_path_factory.mktemp("dataset")
+    rng = np.random.default_rng(0)
+    for folder in ("train_images", "test_images"):
+        for category in ("bad", "good"):
+            for i in range(6):
+                _save(
+                    dataset_dir / folder / category / f"{i}.png",
+                    rng.integers(0, 256, (40, 48, 3), dtype=np.uint8)
+                )
+    for i in range(6):
+        mask = np.zeros((40, 48), dtype=np.uint8)
+        mask[8 + i:20 + i, 10:30] = 255
+        _save(dataset_dir / "test_masks" / "bad" / f"{i}.png", mask)
+    return dataset_dir
@@ -0,0 +1,72 @@
+from tfds_defect_detection.benchmark import benchmark_configs, \
+    compare_backends, compare_results, config_key
+
+
+def report(*results):
+    return {"results": list(results)}
+
+
+def result(images_per_second, **config):
+    return {
+        "config": {"batch_size": 8, "resolution": (256, 256), **config},
+        "images_per_second": images_per_second,
+        "batch_latency_p99": 8 / images_per_second,
+    }
+
+
+def test_config_key_ignores_order_and_tuples():
+    assert config_key({"a": (1, 2), "b": 3}) == config_key(
+        {"b": 3, "a": [1, 2]}
+    )
+    assert config_key({"a": 1, "b": 2}, ignore_keys=("b",)) == config_key(
+        {"a": 1}
+    )
+
+
+def test_benchmark_configs_fill_the_default_grid():
+    configs = benchmark_configs({
+        "pairing_mode": ["result_only"],
+        "create_artificial_anomalies": [True],
+        "drop_masks": [False],
+        "with_masks": [False],
+        "resolution": [(256, 256)],
+        "batch_size": [8, 32],
+    })
+
+    assert [config["batch_size"] for config in configs] == [8, 32]
+    assert all(config["synthesis_backend"] == "generator"
+               for config in configs)
+
+
+def test_compare_results_flags_regressions():
+    comparison = compare_results(
+        report(result(100.0, seed=1), result(100.0, seed=2)),
+        report(result(97.0, seed=1), result(80.0, seed=2)),
+        tolerance=0.05
+    )
+
+    assert [entry["regression"] for entry in comparison] == [False, True]
+    assert abs(comparison[1]["change"] + 0.2) < 1e-9
+    assert comparison[1]["images_per_second"] == (100.0, 80.0)
+
+
+def test_compare_results_skips_errors_and_new_configs():
+    comparison = compare_results(
+        report(result(100.0, seed=1), {"config": {"seed": 2}, "error": "x"}),
+        report(result(50.0, seed=1), result(50.0, seed=2),
+               result(50.0, seed=3)),
+    )
+
+    assert [entry["config"]["seed"] for entry in comparison] == [1]
+
+
+def test_compare_backends_matches_equal_configs():
+    comparison = compare_backends(report(
+        result(100.0, synthesis_backend="generator"),
+        result(300.0, synthesis_backend="parallel"),
+    ))
+
+    assert len(comparison) == 1
+    assert comparison[0]["config"]["synthesis_backend"] == "parallel"
+    assert abs(comparison[0]["change"] - 2.0) < 1e-9
+    assert not comparison[0]["regression"]
@@ -0,0 +1,60 @@
+import numpy as np
+
+from tfds_defect_detection.cache import DecodedImageCache
+
+
+def image(nbytes=100):
+    return np.zeros(nbytes, dtype=np.uint8)
+
+
+def test_evicts_least_recently_used():
+    cache = DecodedImageCache(max_bytes=300)
+    for key in "abc":
+        cache.put(key, image())
+    assert cache.get("a") is not None
+
+    cache.put("d", image())
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert cache.nbytes == 300
+
+
+def test_counts_replaced_images_once():
+    cache = DecodedImageCache(max_bytes=300)
+    cache.put("a", image())
+    cache.put("a", image(200))
+
+    assert len(cache) == 1
+    assert cache.nbytes == 200
+
+
+def test_skips_images_above_the_budget():
+    cache = DecodedImageCache(max_bytes=100)
+    cache.put("a", image())
+    cache.put("b", image(101))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.nbytes == 100
+
+
+def test_resize_evicts_down_to_the_new_budget():
+    cache = DecodedImageCache(max_bytes=300)
+    for key in "abc":
+        cache.put(key, image())
+
+    cache.resize(100)
+
+    assert len(cache) == 1
+    assert cache.get("c") is not None
+    assert cache.nbytes == 100
+
+
+def test_counts_hits_and_misses():
+    cache = DecodedImageCache()
+    cache.put("a", image())
+    cache.get("a")
+    cache.get("b")
+
+    assert (cache.hits, cache.misses) == (1, 1)
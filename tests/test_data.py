@@ -0,0 +1,172 @@
+import itertools
+from pathlib import Path
+
+import albumentations as A
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from tfds_defect_detection.data import DatasetBuilder
+
+
+def builder(dataset_dir, **kwargs):
+    return DatasetBuilder(**{
+        "image_directory": dataset_dir / "train_images",
+        "width": 32,
+        "height": 32,
+        "batch_size": 4,
+        "repeat": False,
+        "peek": False,
+        "seed": 5,
+        **kwargs
+    })
+
+
+def batches(ds, num_batches=3):
+    return [
+        [value.numpy() for value in tf.nest.flatten(batch)]
+        for batch in ds.take(num_batches)
+    ]
+
+
+def assert_same_batches(first, second):
+    assert len(first) == len(second)
+    for batch, other in zip(first, second):
+        for value, other_value in zip(batch, other):
+            np.testing.assert_array_equal(value, other_value)
+
+
+@pytest.mark.parametrize("backends", [
+    [
+        ("generator", {}),
+        ("parallel", {"num_parallel_calls": 1}),
+        ("parallel", {"num_parallel_calls": 4}),
+        ("process", {"num_workers": 1}),
+        ("process", {"num_workers": 3}),
+    ],
+    [
+        ("graph", {"num_parallel_calls": 1}),
+        ("graph", {"num_parallel_calls": 4}),
+        ("vectorized", {}),
+    ],
+])
+def test_backends_are_reproducible(dataset_dir, backends):
+    """
+    Backends of one group give the same batches for the same seed,
+    independent of the number of workers.
+    """
+    results = [
+        batches(builder(
+            dataset_dir,
+            synthesis_backend=backend,
+            process_deviation=A.Compose([A.RandomBrightnessContrast()]),
+            pairing_mode="result_with_original",
+            **kwargs
+        ).ds)
+        for backend, kwargs in backends
+    ]
+    for first, second in itertools.combinations(results, 2):
+        assert_same_batches(first, second)
+
+
+def test_contrastive_pairs_share_the_label(dataset_dir):
+    data = builder(dataset_dir, pairing_mode="result_with_contrastive_pair")
+    data.ds
+
+    for label, name in enumerate(data._class_names):
+        paths = {
+            data._pair_path(
+                label, tf.constant([5, 0, index], tf.int64)
+            ).numpy().decode()
+            for index in range(32)
+        }
+        assert {Path(path).parent.name for path in paths} == {name}
+        # Draws spread over the files of the label
+        assert len(paths) > 1
+        # and are the same for the same element seed
+        assert data._pair_path(
+            label, tf.constant([5, 0, 3], tf.int64)
+        ).numpy() == data._pair_path(
+            label, tf.constant([5, 0, 3], tf.int64)
+        ).numpy()
+
+
+def file_elements(data):
+    data.ds
+    return [
+        (int(file_index), tuple(element_seed))
+        for file_index, element_seed in data._file_dataset(
+            data._tables["file_paths"]
+        ).as_numpy_iterator()
+    ]
+
+
+@pytest.mark.parametrize("num_shards", [2, 5])
+def test_shards_partition_an_epoch(dataset_dir, num_shards):
+    data = builder(dataset_dir)
+    unsharded = file_elements(data)
+    union = [
+        element
+        for index in range(num_shards)
+        for element in file_elements(builder(
+            dataset_dir,
+            num_shards=num_shards,
+            shard_index=index
+        ))
+    ]
+
+    assert sorted(file for file, _ in unsharded) == list(
+        range(len(data._tables["file_paths"]))
+    )
+    # No element is in two shards and together they are the epoch
+    assert len(union) == len(set(union)) == len(unsharded)
+    assert set(union) == set(unsharded)
+
+
+def tiles(dataset_dir, **kwargs):
+    data = builder(
+        dataset_dir,
+        width=16,
+        height=16,
+        tile_stride=8,
+        subset="",
+        **kwargs
+    )
+    data.ds
+    return list(data._raw_ds.as_numpy_iterator())
+
+
+def test_tiles_all_images(dataset_dir):
+    elements = tiles(dataset_dir)
+
+    # 40 x 48 images give 4 x 5 tiles every 8 pixels
+    assert len(elements) == 12 * 20
+    assert all(tile.shape == (16, 16, 3) for tile, _, _ in elements)
+    seeds = [tuple(seed) for _, _, seed in elements]
+    assert len(set(seeds)) == len(seeds)
+    assert all(seed[2] >= 0 for seed in seeds)
+
+
+def test_defect_biased_tiles_keep_the_defects(dataset_dir):
+    def defect_tiles(**kwargs):
+        return [
+            tile
+            for tile, _, _, mask in tiles(
+                dataset_dir,
+                image_directory=dataset_dir / "test_images",
+                mask_directory=dataset_dir / "test_masks",
+                **kwargs
+            )
+            if mask[..., 1].any()
+        ]
+
+    kept = tiles(
+        dataset_dir,
+        image_directory=dataset_dir / "test_images",
+        mask_directory=dataset_dir / "test_masks",
+        tile_selection="defect_biased",
+        tile_background_rate=0.0
+    )
+
+    assert all(mask[..., 1].any() for _, _, _, mask in kept)
+    assert len(kept) == len(defect_tiles()) > 0
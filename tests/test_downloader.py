@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from tfds_defect_detection.downloader import download_and_prepare
+from tfds_defect_detection.downloader.state import PreparationState, \
+    is_complete
+
+
+def save(path, array):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(array).save(path)
+
+
+@pytest.mark.parametrize("name, module, download_folders", [
+    ("mvtec", "mvtec", ["mvtec_download"]),
+    ("visa", "visual_anomalies", ["VisA", "VisA_mvtec_style"]),
+])
+def test_adopts_legacy_trees(tmp_path, monkeypatch, name, module,
+                             download_folders):
+    # Layout of a version without markers, which ran with delete_tmp=True
+    dataset_dir = tmp_path / name
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    save(dataset_dir / "train_images/candle/train/good/0.png", image)
+    save(dataset_dir / "test_images/candle/test/bad/1.png", image)
+    save(
+        dataset_dir / "test_masks/candle/test/bad/1.png",
+        np.full((8, 8), 255, dtype=np.uint8)
+    )
+    for folder in download_folders:
+        (dataset_dir / folder).mkdir()
+
+    def download_and_extract(cache_dir):
+        raise AssertionError("the download is fetched again")
+
+    monkeypatch.setattr(
+        f"tfds_defect_detection.downloader.{module}.download_and_extract",
+        download_and_extract
+    )
+    for _ in range(2):
+        list(download_and_prepare(tmp_path, [name]))
+
+    state = PreparationState(dataset_dir)
+    assert state.is_complete()
+    assert state.categories() == ["candle"]
+    assert sorted(state.files()) == sorted(state.files("candle")) == [
+        "test_images/candle/test/bad/1.png",
+        "test_masks/candle/test/bad/1.png",
+        "train_images/candle/train/good/0.png",
+    ]
+    assert all(
+        is_complete(dataset_dir / folder) for folder in download_folders
+    )
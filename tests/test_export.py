@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from tfds_defect_detection.data import DatasetBuilder
+from tfds_defect_detection.export import export_synthetic_epochs, \
+    load_synthetic_epochs
+
+
+@pytest.mark.parametrize("output_dtype, mask_format", [
+    ("float32", "onehot"),
+    ("uint8", "bool"),
+])
+def test_round_trip(tmp_path, dataset_dir, output_dtype, mask_format):
+    kwargs = dict(
+        image_directory=dataset_dir / "train_images",
+        width=32,
+        height=32,
+        batch_size=4,
+        pairing_mode="result_with_original",
+        output_dtype=output_dtype,
+        mask_format=mask_format,
+        seed=7,
+    )
+    export_synthetic_epochs(tmp_path, epochs=1, num_shards=2, **kwargs)
+
+    loaded = load_synthetic_epochs(
+        tmp_path,
+        pairing_mode="result_with_original",
+        batch_size=4,
+        shuffle=False,
+        repeat=False
+    )
+    expected = DatasetBuilder(repeat=False, peek=False, **kwargs).ds
+
+    assert loaded.element_spec == expected.element_spec
+    batches, expected_batches = list(loaded), list(expected)
+    assert len(batches) == len(expected_batches)
+    for batch, expected_batch in zip(batches, expected_batches):
+        for value, expected_value in zip(
+                tf.nest.flatten(batch),
+                tf.nest.flatten(expected_batch)
+        ):
+            np.testing.assert_allclose(
+                value.numpy().astype(np.float32),
+                expected_value.numpy().astype(np.float32),
+                atol=1e-6
+            )
+
+
+def test_rejects_empty_exports(tmp_path, dataset_dir):
+    with pytest.raises(ValueError):
+        export_synthetic_epochs(
+            tmp_path,
+            epochs=0,
+            image_directory=dataset_dir / "train_images"
+        )
@@ -0,0 +1,60 @@
+import albumentations as A
+import numpy as np
+import tensorflow as tf
+
+from tfds_defect_detection import graph_synthesis
+
+TRANSFORM = A.Compose([A.HorizontalFlip(), A.RandomBrightnessContrast()])
+
+
+def images(batch_size=4, size=32):
+    return tf.constant(
+        np.random.default_rng(0).integers(
+            0, 256, (batch_size, size, size, 3)
+        ),
+        tf.float32
+    )
+
+
+def test_numpy_rng_accepts_negative_seeds():
+    seed = np.array([-1, -2 ** 63], dtype=np.int64)
+
+    first = graph_synthesis.numpy_rng(seed).integers(2 ** 32, size=4)
+    second = graph_synthesis.numpy_rng(seed).integers(2 ** 32, size=4)
+
+    np.testing.assert_array_equal(first, second)
+
+
+def test_transforms_accept_negative_seeds():
+    seeds = tf.constant([[-5, -7], [3, -1], [-2, 8], [-9, -9]], tf.int64)
+
+    single = graph_synthesis.apply_transform(
+        TRANSFORM,
+        images()[0],
+        seeds[0]
+    )
+    batch = graph_synthesis.apply_transform_batch(TRANSFORM, images(), seeds)
+
+    assert single.shape == (32, 32, 3)
+    assert batch.shape == (4, 32, 32, 3)
+
+
+def test_batch_synthesis_with_composition():
+    # Seeds split from these elements are negative for some of them
+    element_seeds = tf.constant(
+        [[123, 0, index] for index in range(4)],
+        tf.int64
+    )
+    results = [
+        graph_synthesis.create_anomalies_batch(
+            images(),
+            images(),
+            element_seeds,
+            width=32,
+            anomaly_composition=TRANSFORM
+        )
+        for _ in range(2)
+    ]
+
+    for first, second in zip(*map(tf.nest.flatten, results)):
+        np.testing.assert_array_equal(first.numpy(), second.numpy())
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = (
+    "tensorflow",
+    "keras",
+    "albumentations",
+    "matplotlib",
+    "cv2",
+    "skimage",
+)
+
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def test_import_time():
+    """
+    Imports the package, the downloader and the utils in a fresh
+    interpreter. No heavy dependency may get imported and the import has
+    to stay within ``IMPORT_BUDGET_SECONDS``.
+    """
+    code = "\n".join([
+        "import sys, time",
+        "start = time.perf_counter()",
+        "import tfds_defect_detection",
+        "import tfds_defect_detection.downloader",
+        "import tfds_defect_detection.utils",
+        "print(time.perf_counter() - start)",
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+    ])
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).resolve().parents[1]
+    ).stdout.splitlines()
+    seconds, imported = float(output[0]), output[1]
+
+    assert not imported, f"Heavy modules imported eagerly: {imported}"
+    assert seconds < IMPORT_BUDGET_SECONDS, (
+        f"Import took {seconds:.2f}s, "
+        f"budget is {IMPORT_BUDGET_SECONDS:.2f}s"
+    )
@@ -0,0 +1,81 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from tfds_defect_detection.manifest import Manifest, split_key, \
+    write_manifest
+from tfds_defect_detection.utils import index_directory
+
+
+def prepared_dataset(dataset_dir: Path) -> Path:
+    for relative in [
+        "train_images/good/a.png",
+        "train_images/good/b.png",
+        "test_images/good/c.png",
+        "test_images/bad/d.png",
+        "test_masks/bad/d.png",
+    ]:
+        path = dataset_dir / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    return dataset_dir
+
+
+def test_split_key_is_stable():
+    keys = [split_key(f"good/{i:03d}.png") for i in range(200)]
+
+    assert all(0 <= key < 1 for key in keys)
+    assert split_key("good/000.png") == keys[0]
+    assert split_key(Path("good") / "000.png") == keys[0]
+    # Roughly uniform, so validation_split keeps its meaning
+    assert 0.3 < np.mean(np.asarray(keys) < 0.5) < 0.7
+
+
+def test_covers_the_listed_folders(tmp_path):
+    dataset_dir = prepared_dataset(tmp_path / "dataset")
+    (tmp_path / "other" / "train_images").mkdir(parents=True)
+    write_manifest(dataset_dir)
+
+    manifest = Manifest.load(dataset_dir)
+
+    assert manifest.covers(dataset_dir / "train_images")
+    assert manifest.covers(dataset_dir / "test_masks")
+    assert not manifest.covers(dataset_dir / "missing")
+    assert not manifest.covers(tmp_path / "other" / "train_images")
+
+
+def test_matches_the_directory_listing(tmp_path):
+    dataset_dir = prepared_dataset(tmp_path)
+    write_manifest(dataset_dir)
+    manifest = Manifest.load(dataset_dir)
+
+    file_paths, labels, _, class_names = manifest.index_directory(
+        dataset_dir / "test_images",
+        shuffle=False
+    )
+    expected = index_directory(dataset_dir / "test_images", shuffle=False)
+
+    np.testing.assert_array_equal(file_paths, expected[0])
+    np.testing.assert_array_equal(labels, expected[1])
+    assert class_names == expected[2]
+    np.testing.assert_array_equal(
+        manifest.mask_paths(
+            file_paths,
+            dataset_dir / "test_images",
+            dataset_dir / "test_masks"
+        ),
+        [str(dataset_dir / "test_masks" / "bad" / "d.png"), ""]
+    )
+
+
+def test_is_stale_after_a_change(tmp_path):
+    dataset_dir = prepared_dataset(tmp_path)
+    write_manifest(dataset_dir)
+
+    good_dir = dataset_dir / "train_images" / "good"
+    (good_dir / "e.png").write_bytes(b"")
+    # The file system may keep the mtime within its timestamp granularity
+    os.utime(good_dir, ns=(0, 0))
+
+    assert Manifest.load(dataset_dir) is None
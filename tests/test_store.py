@@ -0,0 +1,39 @@
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from tfds_defect_detection import store
+from tfds_defect_detection.manifest import write_manifest
+
+
+def prepared(tmp_path, dataset_dir):
+    dataset_dir = shutil.copytree(dataset_dir, tmp_path / "dataset")
+    write_manifest(dataset_dir)
+    store.prepare_image_store(dataset_dir, width=16, height=16)
+    return dataset_dir
+
+
+def test_opens_without_scanning_the_folders(tmp_path, dataset_dir,
+                                            monkeypatch):
+    dataset_dir = prepared(tmp_path, dataset_dir)
+
+    def index_directory(*args, **kwargs):
+        raise AssertionError("folders are scanned")
+
+    monkeypatch.setattr(store, "index_directory", index_directory)
+    image_store = store.ImageStore.open(dataset_dir, 16, 16)
+
+    assert image_store is not None
+    assert image_store.array.shape == (30, 16, 16, 3)
+
+
+def test_does_not_open_changed_stores(tmp_path, dataset_dir):
+    dataset_dir = prepared(tmp_path, dataset_dir)
+    Image.fromarray(np.zeros((40, 48, 3), dtype=np.uint8)).save(
+        dataset_dir / "train_images" / "good" / "new.png"
+    )
+
+    assert store.ImageStore.open(dataset_dir, 16, 16) is None
+    store.prepare_image_store(dataset_dir, width=16, height=16)
+    assert store.ImageStore.open(dataset_dir, 16, 16) is not None
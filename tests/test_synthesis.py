@@ -0,0 +1,103 @@
+import itertools
+
+import numpy as np
+
+from tfds_defect_detection.synthesis import AnomalySynthesizer, \
+    PolygonMaskBank, ProcessPoolSynthesizer, SharedMemoryRingBuffer, \
+    _segments_cross, random_polygon
+
+
+def test_random_polygon_is_simple():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        polygon = random_polygon(12, rng)
+        assert polygon.shape == (12, 2)
+        assert ((polygon >= 0) & (polygon < 1)).all()
+
+        edges = list(zip(polygon, np.roll(polygon, -1, axis=0)))
+        for (i, a), (j, b) in itertools.combinations(enumerate(edges), 2):
+            if j - i in (1, len(edges) - 1):
+                # Neighbouring edges share a vertex
+                continue
+            assert not _segments_cross(*a, *b)
+
+
+def test_ring_buffer_is_shared_by_name():
+    buffer = SharedMemoryRingBuffer(2, 4, 4)
+    attached = SharedMemoryRingBuffer(2, 4, 4, name=buffer.name)
+    try:
+        attached.result[1] = 7
+        attached.seeds[1] = (1, 2, 3)
+
+        assert (buffer.result[1] == 7).all()
+        assert (buffer.result[0] == 0).all()
+        assert tuple(buffer.seeds[1]) == (1, 2, 3)
+    finally:
+        attached.close()
+        buffer.close()
+        buffer.unlink()
+
+
+def test_process_pool_reuses_slots_in_order():
+    width = height = 4
+    pairs = [
+        (
+            np.full((width, height, 3), i, dtype=np.uint8),
+            np.full((width, height, 3), 100 + i, dtype=np.uint8),
+            np.array([0, 0, i]),
+        )
+        for i in range(7)
+    ]
+    synthesizer = AnomalySynthesizer(
+        width=width,
+        create_artificial_anomalies=False
+    )
+
+    results, slots = [], set()
+    with ProcessPoolSynthesizer(
+            synthesizer,
+            width,
+            height,
+            num_workers=2,
+            buffer_depth=2
+    ) as pool:
+        for original, result, mask in pool.imap(pairs):
+            slots.add(result.__array_interface__["data"][0])
+            # Views are only valid until the next item, see imap
+            results.append((original.copy(), result.copy(), mask.copy()))
+
+    assert len(slots) == 2
+    for i, (original, result, mask) in enumerate(results):
+        assert (original == i).all()
+        assert (result == 100 + i).all()
+        assert not mask.any()
+
+
+def test_polygon_mask_bank_is_reproducible():
+    banks = [PolygonMaskBank(masks_per_size=4, seed=1) for _ in range(2)]
+    masks = [
+        bank.sample(16, np.random.default_rng(0))
+        for bank in banks
+    ]
+
+    assert masks[0].shape == (16, 16)
+    assert masks[0].dtype == bool
+    assert masks[0].any()
+    np.testing.assert_array_equal(*masks)
+
+
+def test_polygon_mask_bank_evicts_buckets():
+    bank = PolygonMaskBank(masks_per_size=4, max_bytes=1)
+    bank.warm_up([8, 16])
+
+    # The most recent bucket is kept, even above the budget
+    assert list(bank._buckets) == [16]
+
+
+def test_polygon_mask_bank_persists_buckets(tmp_path):
+    bank = PolygonMaskBank(masks_per_size=4, path=tmp_path)
+    bank.warm_up([16])
+
+    assert bank._bucket_file(16).is_file()
+    loaded = PolygonMaskBank(masks_per_size=4, path=tmp_path)
+    np.testing.assert_array_equal(loaded._bucket(16), bank._bucket(16))
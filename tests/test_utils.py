@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+
+from tfds_defect_detection.utils import index_directory, pair_mask_paths
+
+
+def touch(path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    return path
+
+
+def test_pair_mask_paths(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    file_paths = [
+        str(touch(images / "bad" / "a.jpg")),
+        str(touch(images / "bad" / "b.bmp")),
+        str(touch(images / "good" / "c.jpg")),
+    ]
+    png_mask = touch(masks / "bad" / "a.png")
+    same_name_mask = touch(masks / "bad" / "b.bmp")
+
+    assert list(pair_mask_paths(file_paths, images, masks)) == [
+        str(png_mask),
+        str(same_name_mask),
+        "",
+    ]
+
+
+def test_pair_mask_paths_requires_masks_of_defects(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    file_paths = [str(touch(images / "bad" / "a.png"))]
+
+    with pytest.raises(FileNotFoundError):
+        pair_mask_paths(file_paths, images, masks)
+
+
+def test_pair_mask_paths_uses_existing_masks(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    file_paths = [str(images / "bad" / "a.jpg")]
+
+    # Nothing exists on disk, only the listing is used
+    assert list(pair_mask_paths(
+        file_paths,
+        images,
+        masks,
+        existing=[str(masks / "bad" / "a.png")]
+    )) == [str(masks / "bad" / "a.png")]
+
+
+def test_index_directory_keeps_labels_with_unseeded_shuffle(tmp_path):
+    for class_name in ("a", "b", "c"):
+        for i in range(10):
+            touch(tmp_path / class_name / f"{i}.png")
+
+    file_paths, labels, class_names = index_directory(tmp_path)
+
+    assert [
+        Path(path).parent.name for path in file_paths
+    ] == [class_names[label] for label in labels]
@@ -0,0 +1,64 @@
+import json
+from pathlib import Path
+
+from PIL import Image
+
+from tfds_defect_detection.validation import cache_file, validate_images
+
+
+def image_folder(folder: Path) -> Path:
+    (folder / "good").mkdir(parents=True)
+    for name in ("a.png", "b.png"):
+        Image.new("RGB", (8, 8)).save(folder / "good" / name)
+    data = (folder / "good" / "b.png").read_bytes()
+    (folder / "good" / "b.png").write_bytes(data[:len(data) // 2])
+    return folder
+
+
+def validate(folder: Path):
+    return validate_images(folder, mode="header", num_workers=2)
+
+
+def test_reports_corrupt_files(tmp_path):
+    report = validate(image_folder(tmp_path / "images"))
+
+    assert report.num_files == 2
+    assert report.num_checked == 2
+    assert list(report.corrupt) == ["good/b.png"]
+
+
+def test_caches_results(tmp_path):
+    folder = image_folder(tmp_path / "images")
+    validate(folder)
+
+    report = validate(folder)
+
+    assert report.num_checked == 0
+    assert report.num_cached == 2
+    assert list(report.corrupt) == ["good/b.png"]
+
+
+def test_prunes_deleted_files(tmp_path):
+    folder = image_folder(tmp_path / "images")
+    validate(folder)
+
+    (folder / "good" / "b.png").unlink()
+    report = validate(folder)
+
+    assert report.ok
+    with open(cache_file(folder)) as f:
+        assert list(json.load(f)) == ["good/a.png"]
+
+
+def test_skips_hidden_and_partial_files(tmp_path):
+    folder = image_folder(tmp_path / "images")
+    (folder / "good" / "b.png").unlink()
+    (folder / "good" / ".c.png.partial").write_bytes(b"")
+    (folder / "good" / ".d.png").write_bytes(b"")
+    (folder / "bad.partial").mkdir()
+    (folder / "bad.partial" / "e.png").write_bytes(b"")
+
+    report = validate(folder)
+
+    assert report.num_files == 1
+    assert report.ok
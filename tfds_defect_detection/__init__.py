@@ -1,11 +1,17 @@
 __version__ = "0.1.0"
 
+import time
 from pathlib import Path
-from typing import Optional, Iterable
+from typing import Optional, Iterable, Dict, Union, Tuple, TYPE_CHECKING
 
-import tensorflow as tf
 from typing_extensions import Literal
-import albumentations as A
+
+# TensorFlow, albumentations and matplotlib are only imported when
+# ``load`` runs, importing the package stays cheap
+if TYPE_CHECKING:
+    import albumentations as A
+    import tensorflow as tf
+    from tfds_defect_detection.synthesis import PolygonMaskBank
 
 
 def load(
@@ -29,17 +35,68 @@ def load(
         height=256,
         repeat=True,
         anomaly_size: Optional[int] = None,
-        process_deviation=A.Compose([]),
-        global_transform=A.Compose([]),
-        anomaly_composition=A.Compose([]),
+        process_deviation: Optional["A.Compose"] = None,
+        global_transform: Optional["A.Compose"] = None,
+        anomaly_composition: Optional["A.Compose"] = None,
         batch_size=8,
         seed=123,
         shuffle=True,
         peek=True,
         download=True,
-        image_validation=False,
+        image_validation: Union[bool, Literal["header", "decode"]] = False,
         crop_to_aspect_ratio=False,
         delete_tmp=True,
+        link_mode: Literal["copy", "hardlink", "reflink", "auto"] = "auto",
+        resize_on_ingest=False,
+        synthesis_backend: Literal[
+            "generator",
+            "parallel",
+            "process",
+            "graph",
+            "vectorized"
+        ] = "generator",
+        num_parallel_calls: Optional[int] = None,
+        num_workers: Optional[int] = None,
+        buffer_depth=16,
+        start_method: Optional[Literal[
+            "fork",
+            "spawn",
+            "forkserver"
+        ]] = None,
+        polygon_mask_bank: Optional["PolygonMaskBank"] = None,
+        image_cache_bytes: Optional[int] = None,
+        use_image_store=False,
+        split_by: Literal["seed", "manifest"] = "seed",
+        dataset_weights: Optional[Dict[str, float]] = None,
+        tile_stride: Optional[int] = None,
+        tile_image_size: Optional[Tuple[int, int]] = None,
+        tile_selection: Literal[
+            "all",
+            "foreground",
+            "defect_biased"
+        ] = "all",
+        num_shards: Optional[int] = None,
+        shard_index: Optional[int] = None,
+        input_context: Optional["tf.distribute.InputContext"] = None,
+        category_weights: Union[
+            None,
+            Literal["balanced"],
+            Dict[str, float]
+        ] = None,
+        lazy=False,
+        report_time_to_first_batch=False,
+        mask_color_mode: Literal["grayscale", "rgb"] = "grayscale",
+        output_dtype: Literal[
+            "float32",
+            "float16",
+            "bfloat16",
+            "uint8"
+        ] = "float32",
+        mask_format: Literal[
+            "onehot",
+            "uint8",
+            "bool"
+        ] = "onehot",
 ):
     """
 
@@ -128,30 +185,41 @@ def load(
         Whether to infinitely repeat the data. Defaults to ``True``
     anomaly_size : optional, ``int``
         if None the anomaly size will be random with min=width/8 and max=width/4
-    process_deviation : ``albumentations.Transform``
+    process_deviation : optional, ``albumentations.Transform``
         Data augmentation of the processed images
-    global_transform : ``albumentations.Transform``
+    global_transform : optional, ``albumentations.Transform``
         data augmentation of all images
-    anomaly_composition: ``albumentations.Transform``
+    anomaly_composition: optional, ``albumentations.Transform``
         data augmentation of the synthetic anomaly patches.
     batch_size : ``int``
         Size of the batches of data. Default: 8
     seed : ``int``
-        Optional random seed for shuffling.
+        Optional random seed for shuffling and the synthesis. The
+        randomness of every synthesized element is derived from
+        ``(seed, epoch, index)``, so a synthesis backend produces the same
+        batches no matter how many workers, shards or which batch size
+        are used. Reproducibility holds per backend: "generator",
+        "parallel" and "process" produce the same batches, as do "graph"
+        and "vectorized", but the two groups draw from different random
+        generators.
     shuffle : ``bool``
         Whether to shuffle the input files. Defaults to True.
     peek : ``bool``
         Whether to plot first batch of images of the loaded data.
-        Defaults to True.
+        Ignored if ``lazy``. Defaults to True.
     download : [DEPRECATED] optional, ``bool``
         This variable has no longer an effec.
         Whether download is set to ``False`` or ``True``, when
         ``data_dir`` to already holds the expected folder structure from a
         previous run, the function will always try to use the cached version
-    image_validation : optional, ``bool``
+    image_validation : optional, ``bool`` or ``str``
         Whether to open all images before calling the DatasetBuilder.
         This will print the name of corrupted image files,
-        which cannot be read by tensorflow. Defaults to ``False``
+        which cannot be read by tensorflow. Defaults to ``False``.
+        True or "decode" decode every file, "header" only checks the
+        headers and that no file is truncated, which is much faster.
+        Files are checked in parallel and results are cached, so only
+        new or changed files are checked again.
     crop_to_aspect_ratio : optional, ``bool``
         If True, resize the images without aspect ratio distortion.
         When the original aspect ratio differs from the target aspect ratio,
@@ -169,53 +237,231 @@ def load(
         so you can safely rerun this function without the need to download
         again. Yet, if you want to have a look at the original datasets,
         consider disabling this parameter.
+    link_mode : optional, ``str``
+        How files are placed into the prepared folder structure.
+        "auto" (default) hardlinks or reflinks them where the file system
+        allows it and copies otherwise, so the dataset is not duplicated
+        on disk during preparation. "copy", "hardlink" and "reflink"
+        force one method.
+    resize_on_ingest : optional, ``bool``
+        If True, images and masks are stored at ``width`` x ``height``
+        when the dataset is first prepared, instead of the multi-megapixel
+        originals. Saves disk space and decoding time in every epoch, but
+        fixes the resolution of the prepared dataset: loading it at
+        another size, or without ``resize_on_ingest``, raises a
+        ``ValueError``. Defaults to False.
+    synthesis_backend : optional, ``str``
+        - "generator" - (default) synthesizes the images one at a time in a
+            single python generator wrapped by
+            ``tf.data.Dataset.from_generator``
+        - "parallel" - synthesizes the images in a parallel ``map`` with
+            ``num_parallel_calls`` workers. Returns the same structure as
+            the "generator" backend.
+        - "process" - synthesizes the images in a pool of ``num_workers``
+            processes. Images and masks are exchanged as uint8 through a
+            shared memory ring buffer, which avoids the GIL and pickling.
+        - "graph" - synthesizes the images with TensorFlow ops only, so
+            the whole dataset is a traceable chain of parallel ``map``
+            calls. Polygons are star-shaped instead of the untangled
+            random polygons of the other backends. Non-empty
+            albumentations transforms still run through
+            ``tf.numpy_function``.
+        - "vectorized" - like "graph", but batches first and synthesizes
+            the anomalies for the whole batch with vectorized ops.
+    num_parallel_calls : optional, ``int``
+        Number of images synthesized in parallel by the parallel
+        backends. Defaults to ``tf.data.AUTOTUNE``.
+    num_workers : optional, ``int``
+        Number of worker processes of the "process" backend.
+        Defaults to the number of CPUs.
+    buffer_depth : optional, ``int``
+        Number of shared memory slots of the "process" backend, i.e. how
+        many images can be in flight at the same time. At least
+        ``num_workers``. Defaults to 16.
+    start_method : optional, ``str``
+        ``multiprocessing`` start method of the "process" backend,
+        "fork", "spawn" or "forkserver". Defaults to "forkserver" where
+        available and "spawn" otherwise, forking the multi-threaded
+        TensorFlow process can deadlock.
+    polygon_mask_bank : optional, ``PolygonMaskBank``
+        Samples the anomaly shapes from a bank of pre-rasterised polygon
+        masks instead of rasterising a new polygon per anomaly, see
+        ``tfds_defect_detection.synthesis.PolygonMaskBank``.
+        Used by the "generator", "parallel" and "process" backends.
+        Pass the same bank to several calls to share it.
+
+        .. code-block:: python
+
+            bank = PolygonMaskBank(path=Path("polygon_masks"))
+            bank.warm_up(range(256 // 8, 256 // 4))
+            ds = tfd.load(polygon_mask_bank=bank)
+    image_cache_bytes : optional, ``int``
+        RAM budget in bytes of the process-wide cache of decoded and
+        resized uint8 images. Images, masks and contrastive pairs of all
+        datasets loaded in the same process share the cache, least
+        recently used images are evicted. ``None`` (default) disables
+        the cache. See ``tfds_defect_detection.cache.get_image_cache``.
+    use_image_store : optional, ``bool``
+        If True, all images and masks are written once into a
+        memory-mapped uint8 store at ``width`` x ``height`` and read from
+        there without decoding. Processes on the same node share the
+        store through the page cache. The store is rebuilt when its
+        files change and not used with ``tile_stride``.
+        Defaults to ``False``. See ``tfds_defect_detection.store``.
+    lazy : optional, ``bool``
+        If True, nothing is listed, decoded or synthesized before the
+        returned dataset is first iterated, and ``peek`` is ignored.
+        The pipeline is the same, the file tables are filled on the first
+        iteration. With ``use_image_store`` the store is still opened
+        up front. Useful to create datasets for many subsets and
+        categories up front without paying for the unused ones.
+        Defaults to ``False``.
+    report_time_to_first_batch : optional, ``bool``
+        If True, pulls one batch through a separate iterator before
+        returning and prints the time from calling ``load`` until it
+        arrived. The returned dataset is not changed. Ignored if
+        ``lazy``. Defaults to ``False``.
+    num_shards : optional, ``int``
+        Number of input pipelines the data is split into for distributed
+        training. Each pipeline lists all files but only decodes and
+        synthesizes its share, element ``i`` of the global order goes to
+        shard ``i % num_shards``. Defaults to 1.
+    shard_index : optional, ``int``
+        The shard of this input pipeline, in ``[0, num_shards)``.
+        Defaults to 0.
+    input_context : optional, ``tf.distribute.InputContext``
+        Takes ``num_shards`` and ``shard_index`` from the input context
+        passed to the dataset function of
+        ``strategy.distribute_datasets_from_function``.
+        ``batch_size`` stays the batch size of this pipeline.
+    tile_stride : optional, ``int``
+        Enables tiling. Instead of resizing every image to ``width`` x
+        ``height``, images are cut into ``width`` x ``height`` tiles every
+        ``tile_stride`` pixels, e.g. half the tile size for 50% overlap.
+        Every image is decoded once per epoch and its tiles and mask tiles
+        are streamed as individual elements. Defaults to ``None``.
+    tile_image_size : optional, ``(int, int)``
+        Size the images are resized to before tiling. Defaults to the
+        native size of each image.
+    tile_selection : optional, ``str``
+        "all" (default) keeps every tile. "foreground" keeps tiles with
+        enough texture to not be plain background. "defect_biased" keeps
+        all tiles with a ground truth defect and a quarter of the others.
+    dataset_weights : optional, ``dict``
+        Sampling weight per name in ``names``, e.g.
+        ``{"mvtec": 2, "visa": 1}``. Names that are missing get weight 1.
+        Elements of all datasets are interleaved before one shared batch.
+        Defaults to uniform weights.
+    category_weights : optional, ``str`` or ``dict``
+        Sampling weight per category, i.e. subdirectory, within each
+        dataset. "balanced" draws every category equally often, a dict
+        like ``{"bottle": 2}`` weights categories by name, missing
+        categories get weight 1. Defaults to ``None``, which visits every
+        file once per epoch.
+    split_by : optional, ``str``
+        How files are assigned to the training and validation split.
+        "seed" (default) shuffles the files with ``seed`` and holds out the
+        last ``validation_split``. "manifest" uses the stable split key of
+        each file stored in the dataset manifest, so the assignment does not
+        depend on the seed and does not move when files are added.
+        Files are listed from the manifest in both modes when it is current,
+        see ``tfds_defect_detection.manifest``.
+    mask_color_mode : optional, ``str``
+        "grayscale" (default) decodes ground truth masks with a single
+        channel and treats pixels >= 128 as defect, which fits the binary
+        masks written by the downloaders. "rgb" decodes three channels
+        and matches the colors of ``DatasetBuilder.color_dict``.
+    output_dtype : optional, ``str``
+        dtype of the images. "float32" (default), "float16" and
+        "bfloat16" images are in ``[0, 1]``. "uint8" images are in
+        ``[0, 255]`` and a quarter of the size to copy to the device;
+        normalize them on the device, e.g. with
+        ``tfds_defect_detection.layers.ImageNormalization``.
+    mask_format : optional, ``str``
+        "onehot" (default) masks have two channels (background,
+        foreground) in the float dtype of the images (float32 for uint8
+        images). "uint8" and "bool" masks have a single foreground
+        channel. Use ``tfds_defect_detection.layers.onehot_mask`` to
+        expand them on the device.
 
     ``tf.data.Dataset``
         the dataset requested, or if subset_mode is None,
         a dict<key: subset_mode, value: tf.data.Dataset>.
     """
+    start = time.perf_counter()
+    names = list(names)
+    if input_context is not None:
+        num_shards = input_context.num_input_pipelines
+        shard_index = input_context.input_pipeline_id
+    kwargs = locals().copy()
+    # Unset arguments fall back to the defaults of DatasetBuilder
+    kwargs = {key: value for key, value in kwargs.items() if value is not None}
+
+    import tensorflow as tf
     from tfds_defect_detection.downloader import download_and_prepare
     from tfds_defect_detection.data import DatasetBuilder
-
-    kwargs = locals().copy()
+    from tfds_defect_detection.utils import time_to_first_batch
 
     all_folders = download_and_prepare(
         cache_dir=data_dir,
         names=names,
         download=download,
         image_validation=image_validation,
-        delete_tmp=delete_tmp
+        delete_tmp=delete_tmp,
+        link_mode=link_mode,
+        ingest_size=(width, height) if resize_on_ingest else None,
+        image_store_size=(
+            (width, height)
+            if use_image_store and tile_stride is None
+            else None
+        ),
+        crop_to_aspect_ratio=crop_to_aspect_ratio,
     )
 
-    datasets = [
+    builders = [
         {
             "training": lambda: DatasetBuilder(
                 image_directory=train_folder,
                 subset="training",
                 **kwargs
-            ).ds,
+            ),
             "validation": lambda: DatasetBuilder(
                 image_directory=train_folder,
                 subset="validation",
                 **kwargs
-            ).ds,
+            ),
             "test": lambda: DatasetBuilder(
                 image_directory=test_image_folder,
                 mask_directory=test_mask_folder,
                 subset="training",
                 **kwargs
-            ).ds,
+            ),
             "holdout": lambda: DatasetBuilder(
                 image_directory=test_image_folder,
                 mask_directory=test_mask_folder,
                 subset="validation",
                 **kwargs
-            ).ds
+            )
         }[subset_mode]()
         for train_folder, test_image_folder, test_mask_folder in all_folders
     ]
 
-    return tf.data.Dataset.sample_from_datasets(datasets)
+    # Every source prefetches on its own, so the sources run
+    # concurrently and are mixed element by element
+    ds = tf.data.Dataset.sample_from_datasets(
+        [
+            builder.elements.prefetch(tf.data.AUTOTUNE)
+            for builder in builders
+        ],
+        weights=None if dataset_weights is None else [
+            float(dataset_weights.get(name, 1.0)) for name in names
+        ],
+        seed=seed
+    )
+    ds = ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    if report_time_to_first_batch and not lazy:
+        print(f"Time to first batch: {time_to_first_batch(ds, start):.2f}s")
+    return ds
 
 
 if __name__ == '__main__':
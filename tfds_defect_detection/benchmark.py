@@ -0,0 +1,511 @@
+"""
+Throughput benchmark of the input pipeline.
+
+``run_benchmark`` builds a ``DatasetBuilder`` for every combination of a
+grid of ``pairing_mode``, ``create_artificial_anomalies``, ``drop_masks``,
+mask presence, resolution, batch size and synthesis backend, pulls batches
+from it and records images per second, time to the first batch, p50 and
+p99 batch latency and peak RSS, of the interpreter and separately of its
+worker processes. Every configuration runs in a fresh interpreter, so
+peak RSS, TensorFlow state and the image cache of one configuration do
+not leak into the next. Further grid keys, e.g. ``image_cache_bytes`` or
+``output_dtype``, are passed to ``DatasetBuilder``.
+
+Results are written as JSON. ``compare_results`` matches two result files
+by configuration and reports throughput regressions, e.g. between releases
+or between synthesis backends.
+
+Command line usage
+
+.. code-block:: bash
+
+    python -m tfds_defect_detection.benchmark --data-dir anomaly_datasets \
+        --output benchmark.json --synthesis-backends generator parallel
+
+    python -m tfds_defect_detection.benchmark \
+        --compare benchmark_0.1.0.json benchmark.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+BENCHMARK_VERSION = 1
+
+DEFAULT_GRID = {
+    "pairing_mode": [
+        "result_only",
+        "result_with_original",
+        "result_with_contrastive_pair",
+    ],
+    "create_artificial_anomalies": [True, False],
+    "drop_masks": [False, True],
+    "with_masks": [False, True],
+    "resolution": [(256, 256), (512, 512)],
+    "batch_size": [8, 32],
+    "synthesis_backend": ["generator"],
+}
+
+
+def benchmark_configs(
+        grid: Optional[Dict[str, Iterable[Any]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    All combinations of ``grid``. Axes that are not given take their
+    values from ``DEFAULT_GRID``.
+    """
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    return [
+        dict(zip(grid, values))
+        for values in itertools.product(*grid.values())
+    ]
+
+
+def config_key(
+        config: Dict[str, Any],
+        ignore_keys: Iterable[str] = ()
+) -> str:
+    return json.dumps(
+        {key: list(value) if isinstance(value, tuple) else value
+         for key, value in config.items()
+         if key not in ignore_keys},
+        sort_keys=True
+    )
+
+
+# Keys of a configuration that are not ``DatasetBuilder`` fields
+_CONFIG_KEYS = ("resolution", "with_masks")
+
+
+def _peak_rss_bytes(children=False) -> Optional[int]:
+    """
+    Peak RSS of this process, or with ``children`` of its largest
+    terminated child process.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    ).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _descendants_peak_rss_bytes() -> Optional[int]:
+    """
+    Sum of the peak RSS of all live descendant processes, e.g. the
+    workers of the process backend, which are children of a fork server.
+    Read from ``/proc``, so ``None`` outside of Linux.
+    """
+    proc = Path("/proc")
+    if not (proc / "self" / "status").is_file():
+        return None
+
+    children = {}
+    for stat_file in proc.glob("[0-9]*/stat"):
+        try:
+            # The command name in parentheses may contain spaces
+            fields = stat_file.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(
+            int(stat_file.parent.name)
+        )
+
+    peak = 0
+    pending = list(children.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            status = (proc / str(pid) / "status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                peak += int(line.split()[1]) * 1024
+    return peak
+
+
+def measure_config(
+        config: Dict[str, Any],
+        dataset_dir: Path,
+        num_batches=50,
+        warmup_batches=5,
+        subset="training",
+        seed=123,
+) -> Dict[str, Any]:
+    """
+    Measures one configuration on the prepared dataset in ``dataset_dir``.
+
+    Configurations ``with_masks`` read ``test_images`` with their
+    ``test_masks``, the others read ``train_images``. The time to the
+    first batch includes building the pipeline. Latencies are measured on
+    ``num_batches`` batches after ``warmup_batches`` batches.
+
+    All keys of ``config`` but ``resolution`` and ``with_masks`` are
+    passed to ``DatasetBuilder``, unknown ones raise a ``ValueError``.
+    Worker processes are measured before the pipeline is torn down.
+    """
+    from tfds_defect_detection.data import DatasetBuilder
+
+    builder_kwargs = {
+        key: value
+        for key, value in config.items()
+        if key not in _CONFIG_KEYS
+    }
+    unknown = set(builder_kwargs) - set(DatasetBuilder.__fields__)
+    if unknown:
+        raise ValueError(
+            f"Unknown DatasetBuilder arguments {sorted(unknown)}"
+        )
+
+    width, height = config["resolution"]
+    start = time.perf_counter()
+    builder = DatasetBuilder(
+        image_directory=dataset_dir / (
+            "test_images" if config["with_masks"] else "train_images"
+        ),
+        mask_directory=(
+            dataset_dir / "test_masks" if config["with_masks"] else None
+        ),
+        width=width,
+        height=height,
+        subset=subset,
+        seed=seed,
+        repeat=True,
+        peek=False,
+        **builder_kwargs
+    )
+    batches = iter(builder.ds)
+    next(batches)
+    time_to_first_batch = time.perf_counter() - start
+
+    for _ in range(warmup_batches):
+        next(batches)
+
+    latencies = []
+    for _ in range(num_batches):
+        batch_start = time.perf_counter()
+        next(batches)
+        latencies.append(time.perf_counter() - batch_start)
+
+    children_peak_rss = _descendants_peak_rss_bytes()
+    # Joins the workers, so they count as terminated children
+    del batches
+    if children_peak_rss is None:
+        children_peak_rss = _peak_rss_bytes(children=True)
+
+    return {
+        "images_per_second": (
+            config["batch_size"] * num_batches / sum(latencies)
+        ),
+        "time_to_first_batch": time_to_first_batch,
+        "batch_latency_p50": float(np.percentile(latencies, 50)),
+        "batch_latency_p99": float(np.percentile(latencies, 99)),
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "peak_rss_children_bytes": children_peak_rss,
+    }
+
+
+def _measure_isolated(
+        config: Dict[str, Any],
+        dataset_dir: Path,
+        **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Runs ``measure_config`` in a fresh interpreter.
+    """
+    process = subprocess.run(
+        [
+            sys.executable, "-m", "tfds_defect_detection.benchmark",
+            "--measure", json.dumps({
+                "config": config,
+                "dataset_dir": str(dataset_dir),
+                **kwargs,
+            })
+        ],
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()
+        return {"error": error[-1] if error else "Benchmark process failed"}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _environment() -> Dict[str, Any]:
+    from importlib import metadata
+
+    from tfds_defect_detection import __version__
+
+    def version(package):
+        try:
+            return metadata.version(package)
+        except metadata.PackageNotFoundError:
+            return None
+
+    return {
+        "tfds_defect_detection": __version__,
+        "tensorflow": version("tensorflow"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def run_benchmark(
+        dataset_dir: Path,
+        output: Optional[Path] = None,
+        grid: Optional[Dict[str, Iterable[Any]]] = None,
+        num_batches=50,
+        warmup_batches=5,
+        subset="training",
+        seed=123,
+        isolate=True,
+) -> Dict[str, Any]:
+    """
+    Measures every configuration of ``benchmark_configs(grid)`` on the
+    prepared dataset in ``dataset_dir``, see ``measure_config``.
+
+    With ``isolate``, each configuration runs in its own interpreter,
+    otherwise peak RSS is the peak of all configurations so far.
+    Configurations that fail, e.g. contrastive pairs of a category with a
+    single file, are recorded with their error.
+
+    Returns the results and writes them to ``output`` as JSON.
+    """
+    settings = {
+        "dataset_dir": str(dataset_dir),
+        "num_batches": num_batches,
+        "warmup_batches": warmup_batches,
+        "subset": subset,
+        "seed": seed,
+        "isolate": isolate,
+    }
+    results = []
+    for config in tqdm(benchmark_configs(grid), desc="Benchmarking"):
+        kwargs = {
+            "num_batches": num_batches,
+            "warmup_batches": warmup_batches,
+            "subset": subset,
+            "seed": seed,
+        }
+        if isolate:
+            metrics = _measure_isolated(config, dataset_dir, **kwargs)
+        else:
+            try:
+                metrics = measure_config(config, dataset_dir, **kwargs)
+            except Exception as e:
+                metrics = {"error": f"{type(e).__name__}: {e}"}
+        results.append({"config": config, **metrics})
+
+    report = {
+        "version": BENCHMARK_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": _environment(),
+        "settings": settings,
+        "results": results,
+    }
+    if output is not None:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare_results(
+        baseline: Dict[str, Any],
+        current: Dict[str, Any],
+        tolerance=0.05,
+        ignore_keys: Iterable[str] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Matches the results of two ``run_benchmark`` reports by configuration,
+    without the ``ignore_keys`` of the configuration. A configuration
+    regressed if its images per second dropped by more than
+    ``tolerance``, relative to ``baseline``.
+    """
+    baseline_results = {
+        config_key(result["config"], ignore_keys): result
+        for result in baseline["results"]
+    }
+    comparison = []
+    for result in current["results"]:
+        before = baseline_results.get(
+            config_key(result["config"], ignore_keys)
+        )
+        if before is None or "error" in before or "error" in result:
+            continue
+        change = (
+            result["images_per_second"] / before["images_per_second"] - 1
+        )
+        comparison.append({
+            "config": result["config"],
+            "images_per_second": (
+                before["images_per_second"],
+                result["images_per_second"]
+            ),
+            "batch_latency_p99": (
+                before["batch_latency_p99"],
+                result["batch_latency_p99"]
+            ),
+            "change": change,
+            "regression": change < -tolerance,
+        })
+    return comparison
+
+
+def compare_backends(
+        report: Dict[str, Any],
+        baseline_backend="generator",
+) -> List[Dict[str, Any]]:
+    """
+    Compares every other synthesis backend of one ``run_benchmark`` report
+    with ``baseline_backend`` on otherwise equal configurations.
+    """
+    def results(keep):
+        return {"results": [
+            result for result in report["results"]
+            if keep(result["config"]["synthesis_backend"])
+        ]}
+
+    return compare_results(
+        results(lambda backend: backend == baseline_backend),
+        results(lambda backend: backend != baseline_backend),
+        ignore_keys=("synthesis_backend",)
+    )
+
+
+def _print_comparison(comparison: List[Dict[str, Any]]):
+    for entry in comparison:
+        before, after = entry["images_per_second"]
+        print(
+            f"{'REGRESSION' if entry['regression'] else 'ok':>10} "
+            f"{entry['change']:+7.1%} "
+            f"{before:8.1f} -> {after:8.1f} img/s  "
+            f"{_format_config(entry['config'])}"
+        )
+
+
+def _format_config(config: Dict[str, Any]) -> str:
+    return ", ".join(
+        f"{key}={'x'.join(map(str, value)) if key == 'resolution' else value}"
+        for key, value in config.items()
+    )
+
+
+def main():
+    from tfds_defect_detection.downloader import download_and_prepare
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput of DatasetBuilder "
+                    "configurations."
+    )
+    parser.add_argument("--name", default="mvtec", choices=["mvtec", "visa"])
+    parser.add_argument("--data-dir", type=Path,
+                        default=Path("anomaly_datasets"))
+    parser.add_argument("--output", type=Path,
+                        default=Path("benchmark.json"))
+    parser.add_argument("--pairing-modes", nargs="+",
+                        default=DEFAULT_GRID["pairing_mode"])
+    parser.add_argument("--resolutions", nargs="+", default=["256x256",
+                                                             "512x512"],
+                        help="Resolutions as <width>x<height>")
+    parser.add_argument("--batch-sizes", nargs="+", type=int,
+                        default=DEFAULT_GRID["batch_size"])
+    parser.add_argument("--synthesis-backends", nargs="+",
+                        default=DEFAULT_GRID["synthesis_backend"],
+                        choices=["generator", "parallel", "process",
+                                 "graph", "vectorized"])
+    parser.add_argument("--num-batches", type=int, default=50)
+    parser.add_argument("--warmup-batches", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run all configurations in this process")
+    parser.add_argument("--compare", nargs=2, type=Path,
+                        metavar=("BASELINE", "CURRENT"),
+                        help="Compare two result files instead of running")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        # Child process of an isolated run, prints the metrics as JSON
+        task = json.loads(args.measure)
+        task["config"]["resolution"] = tuple(task["config"]["resolution"])
+        print(json.dumps(measure_config(
+            task.pop("config"),
+            Path(task.pop("dataset_dir")),
+            **task
+        )))
+        return
+
+    if args.compare is not None:
+        baseline_file, current_file = args.compare
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        with open(current_file) as f:
+            current = json.load(f)
+        comparison = compare_results(baseline, current, args.tolerance)
+        _print_comparison(comparison)
+        if any(entry["regression"] for entry in comparison):
+            sys.exit(1)
+        return
+
+    train_folder, _, _ = next(iter(download_and_prepare(
+        cache_dir=args.data_dir,
+        names=[args.name],
+    )))
+    report = run_benchmark(
+        dataset_dir=train_folder.parent,
+        output=args.output,
+        grid={
+            "pairing_mode": args.pairing_modes,
+            "resolution": [
+                tuple(int(size) for size in resolution.split("x"))
+                for resolution in args.resolutions
+            ],
+            "batch_size": args.batch_sizes,
+            "synthesis_backend": args.synthesis_backends,
+        },
+        num_batches=args.num_batches,
+        warmup_batches=args.warmup_batches,
+        seed=args.seed,
+        isolate=not args.no_isolate,
+    )
+    for result in report["results"]:
+        if "error" in result:
+            summary = f"error: {result['error']}"
+        else:
+            summary = (
+                f"{result['images_per_second']:8.1f} img/s, "
+                f"first batch {result['time_to_first_batch']:.2f}s, "
+                f"p50 {result['batch_latency_p50'] * 1000:.1f}ms, "
+                f"p99 {result['batch_latency_p99'] * 1000:.1f}ms"
+            )
+        print(f"{summary}  {_format_config(result['config'])}")
+
+    if len(args.synthesis_backends) > 1:
+        print("Synthesis backends compared with", args.synthesis_backends[0])
+        _print_comparison(
+            compare_backends(report, args.synthesis_backends[0])
+        )
+    print("Results written to", args.output)
+
+
+if __name__ == '__main__':
+    main()
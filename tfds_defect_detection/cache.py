@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Hashable
+
+import numpy as np
+
+_IMAGE_CACHE = None
+_IMAGE_CACHE_LOCK = threading.Lock()
+
+
+class DecodedImageCache:
+    """
+    Thread-safe LRU cache of decoded and resized uint8 images.
+
+    Images are evicted least recently used as soon as the cache holds
+    more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=2 * 2 ** 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+            return image
+
+    def put(self, key: Hashable, image: np.ndarray):
+        if image.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._images:
+                self.nbytes -= self._images[key].nbytes
+            self._images[key] = image
+            self._images.move_to_end(key)
+            self.nbytes += image.nbytes
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._images:
+            _, image = self._images.popitem(last=False)
+            self.nbytes -= image.nbytes
+
+
+def get_image_cache(max_bytes: Optional[int] = None) -> DecodedImageCache:
+    """
+    The process-wide image cache shared by all ``DatasetBuilder`` instances.
+    Creates it on first use. If ``max_bytes`` is given, the budget is set
+    to the largest budget requested so far.
+    """
+    global _IMAGE_CACHE
+    with _IMAGE_CACHE_LOCK:
+        if _IMAGE_CACHE is None:
+            _IMAGE_CACHE = DecodedImageCache(
+                **({} if max_bytes is None else {"max_bytes": max_bytes})
+            )
+        elif max_bytes is not None and max_bytes > _IMAGE_CACHE.max_bytes:
+            _IMAGE_CACHE.resize(max_bytes)
+        return _IMAGE_CACHE
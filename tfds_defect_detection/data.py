@@ -1,18 +1,20 @@
+from collections import deque
 from pathlib import Path
-from typing import Optional, Any
+from typing import Optional, Any, Union, Dict, Tuple
 
 import numpy as np
 import tensorflow as tf
-
-import albumentations as A
-from keras.utils import image_dataset_from_directory
-from polygenerator import random_polygon
-import matplotlib.pyplot as plt
-from skimage.draw import polygon2mask
 from typing_extensions import Literal
 
-from tfds_defect_detection.utils import random_slice, blend_merge, masking, \
-    combine_binary_masks, _HiddenPrints
+from tfds_defect_detection import graph_synthesis
+from tfds_defect_detection.cache import get_image_cache
+from tfds_defect_detection.manifest import Manifest
+from tfds_defect_detection.store import ImageStore
+from tfds_defect_detection.synthesis import AnomalySynthesizer, \
+    ProcessPoolSynthesizer, PolygonMaskBank
+from tfds_defect_detection.utils import masking, binary_mask, \
+    combine_binary_masks, index_directory, training_or_validation_split, \
+    load_image, decode_image, pair_mask_paths
 
 from pydantic import BaseModel
 
@@ -47,48 +49,173 @@ class DatasetBuilder(BaseModel):
     height = 256
     repeat = True
     anomaly_size: Optional[int] = None
-    process_deviation = A.Compose([])
-    global_transform = A.Compose([])
-    anomaly_composition = A.Compose([])
+    # albumentations transforms, None skips the step
+    process_deviation: Optional[Any] = None
+    global_transform: Optional[Any] = None
+    anomaly_composition: Optional[Any] = None
     batch_size = 8
     seed = 123
     crop_to_aspect_ratio = False
+    polygon_mask_bank: Optional[PolygonMaskBank] = None
+    initial_epoch = 0
+    image_cache_bytes: Optional[int] = None
+    use_image_store = False
+    use_manifest = True
+    lazy = False
+    num_shards = 1
+    shard_index = 0
+    # Tiling: ``width`` x ``height`` tiles every ``tile_stride`` pixels of
+    # images decoded at ``tile_image_size`` or their native size.
+    # The image cache and store are bypassed.
+    tile_stride: Optional[int] = None
+    tile_image_size: Optional[Tuple[int, int]] = None
+    tile_selection: Literal[
+        "all",
+        "foreground",
+        "defect_biased",
+    ] = "all"
+    tile_foreground_std = 8.0
+    tile_background_rate = 0.25
+    tile_cycle_length = 8
+    category_weights: Union[
+        None,
+        Literal["balanced"],
+        Dict[str, float],
+    ] = None
+    split_by: Literal[
+        "seed",
+        "manifest",
+    ] = "seed"
+    mask_color_mode: Literal[
+        "grayscale",
+        "rgb",
+    ] = "grayscale"
+    output_dtype: Literal[
+        "float32",
+        "float16",
+        "bfloat16",
+        "uint8",
+    ] = "float32"
+    mask_format: Literal[
+        "onehot",
+        "uint8",
+        "bool",
+    ] = "onehot"
+    synthesis_backend: Literal[
+        "generator",
+        "parallel",
+        "process",
+        "graph",
+        "vectorized",
+    ] = "generator"
+    num_parallel_calls: int = tf.data.AUTOTUNE
+    num_workers: Optional[int] = None
+    buffer_depth = 16
+    start_method: Optional[Literal[
+        "fork",
+        "spawn",
+        "forkserver",
+    ]] = None
 
     _num_classes = None
     _class_names = None
     _num_files = None
     _ds = None
     _raw_ds = None
-    _mask_ds = None
-    _rand_images_by_label = None
+    _file_paths = None
+    _mask_paths = None
+    _labels = None
+    _tables = None
+    _listing = None
+    _image_store = None
+    _store_rows = None
+    _synthesizer = None
+    _manifest = None
 
     def __init__(self, **data: Any):
         super().__init__(**data)
 
+        if (
+                self.tile_stride is not None
+                and self.pairing_mode == "result_with_contrastive_pair"
+        ):
+            raise ValueError(
+                "Contrastive pairs are not supported with tiling"
+            )
+        if not 0 <= self.shard_index < self.num_shards:
+            raise ValueError(
+                f"shard_index {self.shard_index} is out of range for "
+                f"{self.num_shards} shards"
+            )
+
+        self._synthesizer = AnomalySynthesizer(
+            width=self.width,
+            create_artificial_anomalies=self.create_artificial_anomalies,
+            anomaly_size=self.anomaly_size,
+            global_transform=self.global_transform,
+            process_deviation=self.process_deviation,
+            anomaly_composition=self.anomaly_composition,
+            polygon_mask_bank=self.polygon_mask_bank,
+        )
+
+        if self.lazy:
+            return
+
         self._create_image_dataset()
         if self.peek:
             self.peek_dataset()
 
     @property
     def ds(self):
+        if self._ds is None and self.lazy:
+            self._ds = self._build_dataset()
         return self._ds
 
+    @property
+    def elements(self):
+        """
+        The unbatched elements of ``ds``, to interleave several builders
+        before one shared batch.
+        """
+        if self._raw_ds is None:
+            self._init_partial_datasets()
+        return self._synth_and_combine_datasets(batch=False)
+
     @property
     def num_classes(self):
+        if self._num_classes is None:
+            self._init_properties()
         return self._num_classes
 
     @property
     def num_files(self):
+        if self._num_files is None:
+            self._init_properties()
         return self._num_files
 
-    def _create_image_dataset(self):
-        self._init_properties()
+    def _build_dataset(self):
         self._init_partial_datasets()
-        self._ds = self._synth_and_combine_datasets()
+        return self._synth_and_combine_datasets()
+
+    def _create_image_dataset(self):
+        self._ds = self._build_dataset()
 
         return self.ds
 
     def _init_properties(self):
+        if self.use_manifest:
+            manifest = Manifest.load(self.image_directory.parent)
+            if manifest is not None and manifest.covers(self.image_directory):
+                self._manifest = manifest
+
+        if self._manifest is not None:
+            self._num_files = self._manifest.num_files(self.image_directory)
+            self._class_names = self._manifest.class_names(
+                self.image_directory
+            )
+            self._num_classes = len(self._class_names)
+            return
+
         self._num_files = len([
             ""
             for subdir in self.image_directory.rglob("*.*")
@@ -101,67 +228,580 @@ class DatasetBuilder(BaseModel):
         ])
         self._num_classes = len(self._class_names)
 
-    def _init_partial_datasets(self):
-        with _HiddenPrints():
-            self._raw_ds: tf.data.Dataset = image_dataset_from_directory(
-                directory=self.image_directory,
-                validation_split=self.validation_split,
-                subset=self.subset,
+    def _index_files(self, directory: Path):
+        if self._manifest is not None and self._manifest.covers(directory):
+            file_paths, labels, split_keys, _ = self._manifest.index_directory(
+                directory,
+                seed=self.seed,
+                shuffle=self.shuffle
+            )
+        elif self.split_by == "manifest":
+            raise ValueError(
+                f"split_by='manifest' requires a current manifest in "
+                f"{directory.parent}, see "
+                f"tfds_defect_detection.manifest.write_manifest"
+            )
+        else:
+            file_paths, labels, _ = index_directory(
+                directory,
                 seed=self.seed,
+                shuffle=self.shuffle
+            )
+
+        if self.split_by == "manifest":
+            subset = {
+                "training": split_keys >= self.validation_split,
+                "validation": split_keys < self.validation_split,
+            }.get(self.subset, np.ones(len(split_keys), dtype=bool))
+            return file_paths[subset], labels[subset]
+
+        return (
+            training_or_validation_split(
+                file_paths, self.validation_split, self.subset),
+            training_or_validation_split(
+                labels, self.validation_split, self.subset),
+        )
+
+    def _element_seed(self, epoch, index, offset=0):
+        return tf.stack([
+            tf.constant(self.seed + offset, tf.int64),
+            epoch,
+            index
+        ])
+
+    def _file_dataset(self, file_paths) -> tf.data.Dataset:
+        """
+        Dataset of ``(file_index, element_seed)`` into ``file_paths``.
+
+        Every epoch visits the files in the order of a stateless random
+        permutation of ``(seed, epoch)``. Each element carries its
+        ``(seed, epoch, index)``, all randomness of the synthesis is
+        derived from it.
+
+        With ``category_weights`` an epoch is ``num_files`` draws of a
+        category by its weight and a file of that category.
+
+        Every shard keeps each ``num_shards``-th element of the global
+        order, so nothing outside the shard is decoded or synthesized and
+        the elements keep their global seeds.
+
+        In ``lazy`` mode the files are listed when the first element is
+        drawn, see ``_fill_tables``.
+        """
+        def epoch_files(epoch):
+            num_files = tf.size(file_paths, out_type=tf.int64)
+            if self.category_weights is not None:
+                return tf.data.Dataset.range(num_files).shard(
+                    self.num_shards,
+                    self.shard_index
+                ).map(
+                    lambda index: (
+                        self._sample_file(self._element_seed(epoch, index)),
+                        self._element_seed(epoch, index)
+                    )
+                )
+            if self.shuffle:
+                order = tf.argsort(tf.random.stateless_uniform(
+                    [num_files],
+                    seed=tf.stack([tf.constant(self.seed, tf.int64), epoch])
+                ))
+                files = tf.data.Dataset.from_tensor_slices(
+                    tf.cast(order, tf.int64)
+                )
+            else:
+                files = tf.data.Dataset.range(num_files)
+            return files.enumerate().shard(
+                self.num_shards,
+                self.shard_index
+            ).map(
+                lambda index, file_index: (
+                    file_index,
+                    self._element_seed(epoch, index)
+                )
+            )
+
+        files = tf.data.Dataset.range(
+            self.initial_epoch,
+            np.iinfo(np.int64).max if self.repeat else self.initial_epoch + 1
+        ).flat_map(epoch_files)
+        if not self.lazy:
+            return files
+        return tf.data.Dataset.range(1).map(
+            self._fill_tables
+        ).flat_map(lambda _: files)
+
+    def _cached(self, path, load, num_channels=3):
+        """
+        Reads ``load(path)`` through the process-wide image cache,
+        keyed by ``(path, width, height, crop_to_aspect_ratio)``.
+        """
+        if self.image_cache_bytes is None:
+            return load(path)
+
+        cache = get_image_cache(self.image_cache_bytes)
+
+        def cached_load(path_tensor):
+            key = (
+                path_tensor.numpy().decode(),
+                self.width,
+                self.height,
+                self.crop_to_aspect_ratio,
+                num_channels
+            )
+            image = cache.get(key)
+            if image is None:
+                image = tf.cast(
+                    tf.clip_by_value(tf.round(load(path_tensor)), 0, 255),
+                    tf.uint8
+                ).numpy()
+                cache.put(key, image)
+            return image
+
+        image = tf.py_function(cached_load, [path], tf.uint8)
+        image.set_shape([self.width, self.height, num_channels])
+        return tf.cast(image, tf.float32)
+
+    def _init_image_store(self):
+        store = ImageStore.open(
+            self.image_directory.parent,
+            self.width,
+            self.height,
+            self.crop_to_aspect_ratio
+        )
+        if store is None:
+            raise FileNotFoundError(
+                f"No current {self.width}x{self.height} image store in "
+                f"{self.image_directory.parent}. Create it with "
+                f"tfds_defect_detection.store.prepare_image_store"
+            )
+        rows_by_path = store.rows_by_path()
+        self._image_store = store
+        self._store_rows = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(
+                tf.constant(list(rows_by_path.keys()), tf.string),
+                tf.constant(list(rows_by_path.values()), tf.int64)
+            ),
+            default_value=-1
+        )
+
+    def _read_store(self, path):
+        """
+        Slices the image of ``path`` from the memory-mapped store,
+        without any decoding.
+        """
+        row = self._store_rows.lookup(path)
+        tf.debugging.assert_non_negative(
+            row,
+            message="Image is missing in the image store"
+        )
+        image = tf.numpy_function(
+            lambda r: self._image_store[r],
+            [row],
+            tf.uint8
+        )
+        image.set_shape([self.width, self.height, 3])
+        return tf.cast(image, tf.float32)
+
+    def _load_image(self, path):
+        if self._image_store is not None:
+            return self._read_store(path)
+        return self._cached(path, lambda p: load_image(
+            p,
+            image_size=(self.width, self.height),
+            crop_to_aspect_ratio=self.crop_to_aspect_ratio
+        ))
+
+    def _load_mask(self, path):
+        """
+        Returns the one-hot mask of ``path``. Grayscale masks are decoded
+        with a single channel and thresholded once, rgb masks are matched
+        against ``color_dict``.
+        """
+        num_channels = 1 if self.mask_color_mode == "grayscale" else 3
+        if self._image_store is not None:
+            mask = self._read_store(path)[..., :num_channels]
+        else:
+            mask = self._cached(path, lambda p: load_image(
+                p,
                 image_size=(self.width, self.height),
-                batch_size=1,
-                color_mode='rgb',
-                shuffle=self.shuffle,
+                num_channels=num_channels,
+                interpolation="nearest",
                 crop_to_aspect_ratio=self.crop_to_aspect_ratio
-            ).unbatch()
+            ), num_channels=num_channels)
+
+        return self._onehot_mask(mask)
 
-        if self.repeat:
-            self._raw_ds = self._raw_ds.repeat()
+    @staticmethod
+    def _empty_mask(shape):
+        """
+        One-hot mask of a file without a defect, created in the graph
+        instead of decoding a blank file.
+        """
+        return tf.stack([tf.ones(shape), tf.zeros(shape)], axis=-1)
+
+    def _onehot_mask(self, mask):
+        if self.mask_color_mode == "grayscale":
+            return binary_mask(mask)
+        return masking(
+            mask / 255,
+            [self.color_dict[i] for i in range(2)]
+        )
+
+    def _decode_for_tiling(
+            self,
+            path,
+            num_channels=3,
+            interpolation="bilinear"
+    ):
+        if self.tile_image_size is None:
+            return decode_image(path, num_channels)
+        return load_image(
+            path,
+            image_size=self.tile_image_size,
+            num_channels=num_channels,
+            interpolation=interpolation,
+            crop_to_aspect_ratio=self.crop_to_aspect_ratio
+        )
+
+    def _extract_tiles(self, image):
+        """
+        ``[num_tiles, width, height, channels]`` tiles of ``image``,
+        every ``tile_stride`` pixels. Incomplete tiles at the border
+        are dropped.
+        """
+        channels = image.shape[-1]
+        tiles = tf.image.extract_patches(
+            image[tf.newaxis],
+            sizes=[1, self.width, self.height, 1],
+            strides=[1, self.tile_stride, self.tile_stride, 1],
+            rates=[1, 1, 1, 1],
+            padding="VALID"
+        )
+        return tf.reshape(tiles, [-1, self.width, self.height, channels])
+
+    def _select_tiles(self, tiles, mask_tiles, element_seed):
+        """
+        Boolean vector of the tiles to keep.
+
+        "foreground" keeps tiles whose grayscale standard deviation is at
+        least ``tile_foreground_std``. "defect_biased" keeps every tile
+        with a defect and other tiles with probability
+        ``tile_background_rate``, seeded by the element with ``seed + 3``.
+        It keeps all tiles of images without masks.
+        """
+        num_tiles = tf.shape(tiles)[0]
+        if self.tile_selection == "foreground":
+            std = tf.math.reduce_std(
+                tf.reduce_mean(tiles, axis=-1),
+                axis=[1, 2]
+            )
+            return std >= self.tile_foreground_std
+        if self.tile_selection == "defect_biased" and mask_tiles is not None:
+            defect = tf.reduce_max(mask_tiles[..., 1], axis=[1, 2]) > 0
+            keep_seed = graph_synthesis.stateless_seed(
+                element_seed + tf.constant([3, 0, 0], tf.int64)
+            )
+            return defect | (
+                tf.random.stateless_uniform([num_tiles], keep_seed)
+                < self.tile_background_rate
+            )
+        return tf.ones([num_tiles], tf.bool)
+
+    def _tiled_dataset(self, file_paths, labels, mask_paths=None):
+        """
+        Raw dataset of tiles. Every image and mask is decoded once per
+        epoch, at ``tile_image_size`` or at its native size, and cut into
+        ``width`` x ``height`` tiles. The tiles of ``tile_cycle_length``
+        images are interleaved.
+
+        Tile ``t`` of element ``(seed, epoch, index)`` is seeded with
+        ``(seed, epoch, tile_index)``, ``tile_index`` is drawn from the
+        ``t``-th ``stateless_split`` of the element seed, so no two tiles
+        of an epoch share a seed, whatever the number of tiles.
+        """
+        def tile(file_index, element_seed):
+            tiles = self._extract_tiles(self._decode_for_tiling(
+                tf.gather(file_paths, file_index)
+            ))
+            mask_tiles = None
+            if mask_paths is not None:
+                num_channels = 1 if self.mask_color_mode == "grayscale" else 3
+                mask_path = tf.gather(mask_paths, file_index)
+                mask_tiles = tf.cond(
+                    tf.strings.length(mask_path) > 0,
+                    lambda: self._onehot_mask(self._extract_tiles(
+                        self._decode_for_tiling(
+                            mask_path,
+                            num_channels=num_channels,
+                            interpolation="nearest"
+                        )
+                    )),
+                    lambda: self._empty_mask(tf.shape(tiles)[:-1])
+                )
+
+            positions = tf.where(
+                self._select_tiles(tiles, mask_tiles, element_seed)
+            )[:, 0]
+            num_kept = tf.shape(positions, out_type=tf.int64)[0]
+            tile_seeds = tf.random.experimental.stateless_split(
+                graph_synthesis.stateless_seed(element_seed),
+                num=tf.shape(tiles)[0]
+            )
+            seeds = tf.stack([
+                tf.fill([num_kept], element_seed[0]),
+                tf.fill([num_kept], element_seed[1]),
+                # Non-negative, like the index of an untiled element
+                tf.bitwise.bitwise_and(
+                    tf.gather(tile_seeds[:, 0], positions),
+                    tf.constant(2 ** 63 - 1, tf.int64)
+                )
+            ], axis=-1)
+            elements = (
+                tf.gather(tiles, positions),
+                tf.fill([num_kept], tf.gather(labels, file_index)),
+                seeds
+            )
+            if mask_tiles is None:
+                return elements
+            return (*elements, tf.gather(mask_tiles, positions))
+
+        return self._file_dataset(file_paths).map(
+            tile,
+            num_parallel_calls=self.num_parallel_calls
+        ).interleave(
+            lambda *tiles: tf.data.Dataset.from_tensor_slices(tiles),
+            cycle_length=self.tile_cycle_length,
+            block_length=1
+        )
+
+    def _init_partial_datasets(self):
+        # Tiles are cut from images at their own size, not from the store
+        if self.use_image_store and self.tile_stride is None:
+            self._init_image_store()
 
+        self._init_tables()
+        file_paths = self._tables["file_paths"]
+        labels = self._tables["labels"]
+        mask_paths = self._tables.get("mask_paths")
+
+        def load(file_index, element_seed):
+            element = (
+                self._load_image(tf.gather(file_paths, file_index)),
+                tf.gather(labels, file_index),
+                element_seed
+            )
+            if mask_paths is None:
+                return element
+            mask_path = tf.gather(mask_paths, file_index)
+            return (*element, tf.cond(
+                tf.strings.length(mask_path) > 0,
+                lambda: self._load_mask(mask_path),
+                lambda: self._empty_mask([self.width, self.height])
+            ))
+
+        if self.tile_stride is not None:
+            self._raw_ds = self._tiled_dataset(file_paths, labels, mask_paths)
+            return
+
+        # Images and their masks are decoded in the same parallel map
+        self._raw_ds = self._file_dataset(file_paths).map(
+            load,
+            num_parallel_calls=self.num_parallel_calls
+        )
+
+    def _pair_masks(self) -> np.ndarray:
+        """
+        Mask path of every file, ``""`` for files without a defect.
+        Taken from the manifest if it covers both directories.
+        """
+        existing = None
+        if (
+                self._manifest is not None
+                and self._manifest.covers(self.mask_directory)
+        ):
+            if self._manifest.covers(self.image_directory):
+                mask_paths = self._manifest.mask_paths(
+                    self._file_paths,
+                    self.image_directory,
+                    self.mask_directory
+                )
+                if mask_paths is not None:
+                    return mask_paths
+            existing, _, _, _ = self._manifest.index_directory(
+                self.mask_directory,
+                shuffle=False
+            )
+        return pair_mask_paths(
+            self._file_paths,
+            self.image_directory,
+            self.mask_directory,
+            existing=existing
+        )
+
+    def _pair_index(self) -> Dict[str, np.ndarray]:
+        """
+        Label to file index table for contrastive pairs. Files are sorted
+        by label, so the candidates of a label are the ``counts[label]``
+        files starting at ``offsets[label]``.
+        """
+        order = np.argsort(self._labels, kind="stable")
+        counts = np.bincount(self._labels, minlength=self._num_classes)
+        return {
+            "label_order": order,
+            "pair_paths": self._file_paths[order],
+            "pair_counts": counts,
+            "pair_offsets": np.cumsum(counts) - counts,
+        }
+
+    def _category_logits(self) -> np.ndarray:
+        counts = np.bincount(self._labels, minlength=self._num_classes)
+        if self.category_weights == "balanced":
+            weights = np.ones(self._num_classes)
+        else:
+            weights = np.asarray([
+                self.category_weights.get(name, 1.0)
+                for name in self._class_names
+            ], dtype=np.float64)
+        weights = np.where(counts > 0, weights, 0)
+        if not weights.sum() > 0:
+            raise ValueError(
+                f"category_weights {self.category_weights} select none of "
+                f"the categories {self._class_names} with files"
+            )
+        with np.errstate(divide="ignore"):
+            return np.log(weights / weights.sum())
+
+    def _table_dtypes(self) -> Dict[str, tf.DType]:
+        dtypes = {"file_paths": tf.string, "labels": tf.int64}
         if self.mask_directory is not None:
-            with _HiddenPrints():
-                self._mask_ds = image_dataset_from_directory(
-                    directory=self.mask_directory,
-                    validation_split=self.validation_split,
-                    subset=self.subset,
-                    seed=self.seed,
-                    shuffle=self.shuffle,
-                    image_size=(self.width, self.height),
-                    batch_size=1,
-                    color_mode='rgb',
-                    interpolation="nearest",
-                    crop_to_aspect_ratio=self.crop_to_aspect_ratio
-                ).unbatch()
-
-            if self.repeat:
-                self._mask_ds = self._mask_ds.repeat()
-            self._mask_ds = (
-                self._mask_ds
-                .map(lambda x, y: x / 255)
-                .map(lambda x: masking(
-                    x,
-                    [self.color_dict[i] for i in range(2)]
-                ))
+            dtypes["mask_paths"] = tf.string
+        dtypes.update(
+            label_order=tf.int64,
+            pair_paths=tf.string,
+            pair_counts=tf.int64,
+            pair_offsets=tf.int64,
+        )
+        if self.category_weights is not None:
+            dtypes["category_logits"] = tf.float32
+        return dtypes
+
+    def _index_tables(self) -> Dict[str, np.ndarray]:
+        """
+        Lists the files and derives the tables of ``_table_dtypes``.
+        """
+        self._init_properties()
+        self._file_paths, self._labels = self._index_files(
+            self.image_directory
+        )
+        tables = {"file_paths": self._file_paths, "labels": self._labels}
+        if self.mask_directory is not None:
+            self._mask_paths = self._pair_masks()
+            tables["mask_paths"] = self._mask_paths
+        tables.update(self._pair_index())
+        if self.category_weights is not None:
+            tables["category_logits"] = self._category_logits()
+        return tables
+
+    def _init_tables(self):
+        """
+        The pipeline looks files up in ``_tables``. They are constants of
+        the listing, or in ``lazy`` mode empty variables that are filled
+        on the first iteration, so the graph is built without listing.
+        """
+        dtypes = self._table_dtypes()
+        if not self.lazy:
+            self._tables = {
+                name: tf.constant(table, dtypes[name])
+                for name, table in self._index_tables().items()
+            }
+            return
+
+        self._tables = {
+            name: tf.Variable(
+                tf.zeros([0], dtype),
+                shape=tf.TensorShape(None),
+                trainable=False
             )
-        with _HiddenPrints():
-            contrastive_ds: tf.data.Dataset = image_dataset_from_directory(
-                directory=self.image_directory,
-                validation_split=self.validation_split,
-                subset=self.subset,
-                shuffle=True,
-                color_mode='rgb',
-                seed=self.seed + 1,
-                image_size=(self.width, self.height),
-                batch_size=1,
-                crop_to_aspect_ratio=self.crop_to_aspect_ratio,
-            ).unbatch()
-        self._rand_images_by_label = {}
-        for label in range(self._num_classes):
-            filtered_ds = contrastive_ds.filter(lambda x, y: tf.equal(y, label))
-            filtered_ds = filtered_ds.repeat()
-            self._rand_images_by_label[label] = iter(filtered_ds)
+            for name, dtype in dtypes.items()
+        }
+
+    def _fill_tables(self, element):
+        """
+        Lists the files once and assigns the tables of this ``lazy``
+        builder, ``element`` passes once they are assigned.
+        """
+        names = list(self._tables)
+        dtypes = [self._tables[name].dtype for name in names]
+
+        def listing():
+            if self._listing is None:
+                tables = self._index_tables()
+                self._listing = [
+                    np.char.encode(tables[name], "utf-8")
+                    if dtype == tf.string
+                    else tables[name].astype(dtype.as_numpy_dtype)
+                    for name, dtype in zip(names, dtypes)
+                ]
+            return self._listing
+
+        values = tf.numpy_function(listing, [], dtypes, stateful=True)
+        with tf.control_dependencies([
+            self._tables[name].assign(value)
+            for name, value in zip(names, values)
+        ]):
+            return tf.identity(element)
+
+    def _sample_file(self, element_seed):
+        """
+        Draws a category by ``category_weights`` and a file of that
+        category uniformly, seeded by the element with ``seed + 2``.
+        """
+        category_seed, file_seed = tf.unstack(
+            tf.random.experimental.stateless_split(
+                graph_synthesis.stateless_seed(
+                    element_seed + tf.constant([2, 0, 0], tf.int64)
+                ),
+                num=2
+            )
+        )
+        label = tf.random.stateless_categorical(
+            self._tables["category_logits"][tf.newaxis],
+            1,
+            category_seed,
+            dtype=tf.int64
+        )[0, 0]
+        count = tf.gather(self._tables["pair_counts"], label)
+        offset = tf.gather(self._tables["pair_offsets"], label)
+        choice = tf.cast(
+            tf.random.stateless_uniform([], file_seed)
+            * tf.cast(count, tf.float32),
+            tf.int64
+        )
+        choice = tf.minimum(choice, count - 1)
+        return tf.gather(self._tables["label_order"], offset + choice)
+
+    def _pair_path(self, label, element_seed):
+        """
+        Draws a random file of the same class in O(1), seeded by the
+        element like the original contrastive pipeline with ``seed + 1``.
+        """
+        pair_seed = graph_synthesis.stateless_seed(
+            element_seed + tf.constant([1, 0, 0], tf.int64)
+        )
+        label = tf.cast(label, tf.int64)
+        count = tf.gather(self._tables["pair_counts"], label)
+        offset = tf.gather(self._tables["pair_offsets"], label)
+        choice = tf.cast(
+            tf.random.stateless_uniform([], pair_seed)
+            * tf.cast(count, tf.float32),
+            tf.int64
+        )
+        choice = tf.minimum(choice, count - 1)
+        return tf.gather(self._tables["pair_paths"], offset + choice)
 
     def peek_dataset(self):
+        import matplotlib.pyplot as plt
+
         print(f"Dataset shape: {self.ds}")
         num_images = int(
                 self.num_files * self.validation_split
@@ -184,6 +824,16 @@ class DatasetBuilder(BaseModel):
         if self.pairing_mode != "result_only" and self.drop_masks:
             original_batch, image_batch = batches
 
+        def as_uint8(batch):
+            if batch is None or batch.dtype == np.uint8:
+                return batch
+            return (batch.astype(np.float32) * 255).astype("uint8")
+
+        original_batch = as_uint8(original_batch)
+        image_batch = as_uint8(image_batch)
+        if mask_batch is not None:
+            mask_batch = mask_batch[..., -1].astype(np.float32)
+
         columns = 4
         rows = self.batch_size
         plt.figure(figsize=(columns * 2.5, rows * 2.5))
@@ -195,7 +845,7 @@ class DatasetBuilder(BaseModel):
             f"Drop Masks: "
             f"{self.drop_masks}\n"
             f"Manual Masks provided: "
-            f"{self._mask_ds is not None}, "
+            f"{self._mask_paths is not None}, "
             f"Pairing mode: "
             f"{self.pairing_mode}"
         )
@@ -204,20 +854,22 @@ class DatasetBuilder(BaseModel):
             plt.subplot(rows, columns, i * columns + 1)
             if original_batch is not None:
                 # print(original_batch.shape)
-                plt.imshow((original_batch[i] * 255).astype("uint8"))
+                plt.imshow(original_batch[i])
                 plt.title("Paired")
             plt.axis("off")
 
             plt.subplot(rows, columns, i * columns + 2)
             # print(image_batch.shape)
-            plt.imshow((image_batch[i] * 255).astype("uint8"))
+            plt.imshow(image_batch[i])
             plt.title("Image")
             plt.axis("off")
 
             plt.subplot(rows, columns, i * columns + 3)
             if original_batch is not None:
-                plt.imshow(
-                    np.max(abs(original_batch[i] - image_batch[i]), axis=-1))
+                plt.imshow(np.max(abs(
+                    original_batch[i].astype(np.float32) / 255
+                    - image_batch[i].astype(np.float32) / 255
+                ), axis=-1))
                 plt.colorbar()
                 plt.title("Diff Image")
             plt.axis("off")
@@ -225,7 +877,7 @@ class DatasetBuilder(BaseModel):
             plt.subplot(rows, columns, i * columns + 4)
             if mask_batch is not None:
                 # print(mask_batch.shape)
-                plt.imshow(mask_batch[i][..., 1], cmap="Greys_r", vmin=0,
+                plt.imshow(mask_batch[i], cmap="Greys_r", vmin=0,
                            vmax=1)
                 plt.colorbar()
                 plt.title("GT Mask")
@@ -239,108 +891,315 @@ class DatasetBuilder(BaseModel):
             self,
             good_image,
             future_anomaly_image,
+            element_seed=None,
     ):
+        """
+        Returns the original and the result as uint8 images and the
+        foreground mask as a single-channel uint8 array. The conversion
+        to float and one-hot masks happens in the graph, see ``_to_float``.
+        """
+        orig_img, np_img, fg_label = self._synthesizer(
+            good_image.numpy().astype(np.uint8),
+            future_anomaly_image.numpy().astype(np.uint8),
+            None if element_seed is None else element_seed.numpy()
+        )
 
-        orig_img = good_image.numpy().copy()
-        orig_img = self.global_transform(image=(orig_img.astype(np.uint8)))[
-            'image']
+        return (
+            orig_img,
+            np_img,
+            fg_label.astype(np.uint8)
+        )
 
-        # Create a second image that should depict the
-        # same part, but has deviations
-        # which are within the process robustness
-        np_img = future_anomaly_image.numpy()  # .copy()
-        np_img = self.process_deviation(image=(np_img.astype(np.uint8)))[
-            'image']
+    @staticmethod
+    def _to_float(original, result, mask):
+        foreground = tf.cast(mask, tf.float32)
+        return (
+            (
+                tf.cast(original, tf.float32) / 255,
+                tf.cast(result, tf.float32) / 255
+            ),
+            tf.stack([1 - foreground, foreground], axis=-1)
+        )
 
-        fg_label = np.zeros(np_img.shape[:2], dtype=bool)
+    @staticmethod
+    def _add_ground_truth(element, *ground_truth):
+        """
+        Combines the synthesized mask of ``element`` with the ground truth
+        mask of the file, if the file has one.
+        """
+        if not ground_truth:
+            return element
+        images, mask = element
+        return images, combine_binary_masks(mask, ground_truth[0])
 
-        if self.create_artificial_anomalies:
-            if self.anomaly_size is None:
-                anomaly_size = np.random.randint(self.width // 8,
-                                                 self.width // 4)
-            else:
-                anomaly_size = self.anomaly_size
+    def _ground_truth_specs(self):
+        if self.mask_directory is None:
+            return ()
+        return (tf.TensorSpec([self.width, self.height, 2], tf.float32),)
 
-            # Slice a part of the image that will be used to
-            # alter the image to the point
-            # where it becomes an anomaly
-            src_slice = random_slice(np_img, anomaly_size)
-            dest_slice = random_slice(np_img, anomaly_size)
+    def _synthesize(self, good_image, image, element_seed):
+        return self._create_anomalies(
+            good_image=good_image,
+            future_anomaly_image=image,
+            element_seed=element_seed
+        )
 
-            crop = np_img[src_slice].copy()
+    def _synthetic_image_label_pairs(self):
 
-            # Randomly augment the cropped patch, including rotation
-            crop = self.anomaly_composition(
-                image=crop.astype(np.uint8)
-            )['image']
+        for good_image, image, element_seed, *ground_truth in \
+                self._image_pairs():
+            yield (
+                *self._synthesize(good_image, image, element_seed),
+                *(mask.numpy() for mask in ground_truth)
+            )
 
-            crop = crop.astype(np.float32)
+    def _from_synthesized(self, original, result, mask, *ground_truth):
+        return self._add_ground_truth(
+            self._to_float(original, result, mask),
+            *ground_truth
+        )
 
-            # Masking the crop in the shape of a random polygon
-            polygon = random_polygon(20)
-            polygon = np.asarray(polygon) * anomaly_size
-            mask = polygon2mask((anomaly_size, anomaly_size), polygon)
+    def _generator_synthetic_dataset(self):
+        return tf.data.Dataset.from_generator(
+            lambda: self._synthetic_image_label_pairs(),
+            output_signature=(
+                tf.TensorSpec([self.width, self.height, 3], tf.uint8),
+                tf.TensorSpec([self.width, self.height, 3], tf.uint8),
+                tf.TensorSpec([self.width, self.height], tf.uint8),
+                *self._ground_truth_specs()
+            )
+        ).map(
+            self._from_synthesized,
+            num_parallel_calls=self.num_parallel_calls
+        )
 
-            # Blur the borders of the polygon, so it blends when pasted back
-            background = np_img[dest_slice].copy()
-            np_img[dest_slice] = blend_merge(crop, background, mask)
-            fg_label[dest_slice] = mask
+    def _process_pool_image_label_pairs(self):
+        # The pool yields in order, so ground truth masks queue up
+        # next to the images that are in flight
+        ground_truths = deque()
 
-        bg_label = ~fg_label
-        onehot_mask = np.stack([bg_label, fg_label], axis=-1)
+        def pairs():
+            for good_image, image, element_seed, *ground_truth in \
+                    self._image_pairs():
+                ground_truths.append([mask.numpy() for mask in ground_truth])
+                yield (
+                    good_image.numpy().astype(np.uint8),
+                    image.numpy().astype(np.uint8),
+                    element_seed.numpy()
+                )
 
-        return (
-            orig_img.astype(np.float32) / 255,
-            np_img.astype(np.float32) / 255,
-            onehot_mask.astype(np.float32)
+        with ProcessPoolSynthesizer(
+                synthesizer=self._synthesizer,
+                width=self.width,
+                height=self.height,
+                num_workers=self.num_workers,
+                buffer_depth=self.buffer_depth,
+                start_method=self.start_method
+        ) as pool:
+            for synthesized in pool.imap(pairs()):
+                # The views are overwritten once their slot is reused,
+                # while TensorFlow may still hold the yielded buffers
+                yield (
+                    *(np.array(array, copy=True) for array in synthesized),
+                    *ground_truths.popleft()
+                )
+
+    def _process_pool_synthetic_dataset(self):
+        """
+        Synthesizes the images in a pool of worker processes, see
+        ``tfds_defect_detection.synthesis.ProcessPoolSynthesizer``.
+        The workers exchange uint8 images through shared memory,
+        the conversion to float and one-hot masks happens in the graph.
+        The pool is shut down when the dataset iterator is released.
+        """
+        return tf.data.Dataset.from_generator(
+            lambda: self._process_pool_image_label_pairs(),
+            output_signature=(
+                tf.TensorSpec([self.width, self.height, 3], tf.uint8),
+                tf.TensorSpec([self.width, self.height, 3], tf.uint8),
+                tf.TensorSpec([self.width, self.height], tf.uint8),
+                *self._ground_truth_specs()
+            )
+        ).map(
+            self._from_synthesized,
+            num_parallel_calls=self.num_parallel_calls
         )
 
-    def _synthetic_image_label_pairs(self):
+    def _parallel_synthetic_dataset(self):
+        """
+        Runs ``_create_anomalies`` inside a ``tf.py_function`` that is
+        mapped over the raw images with ``num_parallel_calls`` workers.
+        The element order is kept deterministic.
+        """
+        def synthesize(good_image, image, element_seed, *ground_truth):
+            original, result, mask = tf.py_function(
+                self._synthesize,
+                inp=[good_image, image, element_seed],
+                Tout=(tf.uint8, tf.uint8, tf.uint8)
+            )
+            original.set_shape([self.width, self.height, 3])
+            result.set_shape([self.width, self.height, 3])
+            mask.set_shape([self.width, self.height])
+            return self._from_synthesized(
+                original, result, mask, *ground_truth
+            )
 
-        for image, label in self._raw_ds:
-            yield self._create_anomalies(
-                good_image=(
-                    next(
-                        self._rand_images_by_label[label.numpy()]
-                    )[0]
-                    if self.pairing_mode == "result_with_contrastive_pair"
-                    else image
-                ),
-                future_anomaly_image=image
+        return self._image_pairs().map(
+            synthesize,
+            num_parallel_calls=self.num_parallel_calls,
+            deterministic=True
+        )
+
+    def _image_pairs(self):
+        """
+        Raw images paired with the image the original is created from,
+        followed by the ground truth mask if there is one.
+        Contrastive pairs are picked from the label to file index table
+        and decoded in the same parallel pipeline.
+        """
+        def good_image(image, label, element_seed):
+            if self.pairing_mode != "result_with_contrastive_pair":
+                return image
+            return self._load_image(self._pair_path(label, element_seed))
+
+        return self._raw_ds.map(
+            lambda image, label, element_seed, *ground_truth: (
+                good_image(image, label, element_seed),
+                image,
+                element_seed,
+                *ground_truth
+            ),
+            num_parallel_calls=self.num_parallel_calls
+        )
+
+    def _graph_synthetic_dataset(self):
+        """
+        Synthesizes the images with ``tf`` ops only, see
+        ``tfds_defect_detection.graph_synthesis``. The dataset is a
+        traceable chain of parallel ``map`` calls.
+        """
+        def synthesize(good_image, image, element_seed, *ground_truth):
+            original, result, mask = graph_synthesis.create_anomalies(
+                good_image=good_image,
+                future_anomaly_image=image,
+                element_seed=element_seed,
+                width=self.width,
+                create_artificial_anomalies=self.create_artificial_anomalies,
+                anomaly_size=self.anomaly_size,
+                global_transform=self.global_transform,
+                process_deviation=self.process_deviation,
+                anomaly_composition=self.anomaly_composition,
+            )
+            original.set_shape([self.width, self.height, 3])
+            result.set_shape([self.width, self.height, 3])
+            mask.set_shape([self.width, self.height, 2])
+            return self._add_ground_truth(
+                ((original, result), mask),
+                *ground_truth
             )
 
-    def _synth_and_combine_datasets(self):
-        ds = (
-            tf.data.Dataset.from_generator(
-                lambda: self._synthetic_image_label_pairs(),
-                output_types=(
-                    tf.float32,
-                    tf.float32,
-                    tf.float32
-                ),
-                output_shapes=(
-                    [self.width, self.height, 3],
-                    [self.width, self.height, 3],
-                    [self.width, self.height, 2]
-                )
-            ).map(lambda x, y, z: ((x, y), z))
+        return self._image_pairs().map(
+            synthesize,
+            num_parallel_calls=self.num_parallel_calls,
+            deterministic=True
         )
 
-        if self._mask_ds is not None:
-            ds = tf.data.Dataset.zip((ds, self._mask_ds)).map(
-                lambda ds_1, ds_2: (
-                    ds_1[0],
-                    combine_binary_masks(ds_1[1], ds_2)
-                )
+    def _vectorized_synthetic_dataset(self):
+        """
+        Batches the raw images first and synthesizes the anomalies for
+        the whole batch at once, see
+        ``tfds_defect_detection.graph_synthesis.create_anomalies_batch``.
+        Returns a batched dataset.
+        """
+        def synthesize(good_images, images, element_seeds, *ground_truth):
+            original, result, mask = graph_synthesis.create_anomalies_batch(
+                good_images=good_images,
+                future_anomaly_images=images,
+                element_seeds=element_seeds,
+                width=self.width,
+                create_artificial_anomalies=self.create_artificial_anomalies,
+                anomaly_size=self.anomaly_size,
+                global_transform=self.global_transform,
+                process_deviation=self.process_deviation,
+                anomaly_composition=self.anomaly_composition,
+            )
+            original.set_shape([None, self.width, self.height, 3])
+            result.set_shape([None, self.width, self.height, 3])
+            mask.set_shape([None, self.width, self.height, 2])
+            return self._add_ground_truth(
+                ((original, result), mask),
+                *ground_truth
             )
 
+        return self._image_pairs().batch(self.batch_size).map(
+            synthesize,
+            num_parallel_calls=self.num_parallel_calls,
+            deterministic=True
+        )
+
+    def _format_image(self, image):
+        """
+        Converts a float32 image in ``[0, 1]`` to ``output_dtype``.
+        uint8 images keep the ``[0, 255]`` range, see
+        ``tfds_defect_detection.layers.ImageNormalization``.
+        """
+        if self.output_dtype == "uint8":
+            return tf.cast(
+                tf.clip_by_value(tf.round(image * 255), 0, 255),
+                tf.uint8
+            )
+        return tf.cast(image, self.output_dtype)
+
+    def _format_mask(self, mask):
+        """
+        Converts a float32 one-hot mask to ``mask_format``. Single-channel
+        masks hold the foreground with shape ``[..., 1]``.
+        """
+        if self.mask_format == "onehot":
+            return tf.cast(
+                mask,
+                tf.float32 if self.output_dtype == "uint8"
+                else self.output_dtype
+            )
+        foreground = mask[..., 1:] > 0.5
+        if self.mask_format == "bool":
+            return foreground
+        return tf.cast(foreground, tf.uint8)
+
+    def _synth_and_combine_datasets(self, batch=True):
+        """
+        The batched and prefetched pipeline, or its unbatched elements
+        if not ``batch``.
+        """
+        ds = {
+            "generator": self._generator_synthetic_dataset,
+            "parallel": self._parallel_synthetic_dataset,
+            "process": self._process_pool_synthetic_dataset,
+            "graph": self._graph_synthetic_dataset,
+            "vectorized": self._vectorized_synthetic_dataset,
+        }[self.synthesis_backend]()
+        batched = self.synthesis_backend == "vectorized"
+
+        ds = ds.map(
+            lambda x, y: (
+                tuple(self._format_image(image) for image in x),
+                self._format_mask(y)
+            ),
+            num_parallel_calls=self.num_parallel_calls
+        )
+
         if self.pairing_mode == "result_only":
             ds = ds.map(lambda x, y: (x[1], y))
 
         if self.drop_masks:
             ds = ds.map(lambda x, y: x)
 
-        ds = ds.batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
+        if not batch:
+            return ds.unbatch() if batched else ds
+
+        if not batched:
+            ds = ds.batch(self.batch_size)
+        ds = ds.prefetch(tf.data.AUTOTUNE)
         return ds
 
 
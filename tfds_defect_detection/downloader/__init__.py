@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Optional, Tuple, Union
 
 from typing_extensions import Literal
 
@@ -7,9 +7,21 @@ from typing_extensions import Literal
 
 class BaseDownloader:
     mask_suffix = ""
+    # Folders of the downloaded and converted files in the dataset folder
+    download_folders = ()
 
-    def __init__(self, delete_tmp=True):
+    def __init__(self, delete_tmp=True, link_mode="auto", ingest_size=None):
         self.delete_tmp = delete_tmp
+        self.link_mode = link_mode
+        self.ingest_size = ingest_size
+
+    @property
+    def restructure_size(self):
+        """
+        Size the files are resized to while they are restructured, None
+        if ``convert_to_mvtec_style`` already resized them.
+        """
+        return self.ingest_size
 
     def download_and_extract(self, cache_dir) -> Path:
         raise NotImplemented
@@ -20,6 +32,7 @@ class BaseDownloader:
 
 class MvtecDownloader(BaseDownloader):
     mask_suffix = "_mask"
+    download_folders = ("mvtec_download",)
 
     def download_and_extract(self, cache_dir) -> Path:
         import tfds_defect_detection.downloader.mvtec as mvtec
@@ -28,6 +41,8 @@ class MvtecDownloader(BaseDownloader):
 
 class VisaDownloader(BaseDownloader):
     mask_suffix = ""
+    download_folders = ("VisA", "VisA_mvtec_style")
+    restructure_size = None
 
     def download_and_extract(self, cache_dir) -> Path:
         import tfds_defect_detection.downloader.visual_anomalies as visa
@@ -37,7 +52,9 @@ class VisaDownloader(BaseDownloader):
         import tfds_defect_detection.downloader.visual_anomalies as visa
         return visa.convert_to_mvtec_style(
                 root,
-                delete_tmp=self.delete_tmp
+                delete_tmp=self.delete_tmp,
+                link_mode=self.link_mode,
+                resize_to=self.ingest_size
             )
 
 
@@ -46,16 +63,66 @@ def download_and_prepare(
         cache_dir: Path,
         names: Iterable[Literal["mvtec", "visa"]],
         download=True,
-        image_validation=False,
-        delete_tmp=True
+        image_validation: Union[bool, Literal["header", "decode"]] = False,
+        delete_tmp=True,
+        image_store_size: Optional[Tuple[int, int]] = None,
+        crop_to_aspect_ratio=False,
+        link_mode: Literal["copy", "hardlink", "reflink", "auto"] = "auto",
+        ingest_size: Optional[Tuple[int, int]] = None,
 ):
+    """
+    Downloads and restructures the named datasets into ``cache_dir``.
+    Yields ``(train_images, test_images, test_masks)`` folders per dataset.
+
+    ``image_validation`` checks all prepared files, True or "decode"
+    decodes them, "header" only checks headers and truncation. Results
+    are cached, see ``tfds_defect_detection.validation``.
+
+    If ``image_store_size`` is given as ``(width, height)``, all images and
+    masks are additionally written into a memory-mapped store at that
+    resolution, see ``tfds_defect_detection.store.prepare_image_store``.
+
+    Files are hardlinked or reflinked into the new folder structure where
+    the file system allows it and copied otherwise, see ``link_mode`` of
+    ``tfds_defect_detection.utils.copy_to_folder``.
+
+    If ``ingest_size`` is given as ``(width, height)``, images and masks
+    are resized to it while they are prepared. This happens once, when
+    the dataset is first prepared. The size is recorded, a dataset that
+    was prepared at another size, or without resizing, raises a
+    ``ValueError`` instead of being reused.
+
+    A manifest of all files is written next to the folders, unless a
+    current one exists, see ``tfds_defect_detection.manifest``.
+
+    Preparation is incremental. Downloads, categories and datasets are
+    marked complete once all their files are in place, see
+    ``tfds_defect_detection.downloader.state``. An interrupted dataset
+    resumes with its first unfinished category. The files of a complete
+    one are compared with their records, categories with missing or
+    changed files are prepared again. A complete dataset of a version
+    without markers is adopted with the files it holds, one that was
+    interrupted is prepared again and keeps the existing files that
+    match their source.
+    """
     from tfds_defect_detection.downloader.mvtec import \
         restructure_mvtec_style_dataset
+    from tfds_defect_detection.downloader.state import PreparationState, \
+        mark_complete, reset_deleted_downloads
+    from tfds_defect_detection.manifest import Manifest, write_manifest
     from tfds_defect_detection.utils import validate_images
 
     downloaders = {
-        "mvtec": MvtecDownloader(delete_tmp=delete_tmp),
-        "visa": VisaDownloader(delete_tmp=delete_tmp)
+        "mvtec": MvtecDownloader(
+            delete_tmp=delete_tmp,
+            link_mode=link_mode,
+            ingest_size=ingest_size
+        ),
+        "visa": VisaDownloader(
+            delete_tmp=delete_tmp,
+            link_mode=link_mode,
+            ingest_size=ingest_size
+        )
     }
     for name in names:
         ds_cache_dir = cache_dir / name
@@ -69,19 +136,74 @@ def download_and_prepare(
 
         ds_cache_dir.mkdir(exist_ok=True, parents=True)
 
-        base_root = downloaders[name].download_and_extract(ds_cache_dir)
-        root = downloaders[name].convert_to_mvtec_style(base_root)
-
-        result = restructure_mvtec_style_dataset(
-                root,
-                mask_suffix=downloaders[name].mask_suffix,
-                delete_tmp=delete_tmp
-            )
+        state = PreparationState(ds_cache_dir)
+        if not state.started and all(
+                folder.is_dir() and any(folder.iterdir())
+                for folder in result
+        ):
+            # Prepared at the original size by a version without markers.
+            # The downloads it emptied must not be fetched again.
+            state.adopt(result)
+            for folder in downloaders[name].download_folders:
+                directory = ds_cache_dir / folder
+                if directory.is_dir() and not any(directory.iterdir()):
+                    mark_complete(directory)
+        elif not state.started and any(folder.is_dir() for folder in result):
+            # Interrupted by a version without markers
+            state.start()
+        state.check_ingest_size(ingest_size)
+
+        changed = {
+            category: state.changed_files(category)
+            for category in state.categories()
+        }
+        changed = {
+            category: files
+            for category, files in changed.items()
+            if files
+        }
+        for category, files in changed.items():
+            print(f"{len(files)} files of {name} {category} changed")
+            state.invalidate(category, files)
+        if changed:
+            reset_deleted_downloads(ds_cache_dir)
+
+        if not state.is_complete():
+            state.start(ingest_size)
+            base_root = downloaders[name].download_and_extract(ds_cache_dir)
+            root = downloaders[name].convert_to_mvtec_style(base_root)
+
+            result = restructure_mvtec_style_dataset(
+                    root,
+                    mask_suffix=downloaders[name].mask_suffix,
+                    delete_tmp=delete_tmp,
+                    link_mode=link_mode,
+                    state=state,
+                    resize_to=downloaders[name].restructure_size
+                )
 
         train_image_dir, test_image_dir, test_mask_dir = result
 
         if image_validation:
             for image_dir in result:
-                validate_images(image_dir)
+                validate_images(
+                    image_dir,
+                    mode=(
+                        "decode" if image_validation is True
+                        else image_validation
+                    )
+                )
+
+        manifest = Manifest.load(ds_cache_dir)
+        if manifest is None:
+            write_manifest(ds_cache_dir)
+
+        if image_store_size is not None:
+            from tfds_defect_detection.store import prepare_image_store
+            prepare_image_store(
+                ds_cache_dir,
+                *image_store_size,
+                crop_to_aspect_ratio=crop_to_aspect_ratio
+            )
 
         yield train_image_dir, test_image_dir, test_mask_dir
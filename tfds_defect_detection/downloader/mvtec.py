@@ -1,35 +1,113 @@
+import os
 import shutil
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
-from keras.utils import get_file
-from tqdm import tqdm
-import PIL.Image
+from tqdm.contrib.concurrent import thread_map
+from typing_extensions import Literal
 
-from tfds_defect_detection.utils import copy_to_folder
+from tfds_defect_detection.downloader.state import (
+    PreparationState,
+    file_record,
+    mark_complete,
+    is_complete
+)
+from tfds_defect_detection.utils import copy_to_folder, save_image
+
+
+LinkMode = Literal["copy", "hardlink", "reflink", "auto"]
+
+# Relative paths of placed files, mapped to their size and checksum
+FileRecords = Dict[str, dict]
+
+
+def _records(targets, dataset_dir: Path) -> FileRecords:
+    return {
+        os.path.relpath(target, dataset_dir): file_record(target)
+        for target in targets
+        if target is not None
+    }
+
+
+def _place(
+        source: Path,
+        target: Path,
+        link_mode: LinkMode = "auto",
+        resize_to: Optional[Tuple[int, int]] = None,
+        nearest=False,
+):
+    """
+    Places ``source`` at ``target``, resized to ``resize_to`` as
+    ``(width, height)`` if it is given. Masks are resized ``nearest``.
+    """
+    if resize_to is None:
+        copy_to_folder(source, target, link_mode)
+        return
+
+    from PIL import Image
+
+    with Image.open(source) as image:
+        save_image(
+            image.resize(
+                (resize_to[1], resize_to[0]),
+                Image.NEAREST if nearest else Image.BILINEAR
+            ),
+            target
+        )
+
+
+def _is_placed(
+        source: Path,
+        target: Path,
+        resize_to: Optional[Tuple[int, int]] = None,
+) -> bool:
+    """
+    Whether ``target`` already holds ``source``. Files are placed
+    atomically, so a resized one is complete. Others must match the size
+    of ``source``, which catches files that versions without atomic
+    placement copied only partially.
+    """
+    if not target.is_file():
+        return False
+    return (
+        resize_to is not None
+        or target.stat().st_size == source.stat().st_size
+    )
 
 
 def _prepare_good_images(
         download_directory: Path,
         new_root="train_images",
-        skip_if_image_exists=True
-):
+        skip_if_image_exists=True,
+        link_mode: LinkMode = "auto",
+        num_threads=16,
+        category="*",
+        resize_to: Optional[Tuple[int, int]] = None,
+) -> Tuple[Path, FileRecords]:
     old_root = download_directory.name
     result = Path(str(download_directory).replace(old_root, new_root))
-    all_images = list(download_directory.rglob("**/*train/good/*.*"))
+    all_images = list(
+        download_directory.glob(f"{category}/**/*train/good/*.*")
+    )
 
     if not len(all_images) and result.is_dir():
-        return result
+        return result, {}
+
+    print("Preparing", old_root, category, new_root)
 
-    print("Preparing", old_root, new_root)
-    for path in tqdm(all_images):
+    def prepare(path: Path):
         if path.name.startswith("."):
-            continue
+            return None
         target = Path(str(path).replace(old_root, new_root))
-        if skip_if_image_exists and target.is_file():
-            continue
-        copy_to_folder(path, target)
+        if not (
+                skip_if_image_exists
+                and _is_placed(path, target, resize_to)
+        ):
+            _place(path, target, link_mode, resize_to)
+        return target
 
-    return result
+    targets = thread_map(prepare, all_images, max_workers=num_threads)
+    return result, _records(targets, download_directory.parent)
 
 
 def _prepare_anomaly_images_with_masks(
@@ -37,44 +115,55 @@ def _prepare_anomaly_images_with_masks(
         new_root_images="test_images",
         new_root_masks="test_masks",
         mask_suffix="_mask",
-        skip_if_image_exists=True
-):
+        skip_if_image_exists=True,
+        link_mode: LinkMode = "auto",
+        num_threads=16,
+        category="*",
+        resize_to: Optional[Tuple[int, int]] = None,
+) -> Tuple[Path, Path, FileRecords]:
     old_root = download_directory.name
 
     result = (
         Path(str(download_directory).replace(old_root, new_root_images)),
         Path(str(download_directory).replace(old_root, new_root_masks))
     )
-    all_images = list(download_directory.rglob("**/*test/**/*.*"))
+    all_images = list(download_directory.glob(f"{category}/**/*test/**/*.*"))
 
     if not len(all_images) and result[0].is_dir() and result[1].is_dir():
-        return result
+        return (*result, {})
 
-    print("Preparing", old_root, new_root_images, "and", new_root_masks)
+    print("Preparing", old_root, category, new_root_images,
+          "and", new_root_masks)
 
-    for img_path in tqdm(all_images):
+    def prepare(img_path: Path):
         if img_path.name.startswith("."):
-            continue
+            return None, None
         img_target = Path(str(img_path).replace(old_root, new_root_images))
-        if skip_if_image_exists and img_target.is_file():
-            continue
 
         mask_path = Path(str(img_path).replace("test", "ground_truth"))
         mask_path = mask_path.parent / (mask_path.stem + mask_suffix + ".png")
         mask_target = Path(str(img_path).replace(old_root, new_root_masks))
         mask_target = mask_target.with_suffix(".png")
 
-        copy_to_folder(img_path, img_target)
+        if not (
+                skip_if_image_exists
+                and _is_placed(img_path, img_target, resize_to)
+        ):
+            _place(img_path, img_target, link_mode, resize_to)
 
+        # Images without ground truth, e.g. test/good, get no mask file.
+        # The loader creates their empty mask in the graph.
         if not mask_path.is_file():
-            img_size = PIL.Image.open(img_path).size
-            mask = PIL.Image.new(mode="L", size=img_size, color="black")
-            mask_target.parent.mkdir(exist_ok=True, parents=True)
-            mask.save(mask_target)
-        elif not mask_target.is_file():
-            copy_to_folder(mask_path, mask_target)
+            return img_target, None
+        if not _is_placed(mask_path, mask_target, resize_to):
+            _place(mask_path, mask_target, link_mode, resize_to, nearest=True)
+        return img_target, mask_target
 
-    return result
+    targets = thread_map(prepare, all_images, max_workers=num_threads)
+    return (*result, _records(
+        [target for pair in targets for target in pair],
+        download_directory.parent
+    ))
 
 
 def restructure_mvtec_style_dataset(
@@ -83,23 +172,74 @@ def restructure_mvtec_style_dataset(
         new_root_test_images="test_images",
         new_root_test_masks="test_masks",
         mask_suffix="_mask",
-        delete_tmp=True
+        delete_tmp=True,
+        link_mode: LinkMode = "auto",
+        num_threads=16,
+        state: Optional[PreparationState] = None,
+        resize_to: Optional[Tuple[int, int]] = None,
 ):
+    """
+    Restructures an mvtec style dataset into
+    ``train_images``, ``test_images`` and ``test_masks`` folders.
+
+    Files are placed with ``link_mode``, see
+    ``tfds_defect_detection.utils.copy_to_folder``, by ``num_threads``
+    threads. Linked files survive deleting ``root_dir``. If ``resize_to``
+    is given as ``(width, height)``, images and masks are stored at that
+    size instead.
+
+    Categories are prepared one after the other and marked complete in
+    ``state``, which defaults to the ``PreparationState`` of the parent of
+    ``root_dir``. Complete categories are skipped, so an interrupted run
+    resumes where it stopped. ``root_dir`` is only deleted once the whole
+    dataset is marked complete.
+    """
+    dataset_dir = root_dir.parent
+    state = state or PreparationState(dataset_dir)
+    state.start()
     result = (
-        _prepare_good_images(
-            root_dir,
-            new_root_train_images
-        ),
-        *_prepare_anomaly_images_with_masks(
-            root_dir,
-            new_root_test_images,
-            new_root_test_masks,
-            mask_suffix
-        )
+        dataset_dir / new_root_train_images,
+        dataset_dir / new_root_test_images,
+        dataset_dir / new_root_test_masks,
+    )
+    if state.is_complete():
+        return result
+
+    categories = sorted(
+        path.name
+        for path in root_dir.iterdir()
+        if path.is_dir() and not path.name.startswith(".")
     )
+    files = {}
+    for category in categories:
+        if not state.is_complete(category):
+            _, good_files = _prepare_good_images(
+                root_dir,
+                new_root_train_images,
+                link_mode=link_mode,
+                num_threads=num_threads,
+                category=category,
+                resize_to=resize_to
+            )
+            *_, anomaly_files = _prepare_anomaly_images_with_masks(
+                root_dir,
+                new_root_test_images,
+                new_root_test_masks,
+                mask_suffix,
+                link_mode=link_mode,
+                num_threads=num_threads,
+                category=category,
+                resize_to=resize_to
+            )
+            state.mark_complete(category, {**good_files, **anomaly_files})
+        files.update(state.files(category))
+
+    state.mark_complete(files=files)
+
     if delete_tmp:
         shutil.rmtree(root_dir, ignore_errors=True)
-        root_dir.mkdir(parents=True, exist_ok=True)
+        # The marker keeps the deleted download from being fetched again
+        mark_complete(root_dir)
 
     return result
 
@@ -112,10 +252,12 @@ if __name__ == "__main__":
 
 
 def download_and_extract(cache_dir):
+    from keras.utils import get_file
+
     mvtec_name = "mvtec_anomaly_detection.tar.xz"
     mvtec_folder_name = "mvtec_download"
     mvtec_root = cache_dir / mvtec_folder_name
-    if not mvtec_root.is_dir():
+    if not is_complete(mvtec_root):
         get_file(
             fname=mvtec_name,
             origin=MVTEC_ORIGIN,
@@ -123,6 +265,7 @@ def download_and_extract(cache_dir):
             cache_dir=cache_dir,
             cache_subdir=mvtec_folder_name
         )
+        mark_complete(mvtec_root)
     return mvtec_root
 
 
@@ -0,0 +1,247 @@
+"""
+Completion markers of an incremental dataset preparation.
+
+Every file of a prepared dataset is placed atomically, see
+``tfds_defect_detection.utils.copy_to_folder``. Once all files of a
+category are in place, ``PreparationState`` writes a marker with size,
+mtime and sha1 of each of them to
+``<dataset_dir>/.prepared/category_<name>.json``, and once all categories
+are done, the marker of the whole dataset. Markers are written atomically
+and last, so a run that is interrupted resumes with the first unfinished
+category and a half-copied tree is never taken for a complete one.
+
+Re-runs compare the files of complete categories with their records,
+see ``PreparationState.changed_files``, and only hash files whose size or
+mtime differ.
+
+The ingest size the dataset is prepared at is recorded when the
+preparation starts, see ``PreparationState.check_ingest_size``.
+
+Download folders carry a ``.complete`` marker of their own, see
+``mark_complete``. Datasets prepared by versions without markers are
+adopted, see ``PreparationState.adopt``.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PREPARED_DIR = ".prepared"
+COMPLETE_MARKER = ".complete"
+STATE_VERSION = 1
+
+
+def is_complete(directory: Path) -> bool:
+    return (directory / COMPLETE_MARKER).is_file()
+
+
+def mark_complete(directory: Path):
+    """
+    Marks a download ``directory`` as extracted. The marker is kept if the
+    extracted files are deleted after they were converted, so they are not
+    downloaded again.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / COMPLETE_MARKER).touch()
+
+
+def reset_deleted_downloads(dataset_dir: Path):
+    """
+    Removes the markers of download folders in ``dataset_dir`` whose
+    files were deleted after they were converted, so they are downloaded
+    again when a changed dataset is prepared again.
+    """
+    for directory in Path(dataset_dir).iterdir():
+        if is_complete(directory) and [
+            path.name for path in directory.iterdir()
+        ] == [COMPLETE_MARKER]:
+            (directory / COMPLETE_MARKER).unlink()
+            directory.rmdir()
+
+
+def _sha1(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_record(path: Path) -> Dict[str, object]:
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": _sha1(path),
+    }
+
+
+def _write_json(path: Path, data: dict):
+    tmp_file = path.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class PreparationState:
+    """
+    Completion markers of the dataset prepared in ``dataset_dir``.
+    """
+
+    def __init__(self, dataset_dir: Path):
+        self.dataset_dir = Path(dataset_dir)
+        self.directory = self.dataset_dir / PREPARED_DIR
+
+    def _marker(self, category: Optional[str] = None) -> Path:
+        if category is None:
+            return self.directory / "dataset.json"
+        return self.directory / f"category_{category}.json"
+
+    @property
+    def started(self) -> bool:
+        return self.directory.is_dir()
+
+    def start(self, ingest_size: Optional[Tuple[int, int]] = None):
+        """
+        Creates the marker folder and records ``ingest_size``, unless the
+        preparation was already started.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        settings = self.directory / "settings.json"
+        if not settings.is_file():
+            _write_json(settings, {
+                "version": STATE_VERSION,
+                "ingest_size": ingest_size,
+            })
+
+    @property
+    def ingest_size(self) -> Optional[Tuple[int, int]]:
+        settings = self.directory / "settings.json"
+        if not settings.is_file():
+            return None
+        with open(settings) as f:
+            ingest_size = json.load(f)["ingest_size"]
+        return None if ingest_size is None else tuple(ingest_size)
+
+    def check_ingest_size(self, ingest_size: Optional[Tuple[int, int]]):
+        """
+        Raises a ``ValueError`` if the dataset was started at another
+        ingest size, its images would silently be reused at the wrong
+        resolution.
+        """
+        if not self.started:
+            return
+        if self.ingest_size != (
+                None if ingest_size is None else tuple(ingest_size)
+        ):
+            raise ValueError(
+                f"{self.dataset_dir} is prepared with ingest size "
+                f"{self.ingest_size or 'of the originals'}, not "
+                f"{ingest_size or 'of the originals'}. Use another cache "
+                f"directory or delete {self.dataset_dir}"
+            )
+
+    def is_complete(self, category: Optional[str] = None) -> bool:
+        return self._marker(category).is_file()
+
+    def mark_complete(
+            self,
+            category: Optional[str] = None,
+            files: Optional[Dict[str, dict]] = None
+    ):
+        """
+        Marks ``category``, or the whole dataset if it is ``None``, as
+        complete. ``files`` maps the paths relative to ``dataset_dir`` to
+        their ``file_record``.
+        """
+        self.start()
+        _write_json(self._marker(category), {
+            "version": STATE_VERSION,
+            "files": files or {},
+        })
+
+    def files(self, category: Optional[str] = None) -> Dict[str, dict]:
+        if not self.is_complete(category):
+            return {}
+        with open(self._marker(category)) as f:
+            return json.load(f)["files"]
+
+    def categories(self) -> List[str]:
+        """
+        The categories marked complete.
+        """
+        return sorted(
+            marker.stem[len("category_"):]
+            for marker in self.directory.glob("category_*.json")
+        )
+
+    def changed_files(self, category: str) -> List[str]:
+        """
+        Files of a complete ``category`` that are missing or differ from
+        their record. Files whose size matches but whose mtime changed
+        are hashed, the records of unchanged ones get their new mtime.
+        """
+        files = self.files(category)
+        changed, touched = [], False
+        for relative, record in files.items():
+            path = self.dataset_dir / relative
+            if not path.is_file():
+                changed.append(relative)
+                continue
+            stat = path.stat()
+            if stat.st_size != record["size"]:
+                changed.append(relative)
+            elif stat.st_mtime_ns != record.get("mtime_ns"):
+                if _sha1(path) != record["sha1"]:
+                    changed.append(relative)
+                else:
+                    record["mtime_ns"] = stat.st_mtime_ns
+                    touched = True
+        if touched:
+            self.mark_complete(category, files)
+        return changed
+
+    def adopt(self, folders: Iterable[Path]):
+        """
+        Marks a dataset prepared by a version without markers as complete.
+        The files currently in ``folders`` are recorded, grouped into
+        categories by their first subfolder.
+        """
+        categories = {}
+        for folder in folders:
+            for path in sorted(Path(folder).rglob("*")):
+                relative = path.relative_to(folder)
+                if (
+                        len(relative.parts) < 2
+                        or path.name.startswith(".")
+                        or not path.is_file()
+                ):
+                    continue
+                categories.setdefault(relative.parts[0], {})[
+                    os.path.relpath(path, self.dataset_dir)
+                ] = file_record(path)
+
+        self.start()
+        for category, files in categories.items():
+            self.mark_complete(category, files)
+        self.mark_complete(files={
+            relative: record
+            for files in categories.values()
+            for relative, record in files.items()
+        })
+
+    def invalidate(self, category: str, changed: List[str]):
+        """
+        Deletes the ``changed`` files of ``category`` and its marker and
+        that of the dataset, so the next run places them again.
+        """
+        for relative in changed:
+            path = self.dataset_dir / relative
+            if path.is_file():
+                path.unlink()
+        for marker in (self._marker(category), self._marker()):
+            if marker.is_file():
+                marker.unlink()
@@ -1,26 +1,114 @@
 import os
 import shutil
 import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Optional, Tuple
 
-from keras.utils import get_file
 from tqdm import tqdm
+from typing_extensions import Literal
 
 from PIL import Image
 import numpy as np
 
+from tfds_defect_detection.downloader.state import is_complete, mark_complete
+from tfds_defect_detection.synthesis import default_start_method
+from tfds_defect_detection.utils import copy_to_folder, save_image
+
 
 def _mkdirs_if_not_exists(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
 
-def convert_to_mvtec_style(data_dir: Path, delete_tmp=True):
+def _binarize(mask: Image.Image) -> Image.Image:
+    mask_array = np.asarray(mask)
+    if mask_array.ndim == 3:
+        mask_array = mask_array.any(axis=-1)
+    return Image.fromarray(
+        np.where(mask_array != 0, 255, 0).astype(np.uint8),
+        mode="L"
+    )
+
+
+def _convert_row(
+        row,
+        data_dir: Path,
+        save_folder: Path,
+        link_mode="auto",
+        resize_to: Optional[Tuple[int, int]] = None,
+):
+    object, set, label, image_path, mask_path = row
+    if label == 'normal':
+        label = 'good'
+    else:
+        label = 'bad'
+    image_name = image_path.split('/')[-1]
+    mask_name = mask_path.split('/')[-1]
+    img_src_path = data_dir / image_path
+    msk_src_path = data_dir / mask_path
+    img_dst_path = save_folder / object / set / label / image_name
+    msk_dst_path = save_folder / object / 'ground_truth' / label / mask_name
+
+    # PIL sizes are (columns, rows), resize_to is (width, height)
+    # like the image size of DatasetBuilder
+    pil_size = None if resize_to is None else (resize_to[1], resize_to[0])
+
+    # Files are written atomically, existing ones are from a previous,
+    # interrupted conversion and complete
+    if img_dst_path.is_file():
+        pass
+    elif pil_size is None:
+        copy_to_folder(img_src_path, img_dst_path, link_mode)
+    else:
+        with Image.open(img_src_path) as image:
+            save_image(
+                image.convert("RGB").resize(pil_size, Image.BILINEAR),
+                img_dst_path,
+                quality=95
+            )
+
+    if set == 'test' and label == 'bad' and not msk_dst_path.is_file():
+        with Image.open(msk_src_path) as mask:
+            mask = _binarize(mask)
+        if pil_size is not None:
+            mask = mask.resize(pil_size, Image.NEAREST)
+        save_image(mask, msk_dst_path)
+
+
+def convert_to_mvtec_style(
+        data_dir: Path,
+        delete_tmp=True,
+        link_mode: Literal["copy", "hardlink", "reflink", "auto"] = "auto",
+        num_workers: Optional[int] = None,
+        resize_to: Optional[Tuple[int, int]] = None,
+):
+    """
+    Converts the extracted VisA dataset into an mvtec style folder
+    structure. Rows of the split file are converted by ``num_workers``
+    processes, defaults to the number of CPUs. The workers are started
+    with ``forkserver`` where available, else ``spawn``.
+
+    If ``resize_to`` is given as ``(width, height)``, images and masks are
+    stored at that size instead of linked or copied, so later epochs
+    decode small files. Masks are binarized either way.
+
+    The conversion is written to a ``.partial`` folder, which is renamed
+    once all rows are converted. An interrupted conversion resumes and
+    skips the rows it already converted.
+    """
     split_file = data_dir / "split_csv" / "1cls.csv"
-    save_folder = data_dir.parent / (data_dir.stem + "_mvtec_style")
+    save_folder = data_dir.parent / (
+        data_dir.stem + "_mvtec_style"
+        + ("" if resize_to is None else f"_{resize_to[0]}x{resize_to[1]}")
+    )
 
     if save_folder.is_dir():
         return save_folder
+    final_folder = save_folder
+    save_folder = save_folder.with_name(save_folder.name + ".partial")
 
     print("Converting", str(data_dir), "to mvtec-style dataset")
 
@@ -46,32 +134,37 @@ def convert_to_mvtec_style(data_dir: Path, delete_tmp=True):
     with open(split_file, 'r') as file:
         csvreader = csv.reader(file)
         _ = next(csvreader)  # header
-        for row in tqdm(list(csvreader)):
-            object, set, label, image_path, mask_path = row
-            if label == 'normal':
-                label = 'good'
-            else:
-                label = 'bad'
-            image_name = image_path.split('/')[-1]
-            mask_name = mask_path.split('/')[-1]
-            img_src_path = data_dir / image_path
-            msk_src_path = data_dir / mask_path
-            img_dst_path = save_folder / object / set / label / image_name
-            msk_dst_path = save_folder / object / 'ground_truth' / label / mask_name
-            shutil.copyfile(img_src_path, img_dst_path)
-            if set == 'test' and label == 'bad':
-                mask = Image.open(msk_src_path)
-
-                # binarize mask
-                mask_array = np.array(mask)
-                mask_array[mask_array != 0] = 255
-                mask = Image.fromarray(mask_array.astype(np.uint8)).convert("L")
-
-                mask.save(msk_dst_path)
+        rows = list(csvreader)
+
+    # Forking a process that may already run TensorFlow threads can
+    # deadlock the workers
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context(default_start_method())
+    ) as pool:
+        for _ in tqdm(
+                pool.map(
+                    partial(
+                        _convert_row,
+                        data_dir=data_dir,
+                        save_folder=save_folder,
+                        link_mode=link_mode,
+                        resize_to=resize_to
+                    ),
+                    rows,
+                    chunksize=64
+                ),
+                total=len(rows)
+        ):
+            pass
+
+    os.replace(save_folder, final_folder)
+
     if delete_tmp:
         shutil.rmtree(data_dir, ignore_errors=True)
-        data_dir.mkdir(parents=True, exist_ok=True)
-    return save_folder
+        # The marker keeps the deleted download from being fetched again
+        mark_complete(data_dir)
+    return final_folder
 
 
 if __name__ == '__main__':
@@ -80,10 +173,12 @@ VISA_ORIGIN = "https://amazon-visual-anomaly.s3.us-west-2.amazonaws.com/VisA_202
 
 
 def download_and_extract(cache_dir):
+    from keras.utils import get_file
+
     visa_folder_name = "VisA"
     visa_name = "VisA.tar"
     visa_root = cache_dir / visa_folder_name
-    if not visa_root.is_dir():
+    if not is_complete(visa_root):
         get_file(
             fname=visa_name,
             origin=VISA_ORIGIN,
@@ -91,4 +186,5 @@ def download_and_extract(cache_dir):
             cache_dir=cache_dir,
             cache_subdir=visa_folder_name
         )
+        mark_complete(visa_root)
     return visa_root
@@ -0,0 +1,296 @@
+"""
+Offline pre-generation of synthetic anomaly epochs.
+
+``export_synthetic_epochs`` runs a ``DatasetBuilder`` for a number of
+epochs and writes the ``(original, result, mask)`` triples to GZIP
+compressed, sharded TFRecord files. ``load_synthetic_epochs`` streams them
+back as a ``tf.data.Dataset`` with the element spec of the builder.
+
+Command line usage
+
+.. code-block:: bash
+
+    python -m tfds_defect_detection.export --names mvtec --epochs 10 \
+        --data-dir anomaly_datasets --output-dir synthetic_mvtec
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from typing_extensions import Literal
+
+SPEC_FILE = "spec.json"
+SHARD_PATTERN = "synthetic-{shard:05d}-of-{num_shards:05d}.tfrecord.gz"
+
+_FEATURES = {
+    "original": tf.io.FixedLenFeature([], tf.string),
+    "result": tf.io.FixedLenFeature([], tf.string),
+    "mask": tf.io.FixedLenFeature([], tf.string),
+    "epoch": tf.io.FixedLenFeature([], tf.int64),
+    "index": tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+def _bytes_feature(array: np.ndarray):
+    return tf.train.Feature(
+        bytes_list=tf.train.BytesList(value=[array.tobytes()])
+    )
+
+
+def _int_feature(value: int):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def export_synthetic_epochs(
+        output_dir: Path,
+        epochs=1,
+        num_shards=8,
+        **builder_kwargs: Any
+) -> Path:
+    """
+    Writes ``epochs`` passes of a ``DatasetBuilder`` to ``output_dir``.
+
+    ``builder_kwargs`` are passed to ``DatasetBuilder``. Masks are always
+    kept and the original image is always stored, so the files can be read
+    back with any ``pairing_mode``. For "result_with_contrastive_pair" the
+    stored original is the contrastive pair.
+
+    Epoch ``i`` is synthesized by a builder with ``initial_epoch=i``, so
+    every element is seeded by ``(seed, epoch, index)`` and the export is
+    reproducible with any synthesis backend. Elements are distributed
+    round robin over ``num_shards`` files.
+
+    Images and masks are stored as uint8, the requested ``output_dtype``
+    and ``mask_format`` are recorded in the spec and restored by
+    ``load_synthetic_epochs``.
+
+    Returns ``output_dir``.
+    """
+    from tfds_defect_detection.data import DatasetBuilder
+
+    if epochs < 1:
+        raise ValueError(f"epochs must be at least 1, got {epochs}")
+
+    output_dtype = builder_kwargs.get("output_dtype", "float32")
+    mask_format = builder_kwargs.get("mask_format", "onehot")
+    pairing_mode = builder_kwargs.get("pairing_mode", "result_only")
+    builder_kwargs = {
+        **builder_kwargs,
+        "pairing_mode": (
+            "result_with_original"
+            if pairing_mode == "result_only"
+            else pairing_mode
+        ),
+        "drop_masks": False,
+        "output_dtype": "uint8",
+        "mask_format": "uint8",
+        "repeat": False,
+        "peek": False,
+    }
+    builder = None
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    options = tf.io.TFRecordOptions(compression_type="GZIP")
+    writers = [
+        tf.io.TFRecordWriter(
+            str(output_dir / SHARD_PATTERN.format(
+                shard=shard,
+                num_shards=num_shards
+            )),
+            options=options
+        )
+        for shard in range(num_shards)
+    ]
+
+    num_examples = 0
+    try:
+        for epoch in range(epochs):
+            builder = DatasetBuilder(**{
+                **builder_kwargs,
+                "initial_epoch": epoch
+            })
+            elements = builder.ds.unbatch().as_numpy_iterator()
+            for index, ((original, result), mask) in enumerate(tqdm(
+                    elements,
+                    desc=f"Exporting epoch {epoch + 1}/{epochs}"
+            )):
+                example = tf.train.Example(features=tf.train.Features(
+                    feature={
+                        "original": _bytes_feature(original),
+                        "result": _bytes_feature(result),
+                        "mask": _bytes_feature(mask[..., 0]),
+                        "epoch": _int_feature(epoch),
+                        "index": _int_feature(index),
+                    }
+                ))
+                writers[num_examples % num_shards].write(
+                    example.SerializeToString()
+                )
+                num_examples += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+    with open(output_dir / SPEC_FILE, "w") as f:
+        json.dump({
+            "width": builder.width,
+            "height": builder.height,
+            "epochs": epochs,
+            "num_shards": num_shards,
+            "num_examples": num_examples,
+            "seed": builder.seed,
+            "pairing_mode": builder.pairing_mode,
+            "output_dtype": output_dtype,
+            "mask_format": mask_format,
+            "image_directory": str(builder.image_directory),
+            "mask_directory": (
+                str(builder.mask_directory)
+                if builder.mask_directory is not None
+                else None
+            ),
+        }, f, indent=2)
+
+    return output_dir
+
+
+def load_synthetic_epochs(
+        directory: Path,
+        pairing_mode: Literal[
+            "result_only",
+            "result_with_original",
+            "result_with_contrastive_pair"
+        ] = "result_only",
+        drop_masks=False,
+        output_dtype: Optional[Literal[
+            "float32",
+            "float16",
+            "bfloat16",
+            "uint8"
+        ]] = None,
+        mask_format: Optional[Literal[
+            "onehot",
+            "uint8",
+            "bool"
+        ]] = None,
+        batch_size=8,
+        shuffle=True,
+        repeat=True,
+        seed=123,
+        num_parallel_calls=tf.data.AUTOTUNE,
+) -> tf.data.Dataset:
+    """
+    Streams files written by ``export_synthetic_epochs`` as a
+    ``tf.data.Dataset`` with the same element spec as
+    ``DatasetBuilder(pairing_mode=pairing_mode, drop_masks=drop_masks).ds``
+    with the ``output_dtype`` and ``mask_format`` of the export, unless
+    they are given.
+    """
+    with open(directory / SPEC_FILE) as f:
+        spec = json.load(f)
+    width, height = spec["width"], spec["height"]
+    output_dtype = output_dtype or spec.get("output_dtype", "float32")
+    mask_format = mask_format or spec.get("mask_format", "onehot")
+
+    files = tf.data.Dataset.list_files(
+        str(directory / "synthetic-*.tfrecord.gz"),
+        shuffle=shuffle,
+        seed=seed
+    )
+    ds = files.interleave(
+        lambda file: tf.data.TFRecordDataset(file, compression_type="GZIP"),
+        cycle_length=spec["num_shards"],
+        num_parallel_calls=num_parallel_calls,
+        deterministic=not shuffle
+    )
+    if shuffle:
+        ds = ds.shuffle(batch_size * 64, seed=seed)
+    if repeat:
+        ds = ds.repeat()
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, _FEATURES)
+
+        def image(key):
+            img = tf.io.decode_raw(example[key], tf.uint8)
+            img = tf.reshape(img, [width, height, 3])
+            if output_dtype == "uint8":
+                return img
+            return tf.cast(tf.cast(img, tf.float32) / 255, output_dtype)
+
+        mask = tf.reshape(
+            tf.io.decode_raw(example["mask"], tf.uint8),
+            [width, height, 1]
+        )
+        if mask_format == "bool":
+            mask = mask > 0
+        elif mask_format == "onehot":
+            mask = tf.cast(mask[..., 0], tf.float32)
+            mask = tf.cast(
+                tf.stack([1 - mask, mask], axis=-1),
+                tf.float32 if output_dtype == "uint8" else output_dtype
+            )
+        return (image("original"), image("result")), mask
+
+    ds = ds.map(parse, num_parallel_calls=num_parallel_calls)
+
+    if pairing_mode == "result_only":
+        ds = ds.map(lambda x, y: (x[1], y))
+
+    if drop_masks:
+        ds = ds.map(lambda x, y: x)
+
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def main():
+    from tfds_defect_detection.downloader import download_and_prepare
+
+    parser = argparse.ArgumentParser(
+        description="Pre-generate synthetic anomaly epochs "
+                    "into sharded TFRecord files."
+    )
+    parser.add_argument("--names", nargs="+", default=["mvtec", "visa"])
+    parser.add_argument("--data-dir", type=Path,
+                        default=Path("anomaly_datasets"))
+    parser.add_argument("--output-dir", type=Path, required=True)
+    parser.add_argument("--subset", default="training",
+                        choices=["training", "validation"])
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--num-shards", type=int, default=8)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--anomaly-size", type=int, default=None)
+    parser.add_argument("--validation-split", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--synthesis-backend", default="parallel",
+                        choices=["generator", "parallel", "process",
+                                 "graph", "vectorized"])
+    args = parser.parse_args()
+
+    all_folders = download_and_prepare(
+        cache_dir=args.data_dir,
+        names=args.names,
+    )
+    for name, (train_folder, _, _) in zip(args.names, all_folders):
+        export_synthetic_epochs(
+            output_dir=args.output_dir / name,
+            epochs=args.epochs,
+            num_shards=args.num_shards,
+            image_directory=train_folder,
+            subset=args.subset,
+            width=args.width,
+            height=args.height,
+            anomaly_size=args.anomaly_size,
+            validation_split=args.validation_split,
+            seed=args.seed,
+            synthesis_backend=args.synthesis_backend,
+            create_artificial_anomalies=True,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,557 @@
+"""
+TensorFlow graph implementation of the cut-paste anomaly generator.
+
+Mirrors ``tfds_defect_detection.synthesis.AnomalySynthesizer`` with
+``tf`` ops only, so the synthesis can be traced by ``tf.function`` and
+run inside a parallel ``tf.data.Dataset.map``.
+
+All random ops are stateless and take a ``seed`` of shape ``[2]``, derived
+from the ``(seed, epoch, index)`` of the element with ``stateless_seed``.
+"""
+import math
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+import tensorflow as tf
+
+from tfds_defect_detection.synthesis import apply_albumentations, \
+    is_identity
+
+if TYPE_CHECKING:
+    import albumentations as A
+
+
+def stateless_seed(element_seed: tf.Tensor) -> tf.Tensor:
+    """
+    Maps an ``(seed, epoch, index)`` element seed to a stateless seed.
+    """
+    element_seed = tf.cast(element_seed, tf.int64)
+    return tf.stack([
+        element_seed[0],
+        element_seed[1] * 2 ** 32 + element_seed[2]
+    ])
+
+
+def split_seed(seed: tf.Tensor, num: int):
+    return tf.unstack(
+        tf.random.experimental.stateless_split(seed, num=num),
+        num=num
+    )
+
+
+def random_polygon(num_points: int, seed: tf.Tensor, shape=()) -> tf.Tensor:
+    """
+    Random star-shaped polygons with ``num_points`` vertices
+    as ``(row, col)`` coordinates in ``[0, 1]``.
+    Returns a tensor of shape ``[*shape, num_points, 2]``.
+
+    Vertices are placed at sorted random angles around the center with
+    random radii, so the polygon never intersects itself.
+    """
+    angle_seed, radius_seed = split_seed(seed, 2)
+    shape = list(shape) + [num_points]
+    angles = tf.sort(
+        tf.random.stateless_uniform(shape, angle_seed, 0, 2 * math.pi),
+        axis=-1
+    )
+    radii = tf.random.stateless_uniform(shape, radius_seed, 0.2, 0.5)
+    return tf.stack([
+        0.5 + radii * tf.sin(angles),
+        0.5 + radii * tf.cos(angles),
+    ], axis=-1)
+
+
+def polygon_mask(polygon: tf.Tensor, height, width) -> tf.Tensor:
+    """
+    Rasterises polygons with the even-odd rule.
+
+    ``polygon`` holds ``(row, col)`` pixel coordinates of shape
+    ``[..., num_points, 2]``. Returns a boolean mask of shape
+    ``[..., height, width]``.
+    """
+    rows = tf.cast(tf.range(height), tf.float32)[:, None]
+    cols = tf.cast(tf.range(width), tf.float32)[None, :]
+
+    y_i = polygon[..., 0][..., None, None]
+    x_i = polygon[..., 1][..., None, None]
+    y_j = tf.roll(polygon[..., 0], shift=1, axis=-1)[..., None, None]
+    x_j = tf.roll(polygon[..., 1], shift=1, axis=-1)[..., None, None]
+
+    crosses = tf.not_equal(y_i > rows, y_j > rows)
+    x_cross = tf.math.divide_no_nan(
+        (x_j - x_i) * (rows - y_i),
+        y_j - y_i
+    ) + x_i
+    inside = tf.logical_and(crosses, cols < x_cross)
+
+    return tf.math.floormod(
+        tf.reduce_sum(tf.cast(inside, tf.int32), axis=-3),
+        2
+    ) == 1
+
+
+def sample_more_likely_in_the_middle(
+        range_length,
+        seed: tf.Tensor,
+        shape=()
+) -> tf.Tensor:
+    """
+    Graph version of ``utils.sample_more_likely_in_the_middle``.
+    Draws from a beta(5, 5) distribution as the ratio of two gamma samples.
+    """
+    epsilon = 0.000001
+    x_seed, y_seed = split_seed(seed, 2)
+    x = tf.random.stateless_gamma(shape, x_seed, alpha=5.)
+    y = tf.random.stateless_gamma(shape, y_seed, alpha=5.)
+    percentage = tf.clip_by_value(x / (x + y), 0, 1 - epsilon)
+    return tf.cast(
+        percentage * tf.cast(range_length, tf.float32),
+        tf.int32
+    )
+
+
+def gaussian_blur(
+        mask: tf.Tensor,
+        sizes: Optional[tf.Tensor] = None
+) -> tf.Tensor:
+    """
+    3x3 gaussian blur of a ``[..., height, width, 1]`` float mask, same
+    kernel and border handling as ``cv2.GaussianBlur(mask, (3, 3), 0)``.
+    For a batch, ``sizes`` is the extent of each square mask, its border
+    is reflected there instead of at the end of the tensor.
+    """
+    kernel = tf.constant([0.25, 0.5, 0.25])
+    kernel = (kernel[:, None] * kernel[None, :])[..., None, None]
+
+    batched = len(mask.shape) == 4
+    if not batched:
+        mask = mask[None]
+    if sizes is None:
+        mask = tf.pad(mask, [[0, 0], [1, 1], [1, 1], [0, 0]], mode="REFLECT")
+    else:
+        max_size = tf.shape(mask)[1]
+        sizes = sizes[:, None]
+        indices = tf.abs(tf.range(-1, max_size + 1)[None])
+        indices = tf.where(indices >= sizes, 2 * sizes - 2 - indices, indices)
+        indices = tf.clip_by_value(indices, 0, max_size - 1)
+        mask = tf.gather(mask, indices, axis=1, batch_dims=1)
+        mask = tf.gather(mask, indices, axis=2, batch_dims=1)
+    mask = tf.nn.conv2d(mask, kernel, strides=1, padding="VALID")
+    return mask if batched else mask[0]
+
+
+def blend_weights(mask, sizes=None) -> tf.Tensor:
+    """
+    Blurred ``[..., 1]`` foreground weight of a boolean mask, quantised
+    to 8 bit like ``utils.blend_merge``.
+    """
+    mask = tf.cast(mask, tf.float32)[..., None]
+    return tf.round(gaussian_blur(mask, sizes) * 255) / 255
+
+
+def blend(foreground, background, weights) -> tf.Tensor:
+    return tf.clip_by_value(
+        tf.round(foreground * weights) + tf.round(background * (1 - weights)),
+        0,
+        255
+    )
+
+
+def blend_merge(foreground, background, mask) -> tf.Tensor:
+    """
+    Graph version of ``utils.blend_merge``.
+    Expects float images in ``[0, 255]`` and a boolean mask.
+    """
+    return blend(foreground, background, blend_weights(mask))
+
+
+def numpy_rng(seed: np.ndarray) -> np.random.Generator:
+    """
+    NumPy generator of a ``[2]`` stateless seed. Its int64 words are
+    reinterpreted as uint64, NumPy rejects negative seeds.
+    """
+    return np.random.default_rng(
+        np.asarray(seed, dtype=np.int64).view(np.uint64)
+    )
+
+
+def apply_transform(
+        transform: Optional["A.Compose"],
+        image: tf.Tensor,
+        seed: tf.Tensor
+) -> tf.Tensor:
+    """
+    Runs an albumentations transform on a ``[0, 255]`` float image.
+    Empty compositions are skipped, any other transform has to leave
+    the graph through ``tf.numpy_function``.
+    """
+    if is_identity(transform):
+        return image
+
+    def run(np_img, np_seed):
+        return apply_albumentations(
+            numpy_rng(np_seed),
+            transform,
+            image=np_img.astype(np.uint8)
+        )['image']
+
+    result = tf.numpy_function(
+        run,
+        [tf.cast(image, tf.uint8), seed],
+        tf.uint8
+    )
+    result.set_shape(image.shape)
+    return tf.cast(result, tf.float32)
+
+
+def apply_transform_batch(
+        transform: Optional["A.Compose"],
+        images: tf.Tensor,
+        seeds: tf.Tensor
+) -> tf.Tensor:
+    """
+    Batched ``apply_transform``. Non-empty transforms are applied
+    to every image of the ``[batch, height, width, 3]`` tensor in turn,
+    each with its own seed of the ``[batch, 2]`` ``seeds``.
+    """
+    if is_identity(transform):
+        return images
+
+    def run(np_images, np_seeds):
+        return np.stack([
+            apply_albumentations(
+                numpy_rng(np_seed),
+                transform,
+                image=np_img
+            )['image']
+            for np_img, np_seed in zip(np_images, np_seeds)
+        ]).astype(np.uint8)
+
+    result = tf.numpy_function(
+        run,
+        [tf.cast(images, tf.uint8), seeds],
+        tf.uint8
+    )
+    result.set_shape(images.shape)
+    return tf.cast(result, tf.float32)
+
+
+def _anomaly_parameters(
+        size_seed,
+        src_y_seed,
+        src_x_seed,
+        dest_y_seed,
+        dest_x_seed,
+        polygon_seed,
+        img_height,
+        img_width,
+        width: int,
+        anomaly_size: Optional[int] = None,
+):
+    """
+    Size, source and destination corner and ``[20, 2]`` unit polygon
+    of the anomaly of one element.
+    """
+    if anomaly_size is None:
+        size = tf.random.stateless_uniform(
+            [],
+            size_seed,
+            width // 8,
+            width // 4,
+            dtype=tf.int32
+        )
+    else:
+        size = tf.constant(anomaly_size, tf.int32)
+
+    return (
+        size,
+        sample_more_likely_in_the_middle(img_height - size, src_y_seed),
+        sample_more_likely_in_the_middle(img_width - size, src_x_seed),
+        sample_more_likely_in_the_middle(img_height - size, dest_y_seed),
+        sample_more_likely_in_the_middle(img_width - size, dest_x_seed),
+        random_polygon(20, polygon_seed),
+    )
+
+
+def create_anomalies(
+        good_image: tf.Tensor,
+        future_anomaly_image: tf.Tensor,
+        element_seed: tf.Tensor,
+        width: int,
+        create_artificial_anomalies=True,
+        anomaly_size: Optional[int] = None,
+        global_transform: Optional["A.Compose"] = None,
+        process_deviation: Optional["A.Compose"] = None,
+        anomaly_composition: Optional["A.Compose"] = None,
+):
+    """
+    Graph version of ``DatasetBuilder._create_anomalies``.
+
+    Takes two ``[height, width, 3]`` images with values in ``[0, 255]`` and
+    the ``(seed, epoch, index)`` of the element. Returns
+    ``(original, result, onehot_mask)`` as float32, images scaled
+    to ``[0, 1]``.
+    """
+    (
+        global_seed,
+        deviation_seed,
+        size_seed,
+        src_y_seed,
+        src_x_seed,
+        dest_y_seed,
+        dest_x_seed,
+        composition_seed,
+        polygon_seed,
+    ) = split_seed(stateless_seed(element_seed), 9)
+
+    orig_img = apply_transform(
+        global_transform,
+        tf.floor(tf.cast(good_image, tf.float32)),
+        global_seed
+    )
+    np_img = apply_transform(
+        process_deviation,
+        tf.floor(tf.cast(future_anomaly_image, tf.float32)),
+        deviation_seed
+    )
+
+    image_shape = tf.shape(np_img)
+    img_height, img_width = image_shape[0], image_shape[1]
+    fg_label = tf.zeros([img_height, img_width, 1])
+
+    if create_artificial_anomalies:
+        size, src_y, src_x, dest_y, dest_x, polygon = _anomaly_parameters(
+            size_seed,
+            src_y_seed,
+            src_x_seed,
+            dest_y_seed,
+            dest_x_seed,
+            polygon_seed,
+            img_height,
+            img_width,
+            width,
+            anomaly_size
+        )
+
+        crop = tf.image.crop_to_bounding_box(np_img, src_y, src_x, size, size)
+        crop = apply_transform(anomaly_composition, crop, composition_seed)
+
+        polygon = polygon * tf.cast(size, tf.float32)
+        mask = polygon_mask(polygon, size, size)
+
+        background = tf.image.crop_to_bounding_box(
+            np_img, dest_y, dest_x, size, size
+        )
+        blended = blend_merge(crop, background, mask)
+
+        region = tf.image.pad_to_bounding_box(
+            tf.ones([size, size, 1]), dest_y, dest_x, img_height, img_width
+        )
+        np_img = np_img * (1 - region) + tf.image.pad_to_bounding_box(
+            blended, dest_y, dest_x, img_height, img_width
+        )
+        fg_label = tf.image.pad_to_bounding_box(
+            tf.cast(mask, tf.float32)[..., None],
+            dest_y, dest_x, img_height, img_width
+        )
+
+    fg_label = fg_label[..., 0]
+    onehot_mask = tf.stack([1 - fg_label, fg_label], axis=-1)
+
+    return (
+        orig_img / 255,
+        np_img / 255,
+        onehot_mask
+    )
+
+
+def _compose_patches(
+        transform: Optional["A.Compose"],
+        seeds,
+        images,
+        shifted,
+        sizes,
+        src_y,
+        src_x,
+        dest_y,
+        dest_x
+):
+    shifted = shifted.copy()
+    for b, (seed, size, sy, sx, dy, dx) in enumerate(
+            zip(seeds, sizes, src_y, src_x, dest_y, dest_x)
+    ):
+        crop = images[b, sy:sy + size, sx:sx + size]
+        crop = apply_albumentations(
+            numpy_rng(seed),
+            transform,
+            image=crop
+        )['image']
+        shifted[b, dy:dy + size, dx:dx + size] = crop
+    return shifted
+
+
+def create_anomalies_batch(
+        good_images: tf.Tensor,
+        future_anomaly_images: tf.Tensor,
+        element_seeds: tf.Tensor,
+        width: int,
+        create_artificial_anomalies=True,
+        anomaly_size: Optional[int] = None,
+        global_transform: Optional["A.Compose"] = None,
+        process_deviation: Optional["A.Compose"] = None,
+        anomaly_composition: Optional["A.Compose"] = None,
+):
+    """
+    Vectorized version of ``create_anomalies`` for a whole batch.
+
+    Takes two ``[batch, height, width, 3]`` tensors with values in
+    ``[0, 255]``. Slice positions, polygon masks, blending and
+    one-hot masks are computed for the whole batch at once: polygons are
+    rasterised at the size of the largest patch and gathered to their
+    paste position, and the source patch is moved there with one
+    ``tf.gather_nd``.
+
+    ``element_seeds`` holds the ``(seed, epoch, index)`` of every element.
+    Every element draws its anomaly from its own seed, exactly like
+    ``create_anomalies``, so it does not depend on the batch it is in.
+    Returns ``(original, result, onehot_mask)`` batches as float32.
+    """
+    (
+        global_seed,
+        deviation_seed,
+        size_seed,
+        src_y_seed,
+        src_x_seed,
+        dest_y_seed,
+        dest_x_seed,
+        composition_seed,
+        polygon_seed,
+    ) = tf.unstack(tf.map_fn(
+        lambda element_seed: tf.stack(
+            split_seed(stateless_seed(element_seed), 9)
+        ),
+        tf.cast(element_seeds, tf.int64),
+        fn_output_signature=tf.TensorSpec([9, 2], tf.int64)
+    ), num=9, axis=1)
+
+    orig_img = apply_transform_batch(
+        global_transform,
+        tf.floor(tf.cast(good_images, tf.float32)),
+        global_seed
+    )
+    np_img = apply_transform_batch(
+        process_deviation,
+        tf.floor(tf.cast(future_anomaly_images, tf.float32)),
+        deviation_seed
+    )
+
+    image_shape = tf.shape(np_img)
+    batch_size, img_height, img_width = (
+        image_shape[0], image_shape[1], image_shape[2]
+    )
+    fg_label = tf.zeros([batch_size, img_height, img_width])
+
+    if create_artificial_anomalies:
+        # Only the few scalar draws run per element
+        sizes, src_y, src_x, dest_y, dest_x, polygons = tf.map_fn(
+            lambda seeds: _anomaly_parameters(
+                *seeds,
+                img_height,
+                img_width,
+                width,
+                anomaly_size
+            ),
+            (
+                size_seed,
+                src_y_seed,
+                src_x_seed,
+                dest_y_seed,
+                dest_x_seed,
+                polygon_seed,
+            ),
+            fn_output_signature=(
+                *[tf.TensorSpec([], tf.int32)] * 5,
+                tf.TensorSpec([20, 2], tf.float32),
+            )
+        )
+
+        # Move every source patch onto its destination in one gather
+        rows = tf.range(img_height)[None, :, None] + (src_y - dest_y)[
+            :, None, None]
+        cols = tf.range(img_width)[None, None, :] + (src_x - dest_x)[
+            :, None, None]
+        grid_shape = [batch_size, img_height, img_width]
+        indices = tf.stack([
+            tf.broadcast_to(tf.range(batch_size)[:, None, None], grid_shape),
+            tf.broadcast_to(tf.clip_by_value(rows, 0, img_height - 1),
+                            grid_shape),
+            tf.broadcast_to(tf.clip_by_value(cols, 0, img_width - 1),
+                            grid_shape),
+        ], axis=-1)
+        shifted = tf.gather_nd(np_img, indices)
+
+        if not is_identity(anomaly_composition):
+            shifted = tf.numpy_function(
+                lambda *args: _compose_patches(anomaly_composition, *args),
+                [
+                    composition_seed,
+                    tf.cast(np_img, tf.uint8),
+                    tf.cast(shifted, tf.uint8),
+                    sizes, src_y, src_x, dest_y, dest_x
+                ],
+                tf.uint8
+            )
+            shifted.set_shape(np_img.shape)
+            shifted = tf.cast(shifted, tf.float32)
+
+        # Rasterise and blur the polygons at patch size, the largest patch
+        # of the batch, and gather them to their destination
+        max_size = tf.reduce_max(sizes)
+        polygons = polygons * tf.cast(sizes, tf.float32)[:, None, None]
+        patch_masks = polygon_mask(polygons, max_size, max_size)
+        patch_weights = blend_weights(patch_masks, sizes)
+
+        row_range = tf.range(img_height)[None, :, None]
+        col_range = tf.range(img_width)[None, None, :]
+        patch_indices = tf.stack([
+            tf.broadcast_to(tf.range(batch_size)[:, None, None], grid_shape),
+            tf.broadcast_to(
+                tf.clip_by_value(
+                    row_range - dest_y[:, None, None], 0, max_size - 1
+                ),
+                grid_shape
+            ),
+            tf.broadcast_to(
+                tf.clip_by_value(
+                    col_range - dest_x[:, None, None], 0, max_size - 1
+                ),
+                grid_shape
+            ),
+        ], axis=-1)
+
+        box = tf.logical_and(
+            tf.logical_and(
+                row_range >= dest_y[:, None, None],
+                row_range < (dest_y + sizes)[:, None, None]
+            ),
+            tf.logical_and(
+                col_range >= dest_x[:, None, None],
+                col_range < (dest_x + sizes)[:, None, None]
+            )
+        )
+        mask = tf.logical_and(tf.gather_nd(patch_masks, patch_indices), box)
+
+        blended = blend(
+            shifted, np_img, tf.gather_nd(patch_weights, patch_indices)
+        )
+        box = tf.cast(box, tf.float32)[..., None]
+        np_img = np_img * (1 - box) + blended * box
+        fg_label = tf.cast(mask, tf.float32)
+
+    onehot_mask = tf.stack([1 - fg_label, fg_label], axis=-1)
+
+    return (
+        orig_img / 255,
+        np_img / 255,
+        onehot_mask
+    )
@@ -0,0 +1,59 @@
+"""
+Device side counterparts of the compact output modes of
+``tfds_defect_detection.load``.
+
+Datasets loaded with ``output_dtype="uint8"`` and ``mask_format="uint8"``
+or ``"bool"`` move a quarter of the bytes to the accelerator. The helpers
+here restore float images and one-hot masks as part of the model, so the
+conversion runs on the device.
+
+.. code-block:: python
+
+    inputs = tf.keras.Input((256, 256, 3), dtype=tf.uint8)
+    x = ImageNormalization()(inputs)
+"""
+import tensorflow as tf
+
+
+def normalize(images, dtype=tf.float32, scale=1 / 255, offset=0.):
+    """
+    Casts ``images`` to ``dtype`` and maps them to
+    ``images * scale + offset``. With the defaults uint8 images in
+    ``[0, 255]`` become float images in ``[0, 1]``.
+    """
+    images = tf.cast(images, dtype)
+    return images * tf.cast(scale, dtype) + tf.cast(offset, dtype)
+
+
+def onehot_mask(masks, dtype=tf.float32):
+    """
+    Expands single-channel foreground masks ``[..., 1]`` of dtype uint8 or
+    bool into two-channel ``[..., 2]`` (background, foreground) masks.
+    """
+    foreground = tf.cast(tf.cast(masks, tf.bool), dtype)
+    return tf.concat([1 - foreground, foreground], axis=-1)
+
+
+class ImageNormalization(tf.keras.layers.Layer):
+    """
+    Keras layer applying ``normalize``. Uses the compute dtype of the
+    layer, so it follows a mixed precision policy.
+    """
+
+    def __init__(self, scale=1 / 255, offset=0., **kwargs):
+        super().__init__(**kwargs)
+        self.scale = scale
+        self.offset = offset
+
+    def call(self, inputs):
+        return normalize(
+            inputs,
+            dtype=self.compute_dtype,
+            scale=self.scale,
+            offset=self.offset
+        )
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"scale": self.scale, "offset": self.offset})
+        return config
@@ -0,0 +1,242 @@
+"""
+Persistent file index of a prepared dataset.
+
+``write_manifest`` lists the folders of a prepared dataset once and
+records every image with its class, file size, image dimensions, a
+stable split key and its mask, if it has one, in
+``<dataset_dir>/manifest.json``, together with the modification times of
+all listed directories. ``Manifest.load`` returns
+the index as long as none of these directories changed, so building a
+``DatasetBuilder`` costs a few ``stat`` calls instead of directory scans.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from tfds_defect_detection.utils import index_directory, pair_mask_paths
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
+
+def split_key(relative_path: str) -> float:
+    """
+    Stable number in ``[0, 1)`` of a file path. Files with a key below
+    ``validation_split`` belong to the validation split, independent of
+    the seed and of files added or removed later.
+    """
+    digest = hashlib.sha1(Path(relative_path).as_posix().encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def _image_dimensions(path: str) -> Tuple[Optional[int], Optional[int]]:
+    import PIL.Image
+
+    try:
+        # Only reads the header
+        with PIL.Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+
+def _directory_mtimes(folder: Path) -> Dict[str, int]:
+    return {
+        os.path.relpath(root, folder): os.stat(root).st_mtime_ns
+        for root, _, _ in os.walk(folder)
+    }
+
+
+def write_manifest(
+        dataset_dir: Path,
+        folders: Iterable[str] = ("train_images", "test_images", "test_masks"),
+        num_threads=16,
+        mask_folders: Optional[Dict[str, str]] = None,
+) -> Path:
+    """
+    Writes ``<dataset_dir>/manifest.json`` for ``folders``.
+    Image headers are read with ``num_threads`` threads.
+
+    ``mask_folders`` maps image folders to their mask folder, by default
+    ``test_images`` to ``test_masks``. Each image of such a folder records
+    the path of its mask relative to the mask folder, or ``None`` if it has
+    no defect, see ``tfds_defect_detection.utils.pair_mask_paths``.
+
+    Returns the path of the manifest.
+    """
+    folders = list(folders)
+    if mask_folders is None:
+        mask_folders = {"test_images": "test_masks"}
+
+    listings = {
+        folder: index_directory(dataset_dir / folder, shuffle=False)
+        for folder in folders
+        if (dataset_dir / folder).is_dir()
+    }
+    manifest = {"version": MANIFEST_VERSION, "folders": {}}
+    for folder, (paths, labels, class_names) in listings.items():
+        folder_dir = dataset_dir / folder
+        with ThreadPoolExecutor(num_threads) as pool:
+            dimensions = list(pool.map(_image_dimensions, paths))
+
+        mask_folder = mask_folders.get(folder)
+        masks = None
+        if mask_folder in listings:
+            masks = pair_mask_paths(
+                paths,
+                folder_dir,
+                dataset_dir / mask_folder,
+                existing=listings[mask_folder][0]
+            )
+
+        files = []
+        for i, (path, label, (width, height)) in enumerate(
+                zip(paths, labels, dimensions)
+        ):
+            relative = os.path.relpath(path, folder_dir)
+            entry = {
+                "path": relative,
+                "label": int(label),
+                "size": os.path.getsize(path),
+                "width": width,
+                "height": height,
+                "split_key": split_key(relative),
+            }
+            if masks is not None:
+                entry["mask"] = (
+                    os.path.relpath(masks[i], dataset_dir / mask_folder)
+                    if masks[i] else None
+                )
+            files.append(entry)
+
+        manifest["folders"][folder] = {
+            "class_names": class_names,
+            "mask_folder": mask_folder if masks is not None else None,
+            "directories": _directory_mtimes(folder_dir),
+            "files": files,
+        }
+
+    manifest_file = dataset_dir / MANIFEST_NAME
+    tmp_file = manifest_file.with_suffix(".tmp.json")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+
+class Manifest:
+    """
+    Read-only view on a manifest written by ``write_manifest``.
+    """
+
+    def __init__(self, dataset_dir: Path, data: dict):
+        self.dataset_dir = dataset_dir
+        self.data = data
+
+    @classmethod
+    def load(cls, dataset_dir: Path) -> Optional["Manifest"]:
+        """
+        The manifest of ``dataset_dir``, or ``None`` if there is none or
+        a directory changed since it was written.
+        """
+        manifest_file = dataset_dir / MANIFEST_NAME
+        if not manifest_file.is_file():
+            return None
+        with open(manifest_file) as f:
+            data = json.load(f)
+        manifest = cls(dataset_dir, data)
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+        if not manifest.is_current():
+            return None
+        return manifest
+
+    def is_current(self) -> bool:
+        for folder, entry in self.data["folders"].items():
+            for directory, mtime in entry["directories"].items():
+                try:
+                    current = os.stat(
+                        self.dataset_dir / folder / directory
+                    ).st_mtime_ns
+                except OSError:
+                    return False
+                if current != mtime:
+                    return False
+        return True
+
+    def covers(self, directory: Path) -> bool:
+        directory = Path(directory)
+        return (
+            directory.name in self.data["folders"]
+            and os.path.samefile(directory.parent, self.dataset_dir)
+        )
+
+    def class_names(self, directory: Path) -> List[str]:
+        return self.data["folders"][Path(directory).name]["class_names"]
+
+    def mask_paths(
+            self,
+            file_paths: np.ndarray,
+            directory: Path,
+            mask_directory: Path
+    ) -> Optional[np.ndarray]:
+        """
+        Masks of ``file_paths`` in ``directory``, as recorded when the
+        manifest was written, with ``""`` for images without a defect.
+        ``None`` if the manifest does not pair ``directory`` with
+        ``mask_directory``.
+        """
+        entry = self.data["folders"][Path(directory).name]
+        mask_directory = Path(mask_directory)
+        if (
+                entry.get("mask_folder") != mask_directory.name
+                or not self.covers(mask_directory)
+        ):
+            return None
+        masks = {
+            file["path"]: file["mask"]
+            for file in entry["files"]
+        }
+        mask_paths = []
+        for path in file_paths:
+            mask = masks[os.path.relpath(path, directory)]
+            mask_paths.append(
+                "" if mask is None else os.path.join(str(mask_directory), mask)
+            )
+        return np.asarray(mask_paths, dtype=str)
+
+    def num_files(self, directory: Path) -> int:
+        return len(self.data["folders"][Path(directory).name]["files"])
+
+    def index_directory(
+            self,
+            directory: Path,
+            seed: Optional[int] = None,
+            shuffle=True
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+        """
+        Same listing as ``tfds_defect_detection.utils.index_directory``,
+        without touching the file system.
+
+        Returns ``(file_paths, labels, split_keys, class_names)``.
+        """
+        entry = self.data["folders"][Path(directory).name]
+        files = entry["files"]
+        file_paths = np.asarray(
+            [os.path.join(str(directory), file["path"]) for file in files],
+            dtype=str
+        )
+        labels = np.asarray([file["label"] for file in files], dtype=np.int64)
+        split_keys = np.asarray(
+            [file["split_key"] for file in files],
+            dtype=np.float64
+        )
+        if shuffle:
+            for array in (file_paths, labels, split_keys):
+                np.random.RandomState(seed).shuffle(array)
+        return file_paths, labels, split_keys, entry["class_names"]
@@ -0,0 +1,219 @@
+"""
+Memory-mapped store of pre-resized images.
+
+``prepare_image_store`` decodes and resizes every image and mask of a
+prepared dataset once and writes them into one contiguous uint8 ``.npy``
+file per resolution, next to an index of file names, class labels and
+offsets. ``ImageStore`` maps that file read-only, so reading an image is a
+slice of the page cache, shared by all processes on the node.
+
+The index records a fingerprint of the stored files, taken from the
+manifest of the dataset if it is current, else from their paths, sizes
+and modification times. A store whose files changed is rebuilt by
+``prepare_image_store`` and not opened by ``ImageStore.open``.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Iterable, Dict
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from tfds_defect_detection.utils import index_directory, load_image
+
+MASK_FOLDERS = ("test_masks",)
+
+
+def store_name(width: int, height: int, crop_to_aspect_ratio=False) -> str:
+    suffix = "_cropped" if crop_to_aspect_ratio else ""
+    return f"store_{width}x{height}{suffix}"
+
+
+def source_fingerprint(
+        dataset_dir: Path,
+        folders: Iterable[str]
+) -> str:
+    """
+    Hash of the path, size and modification time of every image of
+    ``folders``. With a current manifest of all ``folders`` it is the
+    hash of their manifest entries instead, which costs a few ``stat``
+    calls rather than a scan of the folders.
+    """
+    from tfds_defect_detection.manifest import Manifest
+
+    folders = [
+        folder for folder in folders if (dataset_dir / folder).is_dir()
+    ]
+    manifest = Manifest.load(dataset_dir)
+    if manifest is not None and all(
+            folder in manifest.data["folders"] for folder in folders
+    ):
+        return "manifest:" + hashlib.sha1(json.dumps(
+            [manifest.data["folders"][folder] for folder in folders],
+            sort_keys=True
+        ).encode()).hexdigest()
+
+    digest = hashlib.sha1()
+    for folder in folders:
+        paths, _, _ = index_directory(dataset_dir / folder, shuffle=False)
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(
+                f"{os.path.relpath(path, dataset_dir)}\0{stat.st_size}\0"
+                f"{stat.st_mtime_ns}\n".encode()
+            )
+    return digest.hexdigest()
+
+
+def _is_current(index_file: Path, dataset_dir: Path) -> bool:
+    with open(index_file) as f:
+        index = json.load(f)
+    return index.get("fingerprint") == source_fingerprint(
+        dataset_dir,
+        index["folders"]
+    )
+
+
+def prepare_image_store(
+        dataset_dir: Path,
+        width=256,
+        height=256,
+        crop_to_aspect_ratio=False,
+        folders: Iterable[str] = ("train_images", "test_images", "test_masks"),
+        num_parallel_calls=tf.data.AUTOTUNE,
+) -> Path:
+    """
+    Writes ``<dataset_dir>/<store_name>.npy`` with all images of
+    ``folders`` resized to ``width`` x ``height`` and the index
+    ``<store_name>.json``. Skips the work if the store exists and none of
+    its files changed since.
+
+    Returns the path of the index.
+    """
+    folders = list(folders)
+    name = store_name(width, height, crop_to_aspect_ratio)
+    data_file = dataset_dir / f"{name}.npy"
+    index_file = dataset_dir / f"{name}.json"
+    if (
+            index_file.is_file()
+            and data_file.is_file()
+            and _is_current(index_file, dataset_dir)
+    ):
+        return index_file
+
+    listings = {
+        folder: index_directory(dataset_dir / folder, shuffle=False)
+        for folder in folders
+        if (dataset_dir / folder).is_dir()
+    }
+    num_images = sum(len(paths) for paths, _, _ in listings.values())
+
+    tmp_file = data_file.with_suffix(".tmp.npy")
+    data = np.lib.format.open_memmap(
+        tmp_file,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(num_images, width, height, 3)
+    )
+    row_bytes = width * height * 3
+    index = {
+        "width": width,
+        "height": height,
+        "crop_to_aspect_ratio": crop_to_aspect_ratio,
+        "data_offset": int(data.offset),
+        "row_bytes": row_bytes,
+        "fingerprint": source_fingerprint(dataset_dir, listings),
+        "folders": {},
+    }
+
+    row = 0
+    for folder, (paths, labels, class_names) in listings.items():
+        interpolation = "nearest" if folder in MASK_FOLDERS else "bilinear"
+        images = tf.data.Dataset.from_tensor_slices(paths).map(
+            lambda path: tf.cast(tf.clip_by_value(tf.round(load_image(
+                path,
+                image_size=(width, height),
+                interpolation=interpolation,
+                crop_to_aspect_ratio=crop_to_aspect_ratio
+            )), 0, 255), tf.uint8),
+            num_parallel_calls=num_parallel_calls
+        )
+        first_row = row
+        for image in tqdm(
+                images.as_numpy_iterator(),
+                total=len(paths),
+                desc=f"Storing {folder} at {width}x{height}"
+        ):
+            data[row] = image
+            row += 1
+
+        index["folders"][folder] = {
+            "class_names": class_names,
+            "files": [
+                os.path.relpath(path, dataset_dir / folder)
+                for path in paths
+            ],
+            "labels": labels.tolist(),
+            "rows": list(range(first_row, row)),
+        }
+
+    data.flush()
+    del data
+    os.replace(tmp_file, data_file)
+
+    # The index is written last and marks the store as complete
+    tmp_index = index_file.with_suffix(".tmp.json")
+    with open(tmp_index, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_index, index_file)
+    return index_file
+
+
+class ImageStore:
+    """
+    Read-only view on a store written by ``prepare_image_store``.
+    """
+
+    def __init__(self, index_file: Path):
+        with open(index_file) as f:
+            self.index = json.load(f)
+        self.root = index_file.parent
+        self.array = np.load(index_file.with_suffix(".npy"), mmap_mode="r")
+
+    @classmethod
+    def open(
+            cls,
+            dataset_dir: Path,
+            width: int,
+            height: int,
+            crop_to_aspect_ratio=False
+    ) -> Optional["ImageStore"]:
+        """
+        The store of ``dataset_dir`` at that size, or ``None`` if there
+        is none or its files changed since it was written.
+        """
+        index_file = dataset_dir / (
+            store_name(width, height, crop_to_aspect_ratio) + ".json"
+        )
+        if not index_file.is_file():
+            return None
+        if not _is_current(index_file, dataset_dir):
+            return None
+        return cls(index_file)
+
+    def rows_by_path(self) -> Dict[str, int]:
+        """
+        Store row of every file, keyed by the path
+        ``tfds_defect_detection.utils.index_directory`` lists it with.
+        """
+        return {
+            os.path.join(str(self.root / folder), file): row
+            for folder, listing in self.index["folders"].items()
+            for file, row in zip(listing["files"], listing["rows"])
+        }
+
+    def __getitem__(self, row) -> np.ndarray:
+        return self.array[row]
@@ -0,0 +1,680 @@
+import copy
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from collections import deque, OrderedDict
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Optional, Iterable, Iterator, Tuple, Callable, Sequence, \
+    TYPE_CHECKING
+
+import numpy as np
+from typing_extensions import Literal
+
+from tfds_defect_detection.utils import random_slice, blend_merge
+
+# albumentations and skimage are imported where they are used,
+# worker processes and the downloaders don't pay for them
+if TYPE_CHECKING:
+    import albumentations as A
+
+_GLOBAL_RANDOM_LOCK = threading.Lock()
+_THREAD_LOCAL = threading.local()
+
+
+def element_rngs(
+        element_seed: Optional[Sequence[int]],
+        num_streams: int
+) -> list:
+    """
+    Independent random streams for one dataset element.
+
+    ``element_seed`` is the ``(seed, epoch, index)`` of the element.
+    Without a seed the streams draw fresh entropy.
+    """
+    seed_sequence = np.random.SeedSequence(
+        None if element_seed is None else [int(i) for i in element_seed]
+    )
+    return [
+        np.random.default_rng(child)
+        for child in seed_sequence.spawn(num_streams)
+    ]
+
+
+def with_global_seed(rng: np.random.Generator, function: Callable, *args,
+                     **kwargs):
+    """
+    Calls ``function`` with the global ``random`` and ``np.random`` state
+    seeded from ``rng``.
+
+    The call holds a lock, so concurrent threads can't interleave their
+    draws, and the previous global state is restored afterwards.
+    """
+    python_seed, numpy_seed = rng.integers(0, 2 ** 32, size=2)
+    with _GLOBAL_RANDOM_LOCK:
+        python_state = random.getstate()
+        numpy_state = np.random.get_state()
+        random.seed(int(python_seed))
+        np.random.seed(int(numpy_seed))
+        try:
+            return function(*args, **kwargs)
+        finally:
+            random.setstate(python_state)
+            np.random.set_state(numpy_state)
+
+
+def apply_albumentations(
+        rng: np.random.Generator,
+        transform: "A.Compose",
+        **data
+) -> dict:
+    """
+    Calls ``transform`` with random state drawn from ``rng``.
+
+    Albumentations 1.4.21 and later take the random state explicitly.
+    Every thread then runs its own copy of ``transform``, so concurrent
+    calls neither share state nor wait for each other. Older versions
+    only draw from the global random state, which is seeded with
+    ``with_global_seed`` and serialises the calls.
+    """
+    if not hasattr(transform, "set_random_state"):
+        return with_global_seed(rng, transform, **data)
+
+    copies = getattr(_THREAD_LOCAL, "transforms", None)
+    if copies is None:
+        copies = _THREAD_LOCAL.transforms = {}
+    # The original is kept with its copy, so its id can't be reused
+    original, local_transform = copies.get(id(transform), (None, None))
+    if original is not transform:
+        local_transform = copy.deepcopy(transform)
+        copies[id(transform)] = (transform, local_transform)
+
+    python_seed, numpy_seed = rng.integers(0, 2 ** 32, size=2)
+    local_transform.set_random_state(
+        np.random.default_rng(int(numpy_seed)),
+        random.Random(int(python_seed))
+    )
+    return local_transform(**data)
+
+
+def _orientation(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> float:
+    return np.sign(
+        (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    )
+
+
+def _segments_cross(p1, p2, q1, q2) -> bool:
+    return (
+        _orientation(p1, p2, q1) != _orientation(p1, p2, q2)
+        and _orientation(q1, q2, p1) != _orientation(q1, q2, p2)
+    )
+
+
+def random_polygon(num_points: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Random simple polygon with ``num_points`` vertices in the unit
+    square, as a ``[num_points, 2]`` array.
+
+    Uniform random points are untangled with 2-opt moves: while two edges
+    cross, the path between them is reversed. Every move shortens the
+    perimeter, so the loop ends with a polygon that doesn't intersect
+    itself.
+    """
+    points = rng.random((num_points, 2))
+    untangled = False
+    while not untangled:
+        untangled = True
+        for i in range(num_points - 1):
+            for j in range(i + 2, num_points):
+                if i == 0 and j == num_points - 1:
+                    # The closing edge shares a vertex with the first one
+                    continue
+                if _segments_cross(
+                        points[i],
+                        points[i + 1],
+                        points[j],
+                        points[(j + 1) % num_points]
+                ):
+                    points[i + 1:j + 1] = points[i + 1:j + 1][::-1].copy()
+                    untangled = False
+    return points
+
+
+def is_identity(transform: Optional["A.Compose"]) -> bool:
+    """
+    Whether ``transform`` is ``None`` or an empty composition.
+    """
+    return transform is None or not len(transform.transforms)
+
+
+def _transform(
+        transform: Optional["A.Compose"],
+        image,
+        rng: np.random.Generator
+):
+    if is_identity(transform):
+        return image
+    return apply_albumentations(rng, transform, image=image)['image']
+
+
+class PolygonMaskBank:
+    """
+    Pre-rasterised random polygon masks, one bucket per anomaly size.
+
+    Rasterising a polygon with ``polygon2mask`` is one of the most
+    expensive steps of the synthesis. The bank rasterises
+    ``masks_per_size`` masks per size once, either up front with
+    ``warm_up`` or lazily on first use, and samples from them with random
+    flips and rotations. Masks are stored bit-packed.
+
+    Buckets are evicted least recently used as soon as the bank grows
+    beyond ``max_bytes``. If ``path`` is given, buckets are persisted
+    there and loaded again on later runs to skip the warm-up.
+
+    Every bucket is rasterised from ``(seed, size)``, so all copies of a
+    bank, e.g. in worker processes, hold the same masks.
+    """
+
+    def __init__(
+            self,
+            masks_per_size=1000,
+            max_bytes=256 * 2 ** 20,
+            num_points=20,
+            path: Optional[Path] = None,
+            seed=0,
+    ):
+        self.seed = seed
+        self.masks_per_size = masks_per_size
+        self.max_bytes = max_bytes
+        self.num_points = num_points
+        self.path = path
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(bucket.nbytes for bucket in self._buckets.values())
+
+    def _bucket_file(self, size: int) -> Path:
+        return Path(self.path) / (
+            f"polygon_masks_{size}px"
+            f"_{self.num_points}pts"
+            f"_{self.masks_per_size}"
+            f"_seed{self.seed}.npy"
+        )
+
+    def _rasterise(self, size: int) -> np.ndarray:
+        from skimage.draw import polygon2mask
+
+        rng = np.random.default_rng([self.seed, size])
+        masks = np.stack([
+            polygon2mask(
+                (size, size),
+                random_polygon(self.num_points, rng) * size
+            )
+            for _ in range(self.masks_per_size)
+        ])
+        return np.packbits(masks, axis=-1)
+
+    def _load_or_rasterise(self, size: int) -> np.ndarray:
+        if self.path is not None and self._bucket_file(size).is_file():
+            return np.load(self._bucket_file(size))
+
+        bucket = self._rasterise(size)
+        if self.path is not None:
+            self._save_bucket(size, bucket)
+        return bucket
+
+    def _save_bucket(self, size: int, bucket: np.ndarray):
+        target = self._bucket_file(size)
+        target.parent.mkdir(exist_ok=True, parents=True)
+        tmp = target.with_name(f"{target.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp, bucket)
+        os.replace(tmp, target)
+
+    def _bucket(self, size: int) -> np.ndarray:
+        with self._lock:
+            if size in self._buckets:
+                self._buckets.move_to_end(size)
+                return self._buckets[size]
+
+        bucket = self._load_or_rasterise(size)
+
+        with self._lock:
+            self._buckets[size] = bucket
+            self._buckets.move_to_end(size)
+            while self.nbytes > self.max_bytes and len(self._buckets) > 1:
+                self._buckets.popitem(last=False)
+        return bucket
+
+    def warm_up(self, sizes: Iterable[int]):
+        """
+        Rasterises (or loads) the buckets for all ``sizes`` up front.
+        """
+        for size in sizes:
+            self._bucket(size)
+        return self
+
+    def save(self):
+        """
+        Persists all buckets in memory to ``path``.
+        """
+        if self.path is None:
+            raise ValueError("PolygonMaskBank has no path to save to")
+        with self._lock:
+            buckets = list(self._buckets.items())
+        for size, bucket in buckets:
+            self._save_bucket(size, bucket)
+
+    def sample(
+            self,
+            size: int,
+            rng: Optional[np.random.Generator] = None
+    ) -> np.ndarray:
+        """
+        Boolean ``[size, size]`` polygon mask with a random flip
+        and rotation applied.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        bucket = self._bucket(size)
+        mask = np.unpackbits(
+            bucket[rng.integers(len(bucket))],
+            axis=-1,
+            count=size
+        ).astype(bool)
+        mask = np.rot90(mask, k=rng.integers(4))
+        if rng.integers(2):
+            mask = mask[:, ::-1]
+        return mask
+
+
+class AnomalySynthesizer:
+    """
+    Picklable cut-paste anomaly generator.
+
+    Holds everything ``DatasetBuilder._create_anomalies`` needs, so the same
+    synthesis can run in the tf.data pipeline or in a worker process.
+    Works on uint8 numpy images and returns
+    ``(original, result, foreground_mask)`` where both images are uint8
+    and the mask is a boolean array of the image height and width.
+    """
+
+    def __init__(
+            self,
+            width: int,
+            create_artificial_anomalies=True,
+            anomaly_size: Optional[int] = None,
+            global_transform: Optional["A.Compose"] = None,
+            process_deviation: Optional["A.Compose"] = None,
+            anomaly_composition: Optional["A.Compose"] = None,
+            polygon_mask_bank: Optional[PolygonMaskBank] = None,
+    ):
+        self.width = width
+        self.create_artificial_anomalies = create_artificial_anomalies
+        self.anomaly_size = anomaly_size
+        self.global_transform = global_transform
+        self.process_deviation = process_deviation
+        self.anomaly_composition = anomaly_composition
+        self.polygon_mask_bank = polygon_mask_bank
+
+    def __call__(
+            self,
+            good_image: np.ndarray,
+            future_anomaly_image: np.ndarray,
+            element_seed: Optional[Sequence[int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        All randomness is drawn from independent streams derived from
+        ``element_seed``, so the result only depends on the element and
+        not on the thread or process it is synthesized in.
+        """
+        (
+            global_rng,
+            deviation_rng,
+            geometry_rng,
+            composition_rng,
+            polygon_rng
+        ) = element_rngs(element_seed, 5)
+
+        orig_img = good_image.copy()
+        orig_img = _transform(
+            self.global_transform,
+            orig_img.astype(np.uint8),
+            global_rng
+        )
+
+        # Create a second image that should depict the
+        # same part, but has deviations
+        # which are within the process robustness
+        np_img = future_anomaly_image  # .copy()
+        np_img = _transform(
+            self.process_deviation,
+            np_img.astype(np.uint8),
+            deviation_rng
+        )
+
+        fg_label = np.zeros(np_img.shape[:2], dtype=bool)
+
+        if self.create_artificial_anomalies:
+            if self.anomaly_size is None:
+                anomaly_size = int(geometry_rng.integers(self.width // 8,
+                                                         self.width // 4))
+            else:
+                anomaly_size = self.anomaly_size
+
+            # Slice a part of the image that will be used to
+            # alter the image to the point
+            # where it becomes an anomaly
+            src_slice = random_slice(np_img, anomaly_size, rng=geometry_rng)
+            dest_slice = random_slice(np_img, anomaly_size, rng=geometry_rng)
+
+            crop = np_img[src_slice].copy()
+
+            # Randomly augment the cropped patch, including rotation
+            crop = _transform(
+                self.anomaly_composition,
+                crop.astype(np.uint8),
+                composition_rng
+            )
+
+            crop = crop.astype(np.float32)
+
+            # Masking the crop in the shape of a random polygon
+            if self.polygon_mask_bank is not None:
+                mask = self.polygon_mask_bank.sample(anomaly_size, polygon_rng)
+            else:
+                from skimage.draw import polygon2mask
+
+                polygon = random_polygon(20, polygon_rng) * anomaly_size
+                mask = polygon2mask((anomaly_size, anomaly_size), polygon)
+
+            # Blur the borders of the polygon, so it blends when pasted back
+            background = np_img[dest_slice].copy()
+            np_img[dest_slice] = blend_merge(crop, background, mask)
+            fg_label[dest_slice] = mask
+
+        return (
+            orig_img.astype(np.uint8),
+            np_img.astype(np.uint8),
+            fg_label
+        )
+
+
+class SharedMemoryRingBuffer:
+    """
+    Fixed number of slots in one shared memory block.
+
+    Every slot holds the element seed and the two uint8 input images of a
+    synthesis task and the uint8 outputs written back by the worker.
+    All arrays are numpy views on the shared block, so no image data is
+    pickled between processes.
+    """
+
+    def __init__(
+            self,
+            depth: int,
+            width: int,
+            height: int,
+            name: Optional[str] = None
+    ):
+        self.depth = depth
+        self.width = width
+        self.height = height
+
+        image_shape = (depth, width, height, 3)
+        mask_shape = (depth, width, height)
+        seed_shape = (depth, 3)
+        image_bytes = int(np.prod(image_shape))
+        mask_bytes = int(np.prod(mask_shape))
+        seed_bytes = int(np.prod(seed_shape)) * 8
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True,
+                size=seed_bytes + 4 * image_bytes + mask_bytes
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.seeds = np.ndarray(
+            seed_shape,
+            dtype=np.int64,
+            buffer=self.shm.buf
+        )
+        offsets = np.cumsum([seed_bytes] + [image_bytes] * 4)
+        self.good, self.future, self.original, self.result = [
+            np.ndarray(
+                image_shape,
+                dtype=np.uint8,
+                buffer=self.shm.buf,
+                offset=int(offset)
+            )
+            for offset in offsets[:4]
+        ]
+        self.mask = np.ndarray(
+            mask_shape,
+            dtype=np.uint8,
+            buffer=self.shm.buf,
+            offset=int(offsets[4])
+        )
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        # Drop the views before closing, the buffer can't be released
+        # while numpy arrays still reference it.
+        self.good = self.future = self.original = self.result = None
+        self.mask = self.seeds = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _synthesis_worker(
+        buffer_name: str,
+        depth: int,
+        width: int,
+        height: int,
+        synthesizer: AnomalySynthesizer,
+        tasks: multiprocessing.Queue,
+        done: multiprocessing.Queue,
+):
+    buffer = SharedMemoryRingBuffer(depth, width, height, name=buffer_name)
+    try:
+        while True:
+            slot = tasks.get()
+            if slot is None:
+                break
+            try:
+                original, result, mask = synthesizer(
+                    buffer.good[slot],
+                    buffer.future[slot].copy(),
+                    buffer.seeds[slot]
+                )
+                buffer.original[slot] = original
+                buffer.result[slot] = result
+                buffer.mask[slot] = mask
+                done.put((slot, None))
+            except Exception as e:
+                done.put((slot, repr(e)))
+    finally:
+        buffer.close()
+
+
+def default_start_method() -> str:
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return "forkserver"
+    return "spawn"
+
+
+class ProcessPoolSynthesizer:
+    """
+    Runs an ``AnomalySynthesizer`` in a pool of worker processes.
+
+    Inputs and outputs travel through a ``SharedMemoryRingBuffer`` with
+    ``buffer_depth`` slots, only slot indices are sent through the queues.
+    Results of ``imap`` are returned in input order.
+
+    Use as a context manager, or call ``start`` and ``close``.
+
+    ``start_method`` defaults to "forkserver" where available and "spawn"
+    otherwise. Forking a process that runs TensorFlow threads can
+    deadlock the workers.
+    """
+
+    def __init__(
+            self,
+            synthesizer: AnomalySynthesizer,
+            width: int,
+            height: int,
+            num_workers: Optional[int] = None,
+            buffer_depth=16,
+            start_method: Optional[Literal[
+                "fork",
+                "spawn",
+                "forkserver"
+            ]] = None,
+            timeout=1.0,
+    ):
+        self.synthesizer = synthesizer
+        self.width = width
+        self.height = height
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.buffer_depth = max(buffer_depth, self.num_workers)
+        self.start_method = start_method or default_start_method()
+        self.timeout = timeout
+
+        self._buffer: Optional[SharedMemoryRingBuffer] = None
+        self._workers = []
+        self._tasks = None
+        self._done = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self._buffer is not None:
+            return
+        context = multiprocessing.get_context(self.start_method)
+        self._buffer = SharedMemoryRingBuffer(
+            self.buffer_depth,
+            self.width,
+            self.height
+        )
+        self._tasks = context.Queue()
+        self._done = context.Queue()
+        self._workers = [
+            context.Process(
+                target=_synthesis_worker,
+                args=(
+                    self._buffer.name,
+                    self.buffer_depth,
+                    self.width,
+                    self.height,
+                    self.synthesizer,
+                    self._tasks,
+                    self._done,
+                ),
+                daemon=True
+            )
+            for _ in range(self.num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def close(self):
+        if self._buffer is None:
+            return
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5 * self.timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        for q in (self._tasks, self._done):
+            q.close()
+            q.join_thread()
+        self._buffer.close()
+        self._buffer.unlink()
+        self._buffer = None
+        self._workers = []
+
+    def _wait_for_slot(self):
+        while True:
+            try:
+                slot, error = self._done.get(timeout=self.timeout)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("A synthesis worker died unexpectedly")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Synthesis failed in worker: {error}")
+            return slot
+
+    def imap(
+            self,
+            pairs: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Synthesizes ``(good_image, future_anomaly_image, element_seed)``
+        triples.
+
+        Yields ``(original, result, mask)`` views on the shared buffer.
+        A view is only valid until the next item is requested,
+        copy it if you need to keep it.
+        """
+        self.start()
+        free = deque(range(self.buffer_depth))
+        pending = deque()
+        finished = set()
+        pairs = iter(pairs)
+        exhausted = False
+
+        while True:
+            while free and not exhausted:
+                try:
+                    good_image, future_anomaly_image, element_seed = next(
+                        pairs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = free.popleft()
+                self._buffer.seeds[slot] = element_seed
+                self._buffer.good[slot] = good_image
+                self._buffer.future[slot] = future_anomaly_image
+                self._tasks.put(slot)
+                pending.append(slot)
+
+            if not pending:
+                return
+
+            head = pending.popleft()
+            while head not in finished:
+                finished.add(self._wait_for_slot())
+            finished.remove(head)
+
+            yield (
+                self._buffer.original[head],
+                self._buffer.result[head],
+                self._buffer.mask[head]
+            )
+            free.append(head)
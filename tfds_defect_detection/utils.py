@@ -1,37 +1,191 @@
 import random
 import shutil
+import time
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Iterable, TYPE_CHECKING
 
-import cv2
 import numpy as np
-import tensorflow as tf
-from tqdm import tqdm
+from typing_extensions import Literal
 
+# TensorFlow and OpenCV are imported by the functions that use them, so
+# the downloaders and the numpy helpers import fast
+if TYPE_CHECKING:
+    import PIL.Image
+    import tensorflow as tf
 
-import os, sys
 
+import os
 
-class _HiddenPrints:
-    def __enter__(self):
-        self._original_stdout = sys.stdout
-        sys.stdout = open(os.devnull, 'w')
+ALLOWLIST_FORMATS = (".bmp", ".gif", ".jpeg", ".jpg", ".png")
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout.close()
-        sys.stdout = self._original_stdout
+# ioctl request of Linux to share the extents of a file (reflink)
+_FICLONE = 0x40049409
+
+
+def index_directory(
+        directory: Path,
+        seed: Optional[int] = None,
+        shuffle=True
+) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Lists the images of a directory with one subdirectory per class,
+    in the same order as ``keras.utils.image_dataset_from_directory``.
+
+    Returns ``(file_paths, labels, class_names)``.
+    """
+    class_names = sorted(
+        subdir.name
+        for subdir in Path(directory).iterdir()
+        if subdir.is_dir()
+    )
+    file_paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        walk = sorted(os.walk(Path(directory) / class_name),
+                      key=lambda x: x[0])
+        for root, _, files in walk:
+            for fname in sorted(files):
+                if fname.lower().endswith(ALLOWLIST_FORMATS):
+                    file_paths.append(os.path.join(root, fname))
+                    labels.append(label)
+
+    file_paths = np.asarray(file_paths, dtype=str)
+    labels = np.asarray(labels, dtype=np.int64)
+    if shuffle:
+        # Both shuffles need the same seed to keep the labels in place
+        if seed is None:
+            seed = np.random.randint(1e6)
+        np.random.RandomState(seed).shuffle(file_paths)
+        np.random.RandomState(seed).shuffle(labels)
+    return file_paths, labels, class_names
+
+
+def pair_mask_paths(
+        file_paths: np.ndarray,
+        image_directory: Path,
+        mask_directory: Path,
+        existing: Optional[Iterable[str]] = None
+) -> np.ndarray:
+    """
+    Mask of every image in ``file_paths``. The mask of
+    ``<image_directory>/<class>/<name>.<ext>`` is
+    ``<mask_directory>/<class>/<name>.png``, as written by the
+    downloaders, or a file with the same name as the image.
+
+    Images in a ``good`` folder may have no mask, they get ``""`` and
+    an empty mask, see ``DatasetBuilder``. Missing masks of other images
+    raise a ``FileNotFoundError``.
+
+    If the ``existing`` mask files are known, e.g. from a manifest,
+    the file system is not touched.
+    """
+    if existing is None:
+        def exists(path: Path):
+            return path.is_file()
+    else:
+        existing = {str(Path(path)) for path in existing}
+
+        def exists(path: Path):
+            return str(path) in existing
+
+    mask_paths = []
+    for file_path in file_paths:
+        relative = Path(file_path).relative_to(image_directory)
+        mask_path = Path(mask_directory) / relative.with_suffix(".png")
+        if not exists(mask_path):
+            mask_path = Path(mask_directory) / relative
+        if not exists(mask_path):
+            if "good" in relative.parts:
+                mask_paths.append("")
+                continue
+            raise FileNotFoundError(
+                f"No mask for {file_path} in {mask_directory}"
+            )
+        mask_paths.append(str(mask_path))
+    return np.asarray(mask_paths, dtype=str)
+
+
+def training_or_validation_split(
+        samples: np.ndarray,
+        validation_split: float,
+        subset: str
+) -> np.ndarray:
+    """
+    The last ``validation_split`` of ``samples`` are the validation split,
+    the rest is the training split. An empty subset returns all samples.
+    """
+    num_val_samples = int(validation_split * len(samples))
+    if subset == "training":
+        return samples[:len(samples) - num_val_samples]
+    if subset == "validation":
+        return samples[len(samples) - num_val_samples:]
+    return samples
+
+
+def load_image(
+        path: "tf.Tensor",
+        image_size: Tuple[int, int],
+        num_channels=3,
+        interpolation="bilinear",
+        crop_to_aspect_ratio=False
+) -> "tf.Tensor":
+    """
+    Reads, decodes and resizes an image like
+    ``keras.utils.image_dataset_from_directory`` does.
+    """
+    import tensorflow as tf
+
+    img = tf.io.read_file(path)
+    img = tf.image.decode_image(
+        img,
+        channels=num_channels,
+        expand_animations=False
+    )
+    if crop_to_aspect_ratio:
+        img = tf.keras.preprocessing.image.smart_resize(
+            img,
+            image_size,
+            interpolation=interpolation
+        )
+    else:
+        img = tf.image.resize(img, image_size, method=interpolation)
+    img.set_shape((image_size[0], image_size[1], num_channels))
+    return img
+
+
+def decode_image(path: "tf.Tensor", num_channels=3) -> "tf.Tensor":
+    """
+    Reads and decodes an image at its native size as float32.
+    """
+    import tensorflow as tf
+
+    img = tf.io.read_file(path)
+    img = tf.image.decode_image(
+        img,
+        channels=num_channels,
+        expand_animations=False
+    )
+    img.set_shape((None, None, num_channels))
+    return tf.cast(img, tf.float32)
+
+
+def mask_by_color(
+        img: "tf.Tensor",
+        col: Tuple[int, int, int]
+) -> "tf.Tensor":
+    import tensorflow as tf
 
-def mask_by_color(img: tf.Tensor, col: Tuple[int, int, int]) -> tf.Tensor:
     img = tf.cast(img == col, dtype=tf.uint8)
     img = tf.reduce_sum(img, axis=-1) == 3
     return tf.cast(img, dtype=tf.float32)
 
 
 def masking(
-        img: tf.Tensor,
+        img: "tf.Tensor",
         class_colors: List[Tuple[int, int, int]],
         stack_axis=-1
-) -> tf.Tensor:
+) -> "tf.Tensor":
+    import tensorflow as tf
+
     img = tf.image.convert_image_dtype(img, tf.uint8, saturate=True)
     img = tf.stack([
         mask_by_color(img, col)
@@ -41,6 +195,17 @@ def masking(
     return img
 
 
+def binary_mask(img: "tf.Tensor", threshold=128) -> "tf.Tensor":
+    """
+    One-hot (background, foreground) float32 mask of a single-channel
+    image in ``[0, 255]``. Pixels ``>= threshold`` are foreground.
+    """
+    import tensorflow as tf
+
+    foreground = tf.cast(img[..., 0] >= threshold, tf.float32)
+    return tf.stack([1 - foreground, foreground], axis=-1)
+
+
 def rgb_to_onehot(rgb_arr):
     color_dict = {
         0: (0, 0, 0),
@@ -63,24 +228,32 @@ def onehot_to_rgb(onehot, color_dict):
     return np.uint8(output)
 
 
-def sample_more_likely_in_the_middle(range_length):
+def sample_more_likely_in_the_middle(
+        range_length,
+        rng: Optional[np.random.Generator] = None
+):
     epsilon = 0.000001
     percentage = np.clip(
-        random.betavariate(5, 5),
+        random.betavariate(5, 5) if rng is None else rng.beta(5, 5),
         a_min=0,
         a_max=1 - epsilon
     )
     return int(percentage * range_length)
 
 
-def random_slice(np_img, width, height=None):
+def random_slice(
+        np_img,
+        width,
+        height=None,
+        rng: Optional[np.random.Generator] = None
+):
     if height is None:
         height = width
 
     mask_width, mask_height = np_img.shape[:2]
 
-    x_min = sample_more_likely_in_the_middle(mask_width - width)
-    y_min = sample_more_likely_in_the_middle(mask_height - height)
+    x_min = sample_more_likely_in_the_middle(mask_width - width, rng)
+    y_min = sample_more_likely_in_the_middle(mask_height - height, rng)
     # x_min = np.clip(x_min, 0, mask_width - width)
     # y_min = np.clip(y_min, 0, mask_height - height)
 
@@ -90,12 +263,20 @@ def random_slice(np_img, width, height=None):
     return np.s_[y_min: y_max, x_min: x_max, ...]
 
 
+def _num_pixels(mask):
+    import tensorflow as tf
+
+    return tf.cast(tf.reduce_prod(tf.shape(mask)[:-1]), mask.dtype)
+
+
 def combine_binary_masks(mask_1, mask_2):
+    import tensorflow as tf
+
     tf.assert_equal(tf.reduce_sum(mask_1),
-                    mask_1.shape[0] * mask_1.shape[1] * 1.,
+                    _num_pixels(mask_1),
                     message="first assertion")
     tf.assert_equal(tf.reduce_sum(mask_2),
-                    mask_2.shape[0] * mask_2.shape[1] * 1.,
+                    _num_pixels(mask_2),
                     message="second assertion")
 
     foreground = mask_1[..., 1] + mask_2[..., 1]
@@ -106,12 +287,14 @@ def combine_binary_masks(mask_1, mask_2):
 
     result = tf.stack((background, foreground), axis=-1)
     tf.assert_equal(tf.reduce_sum(result),
-                    result.shape[0] * result.shape[1] * 1.,
+                    _num_pixels(result),
                     message="thirdasserstion")
     return result
 
 
 def blend_merge(foreground, background, mask):
+    import cv2
+
     mask = cv2.GaussianBlur(
         np.array(mask * 255, dtype=np.uint8),
         tuple([3] * 2), 0  # mask.shape[0] // 16 + 1
@@ -124,17 +307,103 @@ def blend_merge(foreground, background, mask):
     return output
 
 
-def validate_images(path: Path):
-    print("Validating files in", path)
-    for path in tqdm(list(path.rglob("*.*"))):
-        try:
-            img = tf.io.read_file(str(path))
-            # convert the compressed string to a 3D uint8 tensor
-            tf.image.decode_image(img)
-        except:
-            print("could not open", path)
+def time_to_first_batch(
+        ds: "tf.data.Dataset",
+        start: Optional[float] = None
+) -> float:
+    """
+    Seconds from ``start``, a ``time.perf_counter`` value, until a new
+    iterator of ``ds`` produces its first element. ``start`` defaults to
+    the time of the call. ``ds`` itself is not changed.
+    """
+    start = time.perf_counter() if start is None else start
+    next(iter(ds))
+    return time.perf_counter() - start
+
+
+def validate_images(path: Path, **kwargs):
+    """
+    Validates all images in ``path`` and prints the corrupt files.
+    See ``tfds_defect_detection.validation.validate_images``.
+    """
+    from tfds_defect_detection.validation import validate_images
+
+    report = validate_images(path, **kwargs)
+    print(report)
+    return report
+
+
+def _reflink(src: Path, target: Path):
+    import fcntl
+
+    try:
+        with open(src, "rb") as src_file, open(target, "wb") as target_file:
+            fcntl.ioctl(target_file.fileno(), _FICLONE, src_file.fileno())
+    except OSError:
+        target.unlink(missing_ok=True)
+        raise
+
+
+def partial_path(target: Path) -> Path:
+    """
+    Temporary name ``target`` is written to before it is atomically
+    renamed. It is hidden and has no image extension, so leftovers of an
+    interrupted run are never listed by ``index_directory``.
+    """
+    return target.with_name(f".{target.name}.partial")
 
 
-def copy_to_folder(src: Path, target):
+def save_image(image: "PIL.Image.Image", target: Path, **kwargs):
+    """
+    Saves a PIL ``image`` to ``target`` atomically.
+    """
+    import PIL.Image
+
+    target.parent.mkdir(exist_ok=True, parents=True)
+    tmp_target = partial_path(target)
+    image.save(
+        tmp_target,
+        format=PIL.Image.registered_extensions()[target.suffix.lower()],
+        **kwargs
+    )
+    os.replace(tmp_target, target)
+
+
+def copy_to_folder(
+        src: Path,
+        target: Path,
+        link_mode: Literal["copy", "hardlink", "reflink", "auto"] = "copy"
+):
+    """
+    Places ``src`` at ``target`` and creates the parent folders.
+
+    "hardlink" and "reflink" share the data with ``src`` instead of
+    copying it, "auto" tries a hardlink, then a reflink and copies if the
+    file system supports neither, e.g. across devices.
+
+    The file is placed under ``partial_path(target)`` and renamed, so
+    ``target`` is either missing or complete, even if the process dies.
+    """
     target.parent.mkdir(exist_ok=True, parents=True)
-    shutil.copy(src, target)
+    tmp_target = partial_path(target)
+    if tmp_target.exists():
+        tmp_target.unlink()
+
+    if link_mode in ("hardlink", "auto"):
+        try:
+            os.link(src, tmp_target)
+            os.replace(tmp_target, target)
+            return
+        except OSError:
+            if link_mode == "hardlink":
+                raise
+    if link_mode in ("reflink", "auto"):
+        try:
+            _reflink(src, tmp_target)
+            os.replace(tmp_target, target)
+            return
+        except (OSError, ImportError):
+            if link_mode == "reflink":
+                raise
+    shutil.copy(src, tmp_target)
+    os.replace(tmp_target, target)
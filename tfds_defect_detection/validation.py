@@ -0,0 +1,196 @@
+"""
+Parallel, cached validation of image files.
+
+``validate_images`` checks every file of a folder in a thread or process
+pool and remembers the outcome in a cache next to the folder, keyed by
+``(path, size, mtime)``. Re-runs only check new or changed files.
+Hidden files and ``.partial`` leftovers of an interrupted preparation
+are skipped, see ``tfds_defect_detection.utils.partial_path``.
+
+Two modes are available
+
+- "header" opens the file with PIL and runs ``verify``, and checks that
+  PNG, JPEG and GIF files are not truncated from their last 4 KiB. For
+  PNG files ``verify`` reads every chunk to check its checksum, so the
+  whole file is read, but nothing is decompressed. Other formats only
+  have their header parsed.
+- "decode" fully decodes every file with TensorFlow, like the pipeline.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from tqdm import tqdm
+from typing_extensions import Literal
+
+ValidationMode = Literal["header", "decode"]
+
+# Modes that also cover the checks of a weaker mode
+_STRENGTH = {"header": 0, "decode": 1}
+
+# Bytes a complete file ends with, trailing padding is ignored
+_TRAILERS = {
+    ".png": b"IEND\xaeB`\x82",
+    ".jpg": b"\xff\xd9",
+    ".jpeg": b"\xff\xd9",
+    ".gif": b";",
+}
+
+
+@dataclass
+class ValidationReport:
+    folder: Path
+    mode: str
+    num_files: int = 0
+    num_checked: int = 0
+    num_cached: int = 0
+    corrupt: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.corrupt
+
+    def __str__(self):
+        lines = [
+            f"Validated {self.num_files} files in {self.folder} "
+            f"({self.mode}): {self.num_checked} checked, "
+            f"{self.num_cached} cached, {len(self.corrupt)} corrupt"
+        ]
+        lines += [
+            f"  {path}: {error}"
+            for path, error in sorted(self.corrupt.items())
+        ]
+        return "\n".join(lines)
+
+
+def cache_file(folder: Path) -> Path:
+    return folder.parent / f".{folder.name}_validation.json"
+
+
+def _is_skipped(relative: Path) -> bool:
+    return any(
+        part.startswith(".") or part.endswith(".partial")
+        for part in relative.parts
+    )
+
+
+def _check_header(path: str):
+    import PIL.Image
+
+    with PIL.Image.open(path) as img:
+        img.verify()
+
+    trailer = _TRAILERS.get(os.path.splitext(path)[1].lower())
+    if trailer is not None:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - 4096))
+            tail = f.read().rstrip(b"\x00\r\n")
+        if not tail.endswith(trailer):
+            raise ValueError("File is truncated")
+
+
+def _check_decode(path: str):
+    import tensorflow as tf
+
+    tf.image.decode_image(tf.io.read_file(path), expand_animations=False)
+
+
+def _check(path: str, mode: ValidationMode) -> Optional[str]:
+    """
+    Returns the error of ``path``, or ``None`` if it is valid.
+    """
+    try:
+        if mode == "header":
+            _check_header(path)
+        else:
+            _check_decode(path)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def _check_args(args: Tuple[str, str]) -> Optional[str]:
+    return _check(*args)
+
+
+def validate_images(
+        folder: Path,
+        mode: ValidationMode = "decode",
+        num_workers=16,
+        executor: Literal["thread", "process"] = "thread",
+        use_cache=True,
+) -> ValidationReport:
+    """
+    Checks all files in ``folder`` with ``num_workers`` threads or
+    processes and returns a ``ValidationReport`` of the corrupt files.
+
+    Results are cached in ``cache_file(folder)``. A cached result is
+    reused if size and mtime of the file did not change and it was
+    checked with the same or a stronger mode. Entries of files that no
+    longer exist are dropped.
+    """
+    folder = Path(folder)
+    cache = {}
+    if use_cache and cache_file(folder).is_file():
+        with open(cache_file(folder)) as f:
+            cache = json.load(f)
+
+    report = ValidationReport(folder=folder, mode=mode)
+    to_check = []
+    listed = set()
+    for path in folder.rglob("*.*"):
+        if not path.is_file() or _is_skipped(path.relative_to(folder)):
+            continue
+        report.num_files += 1
+        relative = path.relative_to(folder).as_posix()
+        listed.add(relative)
+        stat = path.stat()
+        cached = cache.get(relative)
+        if (
+                cached is not None
+                and cached["size"] == stat.st_size
+                and cached["mtime_ns"] == stat.st_mtime_ns
+                and _STRENGTH[cached["mode"]] >= _STRENGTH[mode]
+        ):
+            report.num_cached += 1
+            if cached["error"] is not None:
+                report.corrupt[relative] = cached["error"]
+            continue
+        to_check.append((relative, stat))
+
+    pool = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+    with pool(num_workers) as workers:
+        errors = workers.map(
+            _check_args,
+            [(str(folder / relative), mode) for relative, _ in to_check]
+        )
+        for (relative, stat), error in tqdm(
+                zip(to_check, errors),
+                total=len(to_check),
+                desc=f"Validating {folder}"
+        ):
+            report.num_checked += 1
+            cache[relative] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "mode": mode,
+                "error": error,
+            }
+            if error is not None:
+                report.corrupt[relative] = error
+
+    pruned = {
+        relative: entry
+        for relative, entry in cache.items()
+        if relative in listed
+    }
+    if use_cache and (to_check or len(pruned) < len(cache)):
+        tmp_file = cache_file(folder).with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(pruned, f)
+        os.replace(tmp_file, cache_file(folder))
+
+    return report